@@ -0,0 +1,128 @@
+# # -----------------------------------------------------------------------------
+# # Command line interface of the COPDgene steps (convert, segment, register, predict, evaluate, benchmark)
+# # Date Created: 19-10-2026
+# # -----------------------------------------------------------------------------
+
+import argparse
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+# Only the standard library is imported here: each subcommand imports what it needs, so that e.g. evaluate
+# starts without itk, SimpleITK or scipy.
+
+
+def runCases(function, imageNumbers, numberOfJobs=1):
+    # calls function(imageNumber) for every case, numberOfJobs at a time, raises the first failure
+    with ThreadPoolExecutor(max_workers=numberOfJobs) as executor:
+        futures = [executor.submit(function, imageNumber) for imageNumber in imageNumbers]
+        for future in futures:
+            future.result()
+
+
+def createCOPDgene(args, **kwargs):
+    from main import COPDgene
+    return COPDgene(args.data, args.output, args.parameters, evalResultsDirectory=args.evaluation, preset=args.preset, **kwargs)
+
+
+#################################
+### SUBCOMMANDS #################
+#################################
+
+def convert(args):
+    # raw .img scans of openImages.IMAGE_CASES -> .nii, paths relative to the data folder
+    import openImages
+    cases = []
+    for case in openImages.IMAGE_CASES:
+        caseName = os.path.basename(os.path.dirname(case["raw_file_name"]))
+        if int(caseName[len("copd"):]) in args.cases:
+            cases.append(dict(case, raw_file_name=os.path.join(args.data, os.path.relpath(case["raw_file_name"], "data")),
+                              out_file_name=os.path.join(args.data, os.path.relpath(case["out_file_name"], "data"))))
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        list(executor.map(openImages.convertImage, cases))
+    print(f"converted {len(cases)} scans")
+
+def segment(args):
+    copdgene = createCOPDgene(args)
+    runCases(lambda imageNumber: copdgene.segmentCase(imageNumber, args.streaming), args.cases, args.jobs)
+
+def register(args):
+    from outputWriter import OutputWriter
+    outputWriter = OutputWriter(imageType=args.image_type, retention=args.retention)
+    copdgene = createCOPDgene(args, adaptiveParameters=args.adaptive_parameters, outputWriter=outputWriter,
+                              keypoints=args.keypoints is not None, keypointWeight=args.keypoints if args.keypoints is not None else 0.1)
+    try:
+        copdgene.registerCases(args.cases, not args.no_segmentation, args.warm_start, args.jobs)
+    finally:
+        outputWriter.close()
+    for caseName, (runtime, peakMemory) in sorted(copdgene.caseRuntimes.items()):
+        memory = f"peak memory {peakMemory:.0f} MB" if peakMemory is not None else "memory not measured (overlapping cases)"
+        print(f"{caseName}: {runtime:.1f}s, {memory}")
+
+def predict(args):
+    copdgene = createCOPDgene(args)
+    runCases(copdgene.predictCase, args.cases, args.jobs)
+
+def evaluate(args):
+    copdgene = createCOPDgene(args)
+    if args.predict:
+        runCases(copdgene.predictCase, args.cases, args.jobs)
+    runId = copdgene.evaluateTrain(args.name, args.cases)
+    print(copdgene.resultStore.report([runId]))
+
+def benchmark(args):
+    from parameterMaps import benchmarkPresets
+    benchmarkPresets(args.presets, args.data, args.output, args.cases, args.jobs)
+
+
+def buildParser():
+    parser = argparse.ArgumentParser(description="COPDgene registration steps. Heavy dependencies are only loaded by the subcommands that use them.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--data", default="data", help="dataset folder with copd<N> subfolders")
+    common.add_argument("--cases", type=int, nargs="+", default=[1, 2, 3, 4])
+    common.add_argument("--jobs", type=int, default=1, help="cases processed at the same time")
+
+    experiment = argparse.ArgumentParser(add_help=False, parents=[common])
+    experiment.add_argument("--output", default="results")
+    experiment.add_argument("--evaluation", default="evaluation", help="folder of the result store and the csv files")
+    experiment.add_argument("--parameters", default="customParameters", help="elastix parameter folder")
+    experiment.add_argument("--preset", default=None, choices=["fast", "balanced", "accurate"], help="parameter preset instead of the folder, fast and accurate are experimental (not benchmarked yet)")
+
+    subparsers.add_parser("convert", parents=[common], help="raw .img scans to .nii").set_defaults(function=convert)
+
+    segmentParser = subparsers.add_parser("segment", parents=[experiment], help="lung segmentation of both phases")
+    segmentParser.add_argument("--streaming", action="store_true", help="bounded memory segmentation")
+    segmentParser.set_defaults(function=segment)
+
+    registerParser = subparsers.add_parser("register", parents=[experiment], help="elastix registration")
+    registerParser.add_argument("--no-segmentation", action="store_true", help="register the full scans")
+    registerParser.add_argument("--warm-start", default=None, help="folder with voxelmorph flow_copd<N>.nii.gz fields")
+    registerParser.add_argument("--adaptive-parameters", action="store_true", help="adapt pyramid, grid spacing and samples to each case")
+    registerParser.add_argument("--keypoints", type=float, default=None, metavar="WEIGHT", help="add keypoint correspondences with this metric weight")
+    registerParser.add_argument("--image-type", default="float32", choices=["float32", "int16", "scaledInt16"], help="storage of the warped images (.nii.gz)")
+    registerParser.add_argument("--retention", default="all", choices=["all", "transformsAndPoints"])
+    registerParser.set_defaults(function=register)
+
+    subparsers.add_parser("predict", parents=[experiment], help="predicted landmarks from the transformed points").set_defaults(function=predict)
+
+    evaluateParser = subparsers.add_parser("evaluate", parents=[experiment], help="TRE of the predictions, stored in the result store")
+    evaluateParser.add_argument("--name", required=True, help="name of the evaluation run")
+    evaluateParser.add_argument("--predict", action="store_true", help="extract the predictions first")
+    evaluateParser.set_defaults(function=evaluate)
+
+    benchmarkParser = subparsers.add_parser("benchmark", parents=[common], help="register and evaluate the cases with parameter presets")
+    benchmarkParser.add_argument("--output", default="results")
+    benchmarkParser.add_argument("--presets", nargs="+", default=["fast", "balanced", "accurate"], choices=["fast", "balanced", "accurate"])
+    benchmarkParser.set_defaults(function=benchmark)
+    return parser
+
+
+def main(argv=None):
+    args = buildParser().parse_args(argv)
+    args.function(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,231 @@
+# # -----------------------------------------------------------------------------
+# # Metric and landmark error of a registration per resolution (and every K iterations)
+# # Date Created: 19-10-2026
+# # -----------------------------------------------------------------------------
+
+import argparse
+import csv
+import glob
+import os
+import re
+import threading
+
+import numpy as np
+
+from utils import Utils
+from evaluation import Evaluation
+from deformationAnalysis import TransformChain, UnsupportedTransformError
+
+
+class ConvergenceMonitor:
+    # Monitoring mode of Registration (Registration(..., convergenceMonitor=ConvergenceMonitor(...))).
+    # elastix writes its transform at the end of every resolution and, with everyIterations, at every iteration
+    # into the monitor folder; a background thread deletes all iteration files except every K-th one while
+    # elastix runs. The landmarks are warped in memory with the analytic transforms of deformationAnalysis.py
+    # (no transformix per checkpoint) and compared to the ground truth. Metric values and iteration times are
+    # read from elastix's IterationInfo files. Warm starts (DeformationFieldTransform) get no TRE.
+    CHECKPOINT_PATTERN = re.compile(r"TransformParameters\.(\d+)\.R(\d+)(?:\.It(\d+))?\.txt$")
+    util = Utils()
+
+    def __init__(self, outputDirectory, groundTruthPointPath=None, everyIterations=None, pollSeconds=0.2):
+        self.outputDirectory = os.path.abspath(outputDirectory)
+        self.groundTruthPointPath = groundTruthPointPath
+        self.everyIterations = everyIterations
+        self.pollSeconds = pollSeconds
+        self.records = []
+
+    #################################
+    ### ELASTIX #####################
+    #################################
+
+    def prepare(self, parameterObject):
+        # asks elastix to write the intermediate transforms, returns the parameter object
+        self.util.ensureFolderExists(self.outputDirectory)
+        for path in glob.glob(os.path.join(self.outputDirectory, "*.txt")):
+            os.remove(path)
+        for index in range(parameterObject.GetNumberOfParameterMaps()):
+            parameterMap = dict(parameterObject.GetParameterMap(index))
+            parameterMap["WriteTransformParametersEachResolution"] = ["true"]
+            parameterMap["WriteTransformParametersEachIteration"] = ["true" if self.everyIterations else "false"]
+            parameterObject.SetParameterMap(index, parameterMap)
+        return parameterObject
+
+    def start(self):
+        self.stopEvent = threading.Event()
+        self.pruner = threading.Thread(target=self.pruneIterationFiles, daemon=True)
+        self.pruner.start()
+
+    def stop(self):
+        self.stopEvent.set()
+        self.pruner.join()
+        self.pruneOnce()
+
+    def pruneIterationFiles(self):
+        # the iteration files of a B-spline transform are megabytes each, only every K-th is kept
+        while not self.stopEvent.wait(self.pollSeconds):
+            self.pruneOnce()
+
+    def pruneOnce(self):
+        if not self.everyIterations:
+            return
+        for path in glob.glob(os.path.join(self.outputDirectory, "TransformParameters.*.It*.txt")):
+            match = self.CHECKPOINT_PATTERN.search(path)
+            if match and int(match.group(3)) % self.everyIterations != 0:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    #################################
+    ### CHECKPOINTS #################
+    #################################
+
+    def collect(self, pointFilePath, registrationTypeList):
+        # one record per checkpoint: map, resolution, iteration, metric, elapsed iteration time and TRE
+        fixedLandmarks = np.asarray(Evaluation.readPointsFromFile(pointFilePath), dtype=np.float64) if pointFilePath else None
+        groundTruth = np.asarray(Evaluation.readPointsFromFile(self.groundTruthPointPath), dtype=np.float64) if self.groundTruthPointPath else None
+        iterationInfo = self.readIterationInfo()
+        elapsedBefore = self.elapsedBeforeEachResolution(iterationInfo)
+
+        self.records = []
+        for path, mapIndex, resolution, iteration in self.findCheckpoints(iterationInfo):
+            info = iterationInfo.get((mapIndex, resolution), [])
+            row = info[min(iteration, len(info) - 1)] if info else None
+            self.records.append({
+                "map": mapIndex,
+                "registrationType": registrationTypeList[mapIndex] if mapIndex < len(registrationTypeList) else str(mapIndex),
+                "resolution": resolution,
+                "iteration": iteration,
+                "metric": row["metric"] if row else float("nan"),
+                "seconds": elapsedBefore.get((mapIndex, resolution), 0.0) + (row["elapsed"] if row else 0.0),
+                "tre": self.landmarkError(path, fixedLandmarks, groundTruth),
+                })
+        return self.records
+
+    def findCheckpoints(self, iterationInfo):
+        # (path, map, resolution, iteration) in the order elastix wrote them, end of resolution = last iteration
+        checkpoints = []
+        for path in glob.glob(os.path.join(self.outputDirectory, "TransformParameters.*.R*.txt")):
+            match = self.CHECKPOINT_PATTERN.search(path)
+            if not match:
+                continue
+            mapIndex, resolution = int(match.group(1)), int(match.group(2))
+            if match.group(3) is not None:
+                iteration = int(match.group(3))
+            else:
+                iteration = max(len(iterationInfo.get((mapIndex, resolution), [])) - 1, 0)
+            checkpoints.append((path, mapIndex, resolution, iteration))
+        # an iteration file of the last iteration duplicates the end of resolution
+        unique = {(mapIndex, resolution, iteration): path for path, mapIndex, resolution, iteration in sorted(checkpoints, key=lambda c: c[0])}
+        return [(path, *key) for key, path in sorted(unique.items())]
+
+    def landmarkError(self, parameterFile, fixedLandmarks, groundTruth):
+        # mean distance in mm between the warped fixed landmarks and the ground truth, both as fixed grid indices
+        if fixedLandmarks is None or groundTruth is None:
+            return float("nan")
+        try:
+            chain = TransformChain([parameterFile])
+        except UnsupportedTransformError:
+            return float("nan")
+        predicted = chain.indicesOf(chain.transformPoints(chain.pointsOf(fixedLandmarks)))
+        nPoints = min(len(predicted), len(groundTruth))
+        return float(np.mean(np.linalg.norm((predicted[:nPoints] - groundTruth[:nPoints]) * chain.spacing, axis=1)))
+
+    def readIterationInfo(self):
+        # {(map, resolution): [{"metric": ..., "elapsed": seconds since the start of the resolution}]}
+        iterationInfo = {}
+        for path in glob.glob(os.path.join(self.outputDirectory, "IterationInfo.*.R*.txt")):
+            match = re.search(r"IterationInfo\.(\d+)\.R(\d+)\.txt$", path)
+            with open(path, 'r') as file:
+                header = file.readline().rstrip("\n").split("\t")
+                metricColumn = next(i for i, name in enumerate(header) if "Metric" in name)
+                timeColumn = next(i for i, name in enumerate(header) if name.startswith("Time"))
+                rows, elapsed = [], 0.0
+                for line in file:
+                    values = line.split()
+                    if len(values) <= max(metricColumn, timeColumn):
+                        continue
+                    elapsed += float(values[timeColumn]) / 1000
+                    rows.append({"metric": float(values[metricColumn]), "elapsed": elapsed})
+            iterationInfo[(int(match.group(1)), int(match.group(2)))] = rows
+        return iterationInfo
+
+    @staticmethod
+    def elapsedBeforeEachResolution(iterationInfo):
+        elapsedBefore, total = {}, 0.0
+        for key in sorted(iterationInfo):
+            elapsedBefore[key] = total
+            if iterationInfo[key]:
+                total += iterationInfo[key][-1]["elapsed"]
+        return elapsedBefore
+
+    #################################
+    ### REPORT ######################
+    #################################
+
+    def writeCsv(self, filePath=None):
+        filePath = filePath or os.path.join(self.outputDirectory, "convergence.csv")
+        with open(filePath, mode='w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=["map", "registrationType", "resolution", "iteration", "metric", "seconds", "tre"])
+            writer.writeheader()
+            writer.writerows(self.records)
+        return filePath
+
+    def suggestSchedule(self, toleranceMM=0.1):
+        # per map: the iterations after which the TRE of each resolution stays within toleranceMM of its value at the
+        # end of the resolution, and the resolutions after which the final TRE of the map is already reached
+        suggestions = []
+        for mapIndex in sorted({record["map"] for record in self.records}):
+            records = [record for record in self.records if record["map"] == mapIndex]
+            resolutions = sorted({record["resolution"] for record in records})
+            levels = []
+            for resolution in resolutions:
+                checkpoints = sorted((record for record in records if record["resolution"] == resolution), key=lambda record: record["iteration"])
+                finalTre = checkpoints[-1]["tre"]
+                iterations = checkpoints[-1]["iteration"] + 1
+                # first checkpoint from which on all later ones are within the tolerance
+                for index in range(len(checkpoints)):
+                    if all(abs(record["tre"] - finalTre) <= toleranceMM for record in checkpoints[index:]):
+                        iterations = checkpoints[index]["iteration"] + 1
+                        break
+                levels.append({"resolution": resolution, "iterationsRun": checkpoints[-1]["iteration"] + 1, "tre": finalTre,
+                               "suggestedIterations": iterations, "seconds": checkpoints[-1]["seconds"]})
+
+            mapTre = levels[-1]["tre"]
+            nResolutions = next((index + 1 for index, level in enumerate(levels) if abs(level["tre"] - mapTre) <= toleranceMM), len(levels))
+            suggestions.append({"map": mapIndex, "registrationType": records[0]["registrationType"], "levels": levels, "suggestedResolutions": nResolutions})
+        return suggestions
+
+    def report(self, toleranceMM=0.1):
+        lines = [f"Convergence report, tolerance {toleranceMM} mm (checkpoints every {self.everyIterations or 'resolution'} iterations)"]
+        for suggestion in self.suggestSchedule(toleranceMM):
+            lines.append(f"\n{suggestion['registrationType']} (map {suggestion['map']})")
+            lines.append(f"{'resolution':>10} {'iterations':>10} {'TRE[mm]':>8} {'time[s]':>8} {'suggested':>10}")
+            for level in suggestion["levels"]:
+                lines.append(f"{level['resolution']:>10} {level['iterationsRun']:>10} {level['tre']:8.3f} {level['seconds']:8.1f} {level['suggestedIterations']:>10}")
+            keptLevels = suggestion["levels"][:suggestion["suggestedResolutions"]]
+            lines.append(f"(NumberOfResolutions {suggestion['suggestedResolutions']})  // finest levels dropped, pyramid and grid schedules keep their first entries")
+            lines.append(f"(MaximumNumberOfIterations {' '.join(str(level['suggestedIterations']) for level in keptLevels)})")
+        lines.append("\nThe levels are judged one at a time: rerun with the suggested schedule to confirm the TRE.")
+        return "\n".join(lines)
+
+    def writeReport(self, toleranceMM=0.1, filePath=None):
+        filePath = filePath or os.path.join(self.outputDirectory, "convergence_report.txt")
+        with open(filePath, 'w') as file:
+            file.write(self.report(toleranceMM) + "\n")
+        return filePath
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild the convergence table and report of a monitored registration folder.")
+    parser.add_argument("folder", help="monitor folder with the TransformParameters and IterationInfo files")
+    parser.add_argument("--points", required=True, help="fixed landmarks (index point file)")
+    parser.add_argument("--ground-truth", required=True, help="ground truth landmarks of the moving image")
+    parser.add_argument("--types", nargs="+", default=["affine", "bspline"], help="registration type of each map")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="TRE tolerance in mm")
+    args = parser.parse_args()
+
+    monitor = ConvergenceMonitor(args.folder, args.ground_truth)
+    monitor.collect(args.points, args.types)
+    monitor.writeCsv()
+    print(monitor.report(args.tolerance))
@@ -0,0 +1,531 @@
+# # -----------------------------------------------------------------------------
+# # Jacobian determinant, folding and regional volume change of a registration, computed slab by slab
+# # Date Created: 19-10-2026
+# # -----------------------------------------------------------------------------
+
+import argparse
+import csv
+import os
+import re
+import shlex
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import nibabel as nib
+
+from utils import Utils
+
+
+#################################
+### TRANSFORMS ##################
+#################################
+
+def readParameterFile(filePath):
+    # elastix parameter file -> {key: [values]}, numbers converted to float
+    parameters = {}
+    with open(filePath, 'r') as file:
+        for line in file:
+            match = re.match(r"^\s*\((\w+)\s+(.*)\)\s*$", line.split("//")[0])
+            if not match:
+                continue
+            values = []
+            for value in shlex.split(match.group(2)):
+                try:
+                    values.append(float(value))
+                except ValueError:
+                    values.append(value)
+            parameters[match.group(1)] = values
+    return parameters
+
+
+class UnsupportedTransformError(ValueError):
+    # a transform parameter map this module cannot evaluate
+    pass
+
+
+def readMetaImage(filePath):
+    # MetaImage (.mhd/.mha) as written by itk -> (array (z,y,x) or (z,y,x,channels), spacing, origin, direction).
+    # Uncompressed data is memory mapped. The TransformMatrix holds the direction cosines column by column
+    header, headerBytes = {}, 0
+    with open(filePath, 'rb') as file:
+        for line in file:
+            headerBytes += len(line)
+            key, _, value = line.decode("latin-1").partition("=")
+            header[key.strip()] = value.strip()
+            if key.strip() == "ElementDataFile":
+                break
+    dtypes = {"MET_FLOAT": np.float32, "MET_DOUBLE": np.float64, "MET_SHORT": np.int16, "MET_USHORT": np.uint16,
+              "MET_UCHAR": np.uint8, "MET_CHAR": np.int8, "MET_INT": np.int32, "MET_UINT": np.uint32}
+    if header.get("ElementType") not in dtypes:
+        raise UnsupportedTransformError(f"{filePath}: element type {header.get('ElementType')} is not supported")
+    dtype = np.dtype(dtypes[header["ElementType"]]).newbyteorder(">" if header.get("BinaryDataByteOrderMSB", header.get("ElementByteOrderMSB", "False")) == "True" else "<")
+    size = [int(value) for value in header["DimSize"].split()]
+    channels = int(header.get("ElementNumberOfChannels", 1))
+    shape = tuple(reversed(size)) + ((channels,) if channels > 1 else ())
+    if header["ElementDataFile"] == "LOCAL":
+        dataPath, offset = filePath, headerBytes
+    else:
+        dataPath, offset = os.path.join(os.path.dirname(filePath), header["ElementDataFile"]), 0
+    if header.get("CompressedData", "False") == "True":
+        with open(dataPath, 'rb') as file:
+            file.seek(offset)
+            array = np.frombuffer(zlib.decompress(file.read()), dtype=dtype).reshape(shape)
+    else:
+        array = np.memmap(dataPath, dtype=dtype, mode='r', offset=offset, shape=shape)
+    spacing = np.array(header.get("ElementSpacing", "1 1 1").split(), dtype=np.float64)
+    origin = np.array(header.get("Offset", header.get("Origin", "0 0 0")).split(), dtype=np.float64)
+    direction = np.array(header.get("TransformMatrix", "1 0 0 0 1 0 0 0 1").split(), dtype=np.float64).reshape(3, 3).T
+    return array, spacing, origin, direction
+
+
+class LinearTransform:
+    # Translation, Euler and Affine transforms: T(p) = M (p - c) + c + t
+    def __init__(self, matrix, center, translation):
+        self.matrix = np.asarray(matrix, dtype=np.float64)
+        self.center = np.asarray(center, dtype=np.float64)
+        self.translation = np.asarray(translation, dtype=np.float64)
+
+    @classmethod
+    def fromParameters(cls, parameters):
+        kind = parameters["Transform"][0]
+        values = np.array(parameters["TransformParameters"], dtype=np.float64)
+        center = parameters.get("CenterOfRotationPoint", [0.0, 0.0, 0.0])
+        if kind == "TranslationTransform":
+            return cls(np.eye(3), center, values)
+        if kind == "AffineTransform":
+            return cls(values[:9].reshape(3, 3), center, values[9:12])
+        if kind == "EulerTransform":
+            return cls(cls.eulerMatrix(values[:3], parameters.get("ComputeZYX", ["false"])[0] == "true"), center, values[3:6])
+        raise UnsupportedTransformError(f"{kind} is not a linear transform")
+
+    @staticmethod
+    def eulerMatrix(angles, computeZYX=False):
+        # same convention as itk::Euler3DTransform
+        cx, cy, cz = np.cos(angles)
+        sx, sy, sz = np.sin(angles)
+        rotationX = np.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]])
+        rotationY = np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])
+        rotationZ = np.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]])
+        return rotationZ @ rotationY @ rotationX if computeZYX else rotationZ @ rotationX @ rotationY
+
+    def transform(self, points):
+        # returns the transformed points (N,3) and the jacobian (3,3), the same for every point
+        return (points - self.center) @ self.matrix.T + self.center + self.translation, self.matrix
+
+
+class BSplineTransform:
+    # cubic B-spline transform of elastix. Displacement and its derivatives are evaluated analytically
+    # from the coefficients, no dense deformation field is created
+    def __init__(self, parameters):
+        if int(parameters.get("BSplineTransformSplineOrder", [3])[0]) != 3:
+            raise UnsupportedTransformError("Only cubic B-splines are supported")
+        self.gridSize = np.array(parameters["GridSize"], dtype=np.int64)
+        self.gridIndex = np.array(parameters.get("GridIndex", [0, 0, 0]), dtype=np.int64)
+        self.gridSpacing = np.array(parameters["GridSpacing"], dtype=np.float64)
+        self.gridOrigin = np.array(parameters["GridOrigin"], dtype=np.float64)
+        gridDirection = np.array(parameters.get("GridDirection", [1, 0, 0, 0, 1, 0, 0, 0, 1]), dtype=np.float64).reshape(3, 3)
+        # continuous grid index = indexFromPoint @ (p - origin), derivative of the index with respect to p
+        self.indexFromPoint = np.linalg.inv(gridDirection) / self.gridSpacing[:, None]
+        # coefficients in mm, all x displacements first (x index fastest), then y, then z
+        self.coefficients = np.array(parameters["TransformParameters"], dtype=np.float64).reshape(3, -1)
+
+    @staticmethod
+    def weightsOf(t):
+        # cubic B-spline weights and their derivatives for the 4 supporting coefficients
+        weights = np.stack([(1 - t)**3, 3 * t**3 - 6 * t**2 + 4, -3 * t**3 + 3 * t**2 + 3 * t + 1, t**3], axis=1) / 6
+        derivatives = np.stack([-(1 - t)**2, 3 * t**2 - 4 * t, -3 * t**2 + 2 * t + 1, t**2], axis=1) / 2
+        return weights, derivatives
+
+    def transform(self, points):
+        # returns the transformed points (N,3) and the jacobians (N,3,3)
+        continuousIndex = (points - self.gridOrigin) @ self.indexFromPoint.T - self.gridIndex
+        floorIndex = np.floor(continuousIndex)
+        start = floorIndex.astype(np.int64) - 1
+        inside = np.all((start >= 0) & (start + 3 < self.gridSize), axis=1)
+        start[~inside] = 0
+        weights, derivatives = zip(*[self.weightsOf(continuousIndex[:, axis] - floorIndex[:, axis]) for axis in range(3)])
+
+        displacement = np.zeros((len(points), 3))
+        indexDerivative = np.zeros((len(points), 3, 3))
+        for c in range(4):
+            for b in range(4):
+                flatIndex = ((start[:, 2] + c) * self.gridSize[1] + start[:, 1] + b) * self.gridSize[0] + start[:, 0]
+                for a in range(4):
+                    coefficient = self.coefficients[:, flatIndex + a].T
+                    displacement += coefficient * (weights[0][:, a] * weights[1][:, b] * weights[2][:, c])[:, None]
+                    indexDerivative[:, :, 0] += coefficient * (derivatives[0][:, a] * weights[1][:, b] * weights[2][:, c])[:, None]
+                    indexDerivative[:, :, 1] += coefficient * (weights[0][:, a] * derivatives[1][:, b] * weights[2][:, c])[:, None]
+                    indexDerivative[:, :, 2] += coefficient * (weights[0][:, a] * weights[1][:, b] * derivatives[2][:, c])[:, None]
+        # outside the support region the transform is the identity
+        displacement[~inside] = 0
+        indexDerivative[~inside] = 0
+        jacobian = np.eye(3) + indexDerivative @ self.indexFromPoint
+        return points + displacement, jacobian
+
+
+class DeformationFieldTransform:
+    # elastix DeformationFieldTransform (the warm start of Registration.createInitialTransformFrom): a dense
+    # displacement field in mm, sampled trilinearly. Outside the field the transform is the identity, like itk.
+    # The jacobian is a central finite difference of the sampled field, half a field voxel to each side (one sided
+    # at the border of the field)
+    def __init__(self, parameters):
+        fieldPath = parameters["DeformationFieldFileName"][0]
+        if not os.path.isabs(fieldPath):
+            fieldPath = os.path.join(os.path.dirname(parameters["_path"]), fieldPath)
+        if int(parameters.get("DeformationFieldInterpolationOrder", [1])[0]) != 1:
+            raise UnsupportedTransformError("Only linearly interpolated deformation fields are supported")
+        # field (z,y,x,3), the vectors are (x,y,z) in mm
+        self.field, spacing, self.origin, direction = readMetaImage(fieldPath)
+        if self.field.ndim != 4 or self.field.shape[3] != 3:
+            raise UnsupportedTransformError(f"{fieldPath} is not a 3D displacement field")
+        self.size = np.array(self.field.shape[2::-1], dtype=np.int64)
+        self.indexFromPoint = np.linalg.inv(direction) / spacing[:, None]
+
+    def sample(self, continuousIndex):
+        # trilinear interpolation of the field at continuous indices (N,3) in (x,y,z) order, zero outside
+        floorIndex = np.floor(continuousIndex)
+        fraction = continuousIndex - floorIndex
+        start = floorIndex.astype(np.int64)
+        inside = np.all((start >= 0) & (start + 1 < self.size), axis=1)
+        start[~inside] = 0
+        displacement = np.zeros((len(continuousIndex), 3))
+        for corner in np.ndindex(2, 2, 2):
+            weight = np.prod(np.where(corner, fraction, 1 - fraction), axis=1)
+            index = start + corner
+            displacement += np.asarray(self.field[index[:, 2], index[:, 1], index[:, 0]], dtype=np.float64) * weight[:, None]
+        displacement[~inside] = 0
+        return displacement
+
+    def transform(self, points):
+        # returns the transformed points (N,3) and the jacobians (N,3,3)
+        continuousIndex = (points - self.origin) @ self.indexFromPoint.T
+        displacement = self.sample(continuousIndex)
+        inside = np.all((continuousIndex >= 0) & (continuousIndex < self.size - 1), axis=1)
+        indexDerivative = np.zeros((len(points), 3, 3))
+        for axis in range(3):
+            lower, upper = continuousIndex.copy(), continuousIndex.copy()
+            lower[:, axis] = np.maximum(continuousIndex[:, axis] - 0.5, 0)
+            upper[:, axis] = np.minimum(continuousIndex[:, axis] + 0.5, self.size[axis] - 1 - 1e-6)
+            distance = np.maximum(upper[:, axis] - lower[:, axis], 1e-6)
+            indexDerivative[:, :, axis] = (self.sample(upper) - self.sample(lower)) / distance[:, None]
+        indexDerivative[~inside] = 0
+        jacobian = np.eye(3) + indexDerivative @ self.indexFromPoint
+        return points + displacement, jacobian
+
+
+class TransformChain:
+    # the transform parameter maps stored by Registration.safeTransformParameterObject, applied in order
+    TRANSFORMS = {"TranslationTransform", "EulerTransform", "AffineTransform"}
+
+    def __init__(self, parameterFiles):
+        self.parameters = []
+        for parameterFile in parameterFiles:
+            self.parameters += self.readWithInitialTransforms(parameterFile, known=[p.get("_path") for p in self.parameters])
+        self.transforms = [self.createTransform(parameters) for parameters in self.parameters]
+        # geometry of the fixed image, the voxels the jacobian is computed on
+        last = self.parameters[-1]
+        self.size = np.array(last["Size"], dtype=np.int64)
+        self.spacing = np.array(last["Spacing"], dtype=np.float64)
+        self.origin = np.array(last["Origin"], dtype=np.float64)
+        self.direction = np.array(last.get("Direction", [1, 0, 0, 0, 1, 0, 0, 0, 1]), dtype=np.float64).reshape(3, 3)
+
+    @staticmethod
+    def readWithInitialTransforms(parameterFile, known=()):
+        # follows InitialTransformParametersFileName, the initial transforms are applied first
+        parameters = readParameterFile(parameterFile)
+        parameters["_path"] = os.path.abspath(parameterFile)
+        initialFile = parameters.get("InitialTransformParametersFileName", ["NoInitialTransform"])[0]
+        if initialFile == "NoInitialTransform":
+            return [parameters]
+        if not os.path.isabs(initialFile):
+            initialFile = os.path.join(os.path.dirname(parameterFile), initialFile)
+        if os.path.abspath(initialFile) in known:
+            return [parameters]
+        return TransformChain.readWithInitialTransforms(initialFile, known) + [parameters]
+
+    def createTransform(self, parameters):
+        kind = parameters["Transform"][0]
+        if parameters.get("HowToCombineTransforms", ["Compose"])[0] != "Compose":
+            raise UnsupportedTransformError("Only composed transforms are supported")
+        if kind in self.TRANSFORMS:
+            return LinearTransform.fromParameters(parameters)
+        if kind in ("BSplineTransform", "RecursiveBSplineTransform"):
+            return BSplineTransform(parameters)
+        if kind == "DeformationFieldTransform":
+            return DeformationFieldTransform(parameters)
+        raise UnsupportedTransformError(f"{kind} is not supported, use the displacement field instead")
+
+    def pointsOf(self, voxelIndices):
+        # physical position of voxel indices (i,j,k)
+        return (voxelIndices * self.spacing) @ self.direction.T + self.origin
+
+    def transformPoints(self, points):
+        # physical points of the fixed image -> physical points of the moving image
+        for transform in self.transforms:
+            points, _ = transform.transform(points)
+        return points
+
+    def indicesOf(self, points):
+        # continuous voxel indices (i,j,k) of physical points on the fixed image grid
+        return ((points - self.origin) @ self.direction) / self.spacing
+
+    def jacobianDeterminant(self, voxelIndices):
+        # determinant of the jacobian of the composed transform at the given voxels
+        points = self.pointsOf(voxelIndices.astype(np.float64))
+        jacobian = np.broadcast_to(np.eye(3), (len(points), 3, 3))
+        for transform in self.transforms:
+            points, transformJacobian = transform.transform(points)
+            jacobian = transformJacobian @ jacobian
+        return determinantOf(jacobian)
+
+
+def determinantOf(jacobian):
+    # 3x3 determinants of (..., 3, 3), written out, np.linalg.det would copy to float64 batches
+    return (jacobian[..., 0, 0] * (jacobian[..., 1, 1] * jacobian[..., 2, 2] - jacobian[..., 1, 2] * jacobian[..., 2, 1])
+            - jacobian[..., 0, 1] * (jacobian[..., 1, 0] * jacobian[..., 2, 2] - jacobian[..., 1, 2] * jacobian[..., 2, 0])
+            + jacobian[..., 0, 2] * (jacobian[..., 1, 0] * jacobian[..., 2, 1] - jacobian[..., 1, 1] * jacobian[..., 2, 0]))
+
+
+#################################
+### STATISTICS ##################
+#################################
+
+class JacobianStatistics:
+    # running statistics of the determinants of one region, percentiles from a fixed histogram (bins of 0.001)
+    HISTOGRAM_RANGE = (-1.0, 4.0)
+    HISTOGRAM_BINS = 5000
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.totalSquared = 0.0
+        self.minimum = np.inf
+        self.maximum = -np.inf
+        self.folding = 0
+        self.histogram = np.zeros(self.HISTOGRAM_BINS + 2, dtype=np.int64)
+
+    def update(self, determinants):
+        if len(determinants) == 0:
+            return
+        determinants = determinants.astype(np.float64)
+        self.count += len(determinants)
+        self.total += determinants.sum()
+        self.totalSquared += np.square(determinants).sum()
+        self.minimum = min(self.minimum, determinants.min())
+        self.maximum = max(self.maximum, determinants.max())
+        self.folding += int(np.count_nonzero(determinants <= 0))
+        low, high = self.HISTOGRAM_RANGE
+        bins = np.clip(np.floor((determinants - low) / (high - low) * self.HISTOGRAM_BINS).astype(np.int64) + 1, 0, self.HISTOGRAM_BINS + 1)
+        self.histogram += np.bincount(bins, minlength=self.HISTOGRAM_BINS + 2)
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.totalSquared += other.totalSquared
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+        self.folding += other.folding
+        self.histogram += other.histogram
+
+    def percentile(self, q):
+        low, high = self.HISTOGRAM_RANGE
+        index = int(np.searchsorted(np.cumsum(self.histogram), q / 100 * self.count))
+        return low + (index - 0.5) * (high - low) / self.HISTOGRAM_BINS
+
+    def summary(self, voxelVolume):
+        # voxelVolume in mm^3, the volume change is in ml (fixed -> moving image)
+        if self.count == 0:
+            return {"voxels": 0}
+        mean = self.total / self.count
+        return {
+            "voxels": self.count,
+            "mean": mean,
+            "std": float(np.sqrt(max(self.totalSquared / self.count - mean**2, 0.0))),
+            "min": float(self.minimum),
+            "p5": self.percentile(5),
+            "median": self.percentile(50),
+            "p95": self.percentile(95),
+            "max": float(self.maximum),
+            "foldingVoxels": self.folding,
+            "foldingFraction": self.folding / self.count,
+            "volumeML": self.count * voxelVolume / 1000,
+            "volumeChangeML": (self.total - self.count) * voxelVolume / 1000,
+        }
+
+
+#################################
+### ANALYSIS ####################
+#################################
+
+class DeformationAnalysis:
+    # Jacobian determinant of a transform chain or of a displacement field, computed slab by slab (axial slices)
+    # inside the lung mask. Memory is bounded by slabSize, slabs are processed by numberOfWorkers threads.
+    # Regions: the whole lung and three thirds of the lung along the slice axis (third1 = lowest slice indices).
+    # The determinant is the local volume ratio moving/fixed: below 1 the lung is compressed in the moving
+    # image (exhale for the COPDgene registrations), non positive values are foldings.
+    REGIONS = ["lung", "third1", "third2", "third3"]
+    util = Utils()
+
+    def __init__(self, maskPath=None, slabSize=4, numberOfWorkers=None):
+        self.maskImage = nib.load(maskPath, mmap=True) if maskPath else None
+        self.slabSize = slabSize
+        self.numberOfWorkers = numberOfWorkers
+
+    @classmethod
+    def findParameterFiles(cls, transformParameterFolder):
+        # the maps stored by Registration in application order, the warm start files are followed automatically
+        parameterFiles = [path for path in cls.util.getAllFiles(transformParameterFolder)
+                          if path.endswith(".txt") and not path.endswith("_initialTransform.txt")]
+        return sorted(parameterFiles, key=cls.util.getRegistrationSortKey)
+
+    #################################
+    ### SLABS #######################
+    #################################
+
+    def getRegionBoundaries(self, nSlices):
+        # slice indices splitting the lung into thirds, the whole volume without mask
+        if self.maskImage is None:
+            first, last = 0, nSlices - 1
+        else:
+            slicesWithLung = [k for start in range(0, nSlices, self.slabSize)
+                              for k in start + np.flatnonzero(np.asarray(self.maskImage.dataobj[:, :, start:start + self.slabSize]).any(axis=(0, 1)))]
+            if not slicesWithLung:
+                raise ValueError("The lung mask is empty")
+            first, last = slicesWithLung[0], slicesWithLung[-1]
+        return np.linspace(first, last + 1, 4)
+
+    def readMaskSlab(self, start, stop, shape):
+        if self.maskImage is None:
+            return np.ones(shape + (stop - start,), dtype=bool)
+        return np.asarray(self.maskImage.dataobj[:, :, start:stop]) > 0
+
+    def runSlabs(self, nSlices, computeSlab, output=None):
+        # computeSlab(start, stop) -> (determinant slab (x,y,z) or None, mask slab); statistics merged per region
+        boundaries = self.getRegionBoundaries(nSlices)
+
+        def processSlab(start):
+            stop = min(start + self.slabSize, nSlices)
+            determinants, mask = computeSlab(start, stop)
+            statistics = {region: JacobianStatistics() for region in self.REGIONS}
+            statistics["lung"].update(determinants[mask])
+            sliceIndices = np.arange(start, stop)
+            for third in range(3):
+                inThird = (sliceIndices >= boundaries[third]) & (sliceIndices < boundaries[third + 1])
+                statistics[f"third{third+1}"].update(determinants[:, :, inThird][mask[:, :, inThird]])
+            if output is not None:
+                output[start:stop] = np.where(mask, determinants, 0).transpose(2, 1, 0)
+            return statistics
+
+        total = {region: JacobianStatistics() for region in self.REGIONS}
+        with ThreadPoolExecutor(max_workers=self.numberOfWorkers) as executor:
+            for statistics in executor.map(processSlab, range(0, nSlices, self.slabSize)):
+                for region in self.REGIONS:
+                    total[region].merge(statistics[region])
+        return total
+
+    #################################
+    ### TRANSFORMS ##################
+    #################################
+
+    def analyzeTransform(self, parameterFiles, outputPath=None):
+        # jacobian of the elastix transform chain on the fixed image grid, returns {region: statistics}
+        chain = TransformChain(parameterFiles)
+        sizeX, sizeY, nSlices = (int(s) for s in chain.size)
+        voxelVolume = float(np.prod(chain.spacing))
+
+        def computeSlab(start, stop):
+            mask = self.readMaskSlab(start, stop, (sizeX, sizeY))
+            determinants = np.zeros(mask.shape, dtype=np.float32)
+            # only voxels of the lung are evaluated
+            voxelIndices = np.argwhere(mask)
+            voxelIndices[:, 2] += start
+            determinants[mask] = chain.jacobianDeterminant(voxelIndices)
+            return determinants, mask
+
+        return self.summarize(self.runSlabs(nSlices, computeSlab, self.createOutput(outputPath, (nSlices, sizeY, sizeX))), voxelVolume, outputPath)
+
+    #################################
+    ### DISPLACEMENT FIELDS #########
+    #################################
+
+    def analyzeField(self, fieldPath, units="voxels", outputPath=None):
+        # jacobian of x -> x + u(x) for a stored (x,y,z,3) displacement field (e.g. voxelmorph/inference.py flows)
+        # with central differences. units: "voxels" of the field grid or "mm"
+        fieldImage = nib.load(fieldPath, mmap=True)
+        sizeX, sizeY, nSlices = fieldImage.shape[:3]
+        spacing = np.array(fieldImage.header.get_zooms()[:3], dtype=np.float64)
+        voxelVolume = float(np.prod(spacing))
+
+        def computeSlab(start, stop):
+            # one slice of halo on each side for the derivative along z
+            haloStart, haloStop = max(start - 1, 0), min(stop + 1, nSlices)
+            field = np.asarray(fieldImage.dataobj[:, :, haloStart:haloStop], dtype=np.float32).reshape(sizeX, sizeY, haloStop - haloStart, 3)
+            if units == "mm":
+                field = field / spacing.astype(np.float32)
+            jacobian = np.empty(field.shape[:3] + (3, 3), dtype=np.float32)
+            for component in range(3):
+                gradients = np.gradient(field[..., component], axis=(0, 1, 2))
+                for axis in range(3):
+                    jacobian[..., component, axis] = gradients[axis] + (component == axis)
+            determinants = determinantOf(jacobian[:, :, start - haloStart:start - haloStart + stop - start])
+            return determinants, self.readMaskSlab(start, stop, (sizeX, sizeY))
+
+        return self.summarize(self.runSlabs(nSlices, computeSlab, self.createOutput(outputPath, (nSlices, sizeY, sizeX))), voxelVolume, outputPath, fieldImage)
+
+    #################################
+    ### OUTPUT ######################
+    #################################
+
+    def createOutput(self, outputPath, shape):
+        # (z,y,x) float32 memmap next to the output, written slab by slab
+        if outputPath is None:
+            return None
+        return np.lib.format.open_memmap(outputPath + ".npy", mode="w+", dtype=np.float32, shape=shape)
+
+    def summarize(self, statistics, voxelVolume, outputPath=None, referenceImage=None):
+        summaries = {region: statistics[region].summary(voxelVolume) for region in self.REGIONS}
+        if outputPath is not None:
+            self.saveDeterminantMap(outputPath, referenceImage)
+        return summaries
+
+    def saveDeterminantMap(self, outputPath, referenceImage=None):
+        # geometry of the mask (or of the field), the (z,y,x) memmap is the (x,y,z) array of the NIfTI
+        referenceImage = self.maskImage if self.maskImage is not None else referenceImage
+        determinants = np.load(outputPath + ".npy", mmap_mode="r")
+        affine = referenceImage.affine if referenceImage is not None else np.eye(4)
+        image = nib.Nifti1Image(determinants.T, affine)
+        image.set_data_dtype(np.float32)
+        nib.save(image, outputPath)
+        del determinants
+        os.remove(outputPath + ".npy")
+
+    @staticmethod
+    def writeCsv(rows, filePath):
+        # rows: list of {"case": ..., "region": ..., statistics}
+        fieldNames = ["case", "region", "voxels", "mean", "std", "min", "p5", "median", "p95", "max", "foldingVoxels", "foldingFraction", "volumeML", "volumeChangeML"]
+        with open(filePath, mode='w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=fieldNames)
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Jacobian determinant statistics of a registration inside the lung mask.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--transforms", help="folder with the transform parameter maps (transformParameterMaps)")
+    source.add_argument("--field", help="displacement field (x,y,z,3), e.g. flow_copd1.nii.gz")
+    parser.add_argument("--field-units", choices=["voxels", "mm"], default="voxels")
+    parser.add_argument("--mask", default=None, help="lung mask of the fixed image")
+    parser.add_argument("--output", default=None, help="optional NIfTI of the determinants")
+    parser.add_argument("--slab-size", type=int, default=4)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    analysis = DeformationAnalysis(args.mask, slabSize=args.slab_size, numberOfWorkers=args.workers)
+    if args.transforms:
+        summaries = analysis.analyzeTransform(analysis.findParameterFiles(args.transforms), outputPath=args.output)
+    else:
+        summaries = analysis.analyzeField(args.field, units=args.field_units, outputPath=args.output)
+    for region, summary in summaries.items():
+        print(region, {key: round(value, 4) if isinstance(value, float) else value for key, value in summary.items()})
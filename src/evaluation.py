@@ -4,7 +4,6 @@
 # # Date Created: 12-12-2023
 # # -----------------------------------------------------------------------------
 
-import itk
 from utils import Utils
 import os
 import numpy as np
@@ -47,11 +46,15 @@ class Evaluation:
     @staticmethod
     def targetRegistrationError(pointSet1, pointSet2):
         # returns the average target registration error between pointSet1 and pointSet2 using the euclidean norm
-        treValues = []
-        for p1, p2 in zip(pointSet1, pointSet2):
-            tre = np.linalg.norm(np.array(p1) - np.array(p2))
-            treValues.append(tre)
-        return np.mean(treValues)
+        return np.mean(Evaluation.landmarkErrors(pointSet1, pointSet2))
+
+    @staticmethod
+    def landmarkErrors(pointSet1, pointSet2):
+        # returns the euclidean distance between each pair of corresponding points
+        nPoints = min(len(pointSet1), len(pointSet2))
+        pointArray1 = np.asarray(pointSet1[:nPoints], dtype=float)
+        pointArray2 = np.asarray(pointSet2[:nPoints], dtype=float)
+        return np.linalg.norm(pointArray1 - pointArray2, axis=1)
 
     
 
@@ -0,0 +1,242 @@
+# # -----------------------------------------------------------------------------
+# # Registration of all respiratory phases of the DIR-Lab 4DCT cases with phase-to-phase warm starts
+# # Date Created: 19-10-2026
+# # -----------------------------------------------------------------------------
+
+import argparse
+import csv
+import glob
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from utils import Utils
+from evaluation import Evaluation
+from resultStore import ResultStore
+from parameterMaps import ParameterMapBuilder, readParameterMap, writeParameterMap
+
+#################################
+### DATASET #####################
+#################################
+
+# size (x,y,z) and spacing (mm) of the raw int16 phases of each DIR-Lab 4DCT case
+CASES = {
+    1: {"size": [256, 256, 94], "spacing": ["0.97", "0.97", "2.5"]},
+    2: {"size": [256, 256, 112], "spacing": ["1.16", "1.16", "2.5"]},
+    3: {"size": [256, 256, 104], "spacing": ["1.15", "1.15", "2.5"]},
+    4: {"size": [256, 256, 99], "spacing": ["1.13", "1.13", "2.5"]},
+    5: {"size": [256, 256, 106], "spacing": ["1.10", "1.10", "2.5"]},
+    6: {"size": [512, 512, 128], "spacing": ["0.97", "0.97", "2.5"]},
+    7: {"size": [512, 512, 136], "spacing": ["0.97", "0.97", "2.5"]},
+    8: {"size": [512, 512, 128], "spacing": ["0.97", "0.97", "2.5"]},
+    9: {"size": [512, 512, 128], "spacing": ["0.97", "0.97", "2.5"]},
+    10: {"size": [512, 512, 120], "spacing": ["0.97", "0.97", "2.5"]},
+}
+PHASES = [0, 10, 20, 30, 40, 50, 60, 70, 80, 90]
+
+
+class FourDCT:
+    # The reference phase (fixed) is registered to every other phase (moving). The phases are visited along the
+    # breathing cycle in two chains starting at the reference (T00: T10 ... T50 and T90 ... T60); every phase
+    # starts from the transform of its neighbour in the chain and only solves the remaining deformation with the
+    # warm start schedule of Registration (finest resolutions, fewer iterations). The transform of a phase is
+    # stored as a chain of elastix files (phase/chain) that starts with the transforms of its neighbour, so the
+    # landmarks are warped exactly, without resampling a field. The two chains run concurrently.
+    # Afterwards the landmarks of the reference are warped to all phases and compared in one pass.
+    util = Utils()
+    evaluation = Evaluation()
+
+    def __init__(self, datasetDirectory, outputDirectory, parameterFolder="customParameters", preset=None, evalResultsDirectory="evaluation",
+                 referencePhase=0, warmStart=True, numberOfWorkers=2, storeImages=False, warmStartResolutions=2, warmStartIterationFactor=0.25):
+        self.datasetDirectory = datasetDirectory
+        self.outputDirectory = outputDirectory
+        self.parameterFolder = parameterFolder
+        self.preset = preset
+        self.parameterMaps = ParameterMapBuilder.resolve(preset or parameterFolder)
+        self.evalResultsDirectory = evalResultsDirectory
+        self.referencePhase = referencePhase
+        self.warmStart = warmStart
+        self.numberOfWorkers = numberOfWorkers
+        self.storeImages = storeImages
+        self.warmStartResolutions = warmStartResolutions
+        self.warmStartIterationFactor = warmStartIterationFactor
+        self.phaseRuntimes = {}
+        self.util.ensureFolderExists(self.evalResultsDirectory)
+
+    #################################
+    ### DATA ########################
+    #################################
+
+    def getCaseDirectory(self, caseNumber):
+        return os.path.join(self.datasetDirectory, f"case{caseNumber}")
+
+    def findFile(self, caseNumber, pattern):
+        # first file of the case folder (and its subfolders) matching pattern, None without match
+        paths = sorted(glob.glob(os.path.join(self.getCaseDirectory(caseNumber), "**", pattern), recursive=True))
+        return paths[0] if paths else None
+
+    def getPhasePath(self, caseNumber, phase):
+        return os.path.join(self.getCaseDirectory(caseNumber), f"case{caseNumber}_T{phase:02d}.nii")
+
+    def getLandmarkPath(self, caseNumber, phase, nLandmarks):
+        # 300 landmarks of the extreme phases (case1_300_T00_xyz.txt) or 75 of every phase (case1_4D-75_T00.txt)
+        pattern = f"*300*T{phase:02d}*.txt" if nLandmarks == 300 else f"*4D-75*T{phase:02d}*.txt"
+        return self.findFile(caseNumber, pattern)
+
+    def convertCase(self, caseNumber):
+        # raw phases (case1_T00_s.img, ...) -> case<N>_T<phase>.nii with the size and spacing of CASES
+        import openImages
+        import SimpleITK as sitk
+        for phase in PHASES:
+            rawPath = self.findFile(caseNumber, f"*T{phase:02d}*.img")
+            if rawPath is None or os.path.exists(self.getPhasePath(caseNumber, phase)):
+                continue
+            openImages.convertImage({"raw_file_name": rawPath, "out_file_name": self.getPhasePath(caseNumber, phase), "big_endian": False,
+                                     "sitk_pixel_type": sitk.sitkInt16, "sz": CASES[caseNumber]["size"], "spacing": CASES[caseNumber]["spacing"]})
+
+    def availablePhases(self, caseNumber):
+        return [phase for phase in PHASES if os.path.exists(self.getPhasePath(caseNumber, phase))]
+
+    #################################
+    ### REGISTRATION ################
+    #################################
+
+    def phaseChains(self, phases):
+        # the other phases in the order of the breathing cycle, forward and backward from the reference
+        index = phases.index(self.referencePhase)
+        ordered = phases[index + 1:] + phases[:index]
+        nForward = (len(ordered) + 1) // 2
+        return [chain for chain in [ordered[:nForward], ordered[nForward:][::-1]] if chain]
+
+    def registerCase(self, caseNumber):
+        # returns {phase: last file of its transform chain}. Without warm start every phase is an independent
+        # registration and all of them run concurrently
+        phases = self.availablePhases(caseNumber)
+        if self.referencePhase not in phases:
+            raise FileNotFoundError(f"Reference phase T{self.referencePhase:02d} of case {caseNumber} not found, run convertCase first")
+        chains = self.phaseChains(phases) if self.warmStart else [[phase] for phase in phases if phase != self.referencePhase]
+        chainFiles = {}
+        with ThreadPoolExecutor(max_workers=self.numberOfWorkers) as executor:
+            for result in executor.map(lambda chain: self.registerChain(caseNumber, chain), chains):
+                chainFiles.update(result)
+        return chainFiles
+
+    def registerChain(self, caseNumber, phases):
+        chainFiles, previous = {}, None
+        for phase in phases:
+            chainFiles[phase] = previous = self.registerPhase(caseNumber, phase, previous)
+        return chainFiles
+
+    def registerPhase(self, caseNumber, phase, initialTransform=None):
+        from registration import Registration
+        outputDirectory = os.path.join(self.outputDirectory, f"case{caseNumber}", f"T{phase:02d}")
+        registration = Registration(
+            self.parameterFolder,
+            outputDirectory=outputDirectory,
+            storeTransformParameterMaps=True,
+            storeImage=self.storeImages,
+            storePointFile=False,
+            warmStartResolutions=self.warmStartResolutions,
+            warmStartIterationFactor=self.warmStartIterationFactor,
+            parameterMaps=self.parameterMaps
+            )
+        movingImagePath = self.getPhasePath(caseNumber, phase)
+        startTime = time.perf_counter()
+        registration.register(self.getPhasePath(caseNumber, self.referencePhase), movingImagePath, initialTransform=initialTransform)
+        self.phaseRuntimes[(caseNumber, phase)] = time.perf_counter() - startTime
+        print(f"case{caseNumber} T{self.referencePhase:02d}->T{phase:02d}: {self.phaseRuntimes[(caseNumber, phase)]:.1f}s{' (warm start)' if initialTransform else ''}")
+        return self.writeTransformChain(registration.registrationTypeList, movingImagePath, outputDirectory, initialTransform)
+
+    def writeTransformChain(self, registrationTypeList, movingImagePath, outputDirectory, initialTransform=None):
+        # links the stored maps of a phase behind the chain of its neighbour, returns the last file
+        imageName, _ = self.util.splitNameFromExtension(movingImagePath)
+        chainDirectory = os.path.join(outputDirectory, "chain")
+        self.util.ensureFolderExists(chainDirectory)
+        previous = os.path.abspath(initialTransform) if initialTransform else "NoInitialTransform"
+        for index, registrationType in enumerate(registrationTypeList):
+            parameterMap = readParameterMap(os.path.join(outputDirectory, "transformParameterMaps", f"{imageName}_{registrationType}.txt"))
+            parameterMap["InitialTransformParametersFileName"] = [previous]
+            previous = os.path.abspath(os.path.join(chainDirectory, f"{index}_{registrationType}.txt"))
+            writeParameterMap(parameterMap, previous)
+        return previous
+
+    #################################
+    ### EVALUATION ##################
+    #################################
+
+    def landmarkPairs(self, caseNumber, phases):
+        # (phase, number of landmarks, reference landmarks, phase landmarks), the 300 landmarks where both phases have them
+        pairs = []
+        for phase in phases:
+            for nLandmarks in [300, 75]:
+                referencePath, phasePath = self.getLandmarkPath(caseNumber, self.referencePhase, nLandmarks), self.getLandmarkPath(caseNumber, phase, nLandmarks)
+                if referencePath and phasePath:
+                    pairs.append((phase, nLandmarks, referencePath, phasePath))
+                    break
+        return pairs
+
+    def evaluateCase(self, caseNumber, chainFiles):
+        # landmark errors (mm) of every phase pair with landmarks, the reference landmarks warped by the transform chains
+        from deformationAnalysis import TransformChain
+        rows = []
+        for phase, nLandmarks, referencePath, phasePath in self.landmarkPairs(caseNumber, sorted(chainFiles)):
+            chain = TransformChain([chainFiles[phase]])
+            referenceLandmarks = np.asarray(self.evaluation.readPointsFromFile(referencePath), dtype=np.float64)
+            phaseLandmarks = np.asarray(self.evaluation.readPointsFromFile(phasePath), dtype=np.float64)
+            predicted = chain.indicesOf(chain.transformPoints(chain.pointsOf(referenceLandmarks)))
+            rows.append({
+                "case": f"case{caseNumber}",
+                "pair": f"T{self.referencePhase:02d}-T{phase:02d}",
+                "landmarks": nLandmarks,
+                "initialErrors": np.linalg.norm((referenceLandmarks - phaseLandmarks) * chain.spacing, axis=1),
+                "landmarkErrors": np.linalg.norm((predicted - phaseLandmarks) * chain.spacing, axis=1),
+                "seconds": self.phaseRuntimes.get((caseNumber, phase)),
+                "landmarkPaths": [referencePath, phasePath],
+                })
+        return rows
+
+    def run(self, resultName, caseNumbers=(1,)):
+        # registers and evaluates all phases of the cases, one run of the result store with one entry per phase pair
+        rows = []
+        for caseNumber in caseNumbers:
+            self.convertCase(caseNumber)
+            rows += self.evaluateCase(caseNumber, self.registerCase(caseNumber))
+        return self.storeResults(resultName, rows)
+
+    def storeResults(self, resultName, rows):
+        resultStore = ResultStore(os.path.join(self.evalResultsDirectory, "results.sqlite"))
+        runId = resultStore.addRun(
+            resultName,
+            parameterHash=ParameterMapBuilder.hashOf(self.parameterMaps),
+            datasetVersion=resultStore.hashFiles([path for row in rows for path in row["landmarkPaths"]]),
+            parameterFolder=f"preset:{self.preset}" if self.preset else self.parameterFolder
+            )
+        with open(os.path.join(self.evalResultsDirectory, f"tre_4dct_{resultName}.csv"), mode='w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(["Case", "Pair", "Landmarks", "InitialTRE", "TRE", "seconds"])
+            for row in rows:
+                resultStore.addCase(runId, f"{row['case']}_{row['pair']}", row["landmarkErrors"], row["seconds"])
+                writer.writerow([row["case"], row["pair"], row["landmarks"], np.mean(row["initialErrors"]), np.mean(row["landmarkErrors"]), row["seconds"]])
+        print(resultStore.report([runId]))
+        print(f"registration time: {sum(seconds for seconds in self.phaseRuntimes.values()):.1f}s for {len(self.phaseRuntimes)} phases")
+        resultStore.close()
+        return runId
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Register the reference phase of DIR-Lab 4DCT cases to all other phases.")
+    parser.add_argument("--data", default="data/4DCT", help="folder with case<N> subfolders holding the raw phases and landmarks")
+    parser.add_argument("--output", default="results/4DCT")
+    parser.add_argument("--cases", type=int, nargs="+", default=[1])
+    parser.add_argument("--parameters", default="customParameters", help="elastix parameter folder")
+    parser.add_argument("--preset", default=None, choices=["fast", "balanced", "accurate"], help="parameter preset instead of the folder")
+    parser.add_argument("--reference", type=int, default=0, choices=PHASES, help="reference (fixed) phase")
+    parser.add_argument("--cold", action="store_true", help="register every phase independently, without warm starts")
+    parser.add_argument("--workers", type=int, default=2, help="registrations running at the same time")
+    parser.add_argument("--name", default="4DCT", help="name of the evaluation run")
+    args = parser.parse_args()
+
+    fourDCT = FourDCT(args.data, args.output, args.parameters, args.preset, referencePhase=args.reference, warmStart=not args.cold, numberOfWorkers=args.workers)
+    fourDCT.run(args.name, args.cases)
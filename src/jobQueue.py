@@ -0,0 +1,357 @@
+# # -----------------------------------------------------------------------------
+# # SQLite job queue on a shared filesystem for registration jobs on many nodes
+# # Date Created: 19-10-2026
+# # -----------------------------------------------------------------------------
+
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+
+from utils import Utils
+
+
+class JobQueue:
+    # Jobs are claimed inside an exclusive transaction, so two workers never get the same job. A running job
+    # whose worker stopped sending heartbeats for leaseSeconds (crash, killed node) goes back to pending until
+    # it used up maxAttempts. Every attempt writes into its own directory jobs/<jobId>/attempt<N> and only the attempt
+    # that still owns the job can complete it, so a worker that lost its lease never overwrites the result of the
+    # attempt that took over. The rollback journal is used instead of WAL, WAL does not work on network
+    # filesystems; the filesystem must support POSIX locks (e.g. NFSv4) and the node clocks must be synchronized.
+    util = Utils()
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            jobId INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            maxAttempts INTEGER NOT NULL,
+            worker TEXT,
+            heartbeat REAL,
+            created REAL NOT NULL,
+            finished REAL,
+            error TEXT
+        );
+        CREATE INDEX IF NOT EXISTS jobsByStatus ON jobs(status, jobId);
+    """
+
+    def __init__(self, queueDirectory, leaseSeconds=300):
+        self.queueDirectory = queueDirectory
+        self.leaseSeconds = leaseSeconds
+        self.databasePath = os.path.join(queueDirectory, "queue.sqlite")
+        self.util.ensureFolderExists(os.path.join(queueDirectory, "jobs"))
+        with self.connect() as connection:
+            connection.executescript(self.SCHEMA)
+
+    def connect(self):
+        # a short lived connection per operation: safe across threads and processes and it does not keep the
+        # database locked on the shared filesystem
+        connection = sqlite3.connect(self.databasePath, timeout=120, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA journal_mode = DELETE")
+        return ClosingConnection(connection)
+
+    def getJobDirectory(self, jobId, attempt):
+        return os.path.join(self.queueDirectory, "jobs", str(jobId), f"attempt{attempt}")
+
+    #################################
+    ### SUBMISSION ##################
+    #################################
+
+    def submit(self, kind, payload, maxAttempts=3):
+        # payload must be json serializable, returns the job id
+        with self.connect() as connection:
+            cursor = connection.execute(
+                "INSERT INTO jobs (kind, payload, maxAttempts, created) VALUES (?, ?, ?, ?)",
+                (kind, json.dumps(payload, sort_keys=True), maxAttempts, time.time()))
+        return cursor.lastrowid
+
+    def retryFailed(self):
+        # failed jobs get a new set of attempts
+        with self.connect() as connection:
+            return connection.execute("UPDATE jobs SET status = 'pending', attempts = 0, error = NULL WHERE status = 'failed'").rowcount
+
+    #################################
+    ### WORKER SIDE #################
+    #################################
+
+    def claim(self, workerName):
+        # returns the oldest pending job (as a dict) now owned by workerName, None if there is nothing to do
+        with self.connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.releaseExpired(connection)
+                row = connection.execute("SELECT * FROM jobs WHERE status = 'pending' ORDER BY jobId LIMIT 1").fetchone()
+                if row is None:
+                    connection.execute("COMMIT")
+                    return None
+                connection.execute(
+                    "UPDATE jobs SET status = 'running', attempts = attempts + 1, worker = ?, heartbeat = ? WHERE jobId = ?",
+                    (workerName, time.time(), row["jobId"]))
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+        job = dict(row)
+        job["payload"] = json.loads(job["payload"])
+        job["attempts"] += 1
+        job["jobDirectory"] = self.getJobDirectory(job["jobId"], job["attempts"])
+        self.util.ensureFolderExists(job["jobDirectory"])
+        return job
+
+    def releaseExpired(self, connection):
+        # running jobs without heartbeat for leaseSeconds: retried, or failed after maxAttempts
+        expired = time.time() - self.leaseSeconds
+        connection.execute(
+            "UPDATE jobs SET status = 'failed', finished = ?, error = 'lease expired' "
+            "WHERE status = 'running' AND heartbeat < ? AND attempts >= maxAttempts", (time.time(), expired))
+        connection.execute("UPDATE jobs SET status = 'pending', worker = NULL WHERE status = 'running' AND heartbeat < ?", (expired,))
+
+    def heartbeat(self, jobId, workerName, attempt):
+        # returns False when the attempt does not own the job anymore (its lease expired and it was reclaimed)
+        with self.connect() as connection:
+            cursor = connection.execute(
+                "UPDATE jobs SET heartbeat = ? WHERE jobId = ? AND worker = ? AND attempts = ? AND status = 'running'",
+                (time.time(), jobId, workerName, attempt))
+        return cursor.rowcount == 1
+
+    def complete(self, jobId, workerName, attempt, result):
+        # marks the job done and stores the result as result.json in the attempt directory. Returns False (and writes
+        # nothing) when the attempt does not own the job anymore. The file is moved in place inside the transaction,
+        # readers never see a done job without its result
+        resultPath = os.path.join(self.getJobDirectory(jobId, attempt), "result.json")
+        with self.connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                cursor = connection.execute(
+                    "UPDATE jobs SET status = 'done', finished = ?, error = NULL "
+                    "WHERE jobId = ? AND worker = ? AND attempts = ? AND status = 'running'",
+                    (time.time(), jobId, workerName, attempt))
+                if cursor.rowcount != 1:
+                    connection.execute("ROLLBACK")
+                    return False
+                with open(resultPath + ".tmp", 'w') as file:
+                    json.dump(result, file)
+                os.replace(resultPath + ".tmp", resultPath)
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+        return True
+
+    def fail(self, jobId, workerName, attempt, error):
+        # back to pending while attempts remain, returns False when the attempt does not own the job anymore
+        with self.connect() as connection:
+            cursor = connection.execute(
+                "UPDATE jobs SET status = CASE WHEN attempts >= maxAttempts THEN 'failed' ELSE 'pending' END, "
+                "worker = NULL, finished = ?, error = ? WHERE jobId = ? AND worker = ? AND attempts = ? AND status = 'running'",
+                (time.time(), error, jobId, workerName, attempt))
+        return cursor.rowcount == 1
+
+    #################################
+    ### QUERIES #####################
+    #################################
+
+    def jobs(self, status=None, kind=None):
+        query = "SELECT * FROM jobs WHERE (? IS NULL OR status = ?) AND (? IS NULL OR kind = ?) ORDER BY jobId"
+        with self.connect() as connection:
+            rows = connection.execute(query, (status, status, kind, kind)).fetchall()
+        jobs = []
+        for row in rows:
+            job = dict(row)
+            job["payload"] = json.loads(job["payload"])
+            # directory of the last attempt, the one that completed a done job
+            job["jobDirectory"] = self.getJobDirectory(job["jobId"], job["attempts"])
+            jobs.append(job)
+        return jobs
+
+    def counts(self):
+        with self.connect() as connection:
+            rows = connection.execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status").fetchall()
+        return {row["status"]: row["n"] for row in rows}
+
+    def loadResult(self, job):
+        with open(os.path.join(job["jobDirectory"], "result.json"), 'r') as file:
+            return json.load(file)
+
+
+class ClosingConnection:
+    # sqlite3 connections do not close when used as context manager
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self.connection
+
+    def __exit__(self, *exc):
+        self.connection.close()
+
+
+class Worker:
+    # claims jobs until the queue is empty (or forever), runs handlers[kind](payload, jobDirectory) and sends
+    # heartbeats from a background thread meanwhile. The handler cannot be interrupted, when the lease is lost
+    # its outcome is discarded: another attempt owns the job and the queue rejects the result anyway
+    def __init__(self, jobQueue, handlers, workerName=None, heartbeatInterval=30, pollInterval=10):
+        self.jobQueue = jobQueue
+        self.handlers = handlers
+        self.workerName = workerName or f"{socket.gethostname()}:{os.getpid()}"
+        self.heartbeatInterval = heartbeatInterval
+        self.pollInterval = pollInterval
+
+    def run(self, exitWhenEmpty=True):
+        # returns the number of jobs processed by this worker
+        processed = 0
+        while True:
+            job = self.jobQueue.claim(self.workerName)
+            if job is None:
+                if exitWhenEmpty and not self.jobQueue.counts().get("running"):
+                    return processed
+                time.sleep(self.pollInterval)
+                continue
+            self.runJob(job)
+            processed += 1
+
+    def runJob(self, job):
+        print(f"[{self.workerName}] job {job['jobId']} ({job['kind']}, attempt {job['attempts']})")
+        stopHeartbeat, leaseLost = threading.Event(), threading.Event()
+        heartbeatThread = threading.Thread(target=self.sendHeartbeats, args=(job["jobId"], job["attempts"], stopHeartbeat, leaseLost), daemon=True)
+        heartbeatThread.start()
+        try:
+            handler = self.handlers[job["kind"]]
+            result = handler(job["payload"], job["jobDirectory"])
+        except Exception:
+            error = traceback.format_exc()
+            print(f"[{self.workerName}] job {job['jobId']} failed:\n{error}")
+            if not leaseLost.is_set() and not self.jobQueue.fail(job["jobId"], self.workerName, job["attempts"], error):
+                print(f"[{self.workerName}] job {job['jobId']} is owned by another attempt, failure discarded")
+            return False
+        finally:
+            stopHeartbeat.set()
+            heartbeatThread.join()
+        if leaseLost.is_set() or not self.jobQueue.complete(job["jobId"], self.workerName, job["attempts"], result):
+            print(f"[{self.workerName}] job {job['jobId']} is owned by another attempt, result discarded")
+            return False
+        return True
+
+    def sendHeartbeats(self, jobId, attempt, stopHeartbeat, leaseLost):
+        while not stopHeartbeat.wait(self.heartbeatInterval):
+            if not self.jobQueue.heartbeat(jobId, self.workerName, attempt):
+                print(f"[{self.workerName}] lost the lease of job {jobId}")
+                leaseLost.set()
+                return
+
+
+#################################
+### COPDGENE JOBS ###############
+#################################
+
+def runRegistrationJob(payload, jobDirectory, volumeCache=None):
+    # registers, predicts and evaluates one case with one parameter folder, all outputs in the job directory.
+    # With a volumeCache the workers of a node decode each scan only once. The retention policy of the payload
+    # decides which outputs are written (outputWriter.py), sweep trials keep only transforms and points
+    from main import COPDgene
+    from outputWriter import OutputWriter
+    outputWriter = OutputWriter(retention=payload.get("retention", "all"))
+    copdgene = COPDgene(payload["datasetDirectory"], jobDirectory, payload["parameterFolder"], evalResultsDirectory=jobDirectory, volumeCache=volumeCache, outputWriter=outputWriter)
+    imageNumber = payload["imageNumber"]
+    try:
+        copdgene.registerCase(imageNumber, payload.get("segmentation", True), payload.get("warmStartDirectory"))
+        landmarkErrors = copdgene.evaluateCase(imageNumber)
+    finally:
+        outputWriter.close()
+        copdgene.resultStore.close()
+    runtime, peakMemory = copdgene.caseRuntimes[f"copd{imageNumber}"]
+    return {"caseName": f"copd{imageNumber}", "landmarkErrors": [float(e) for e in landmarkErrors], "runtimeSeconds": runtime, "peakMemoryMB": peakMemory}
+
+HANDLERS = {"register": runRegistrationJob}
+
+def submitStudy(jobQueue, datasetDirectory, parameterFolders, imageNumbers=(1, 2, 3, 4), segmentation=True, warmStartDirectory=None, maxAttempts=3, retention="transformsAndPoints"):
+    # one job per case and parameter folder, returns the job ids
+    jobIds = []
+    for parameterFolder in parameterFolders:
+        for imageNumber in imageNumbers:
+            payload = {
+                "datasetDirectory": os.path.abspath(datasetDirectory),
+                "parameterFolder": os.path.abspath(parameterFolder),
+                "imageNumber": imageNumber,
+                "segmentation": segmentation,
+                "warmStartDirectory": os.path.abspath(warmStartDirectory) if warmStartDirectory else None,
+                "retention": retention,
+            }
+            jobIds.append(jobQueue.submit("register", payload, maxAttempts=maxAttempts))
+    return jobIds
+
+def collectStudy(jobQueue, resultStore, name):
+    # adds one run per parameter folder with the finished cases to the result store, returns the run ids
+    jobsPerFolder = {}
+    for job in jobQueue.jobs(status="done", kind="register"):
+        jobsPerFolder.setdefault(job["payload"]["parameterFolder"], []).append(job)
+
+    runIds = []
+    for parameterFolder, jobs in sorted(jobsPerFolder.items()):
+        runName = f"{name}_{os.path.basename(os.path.normpath(parameterFolder))}"
+        runId = resultStore.addRun(runName, parameterHash=resultStore.hashParameterFolder(parameterFolder), parameterFolder=parameterFolder)
+        for job in sorted(jobs, key=lambda job: job["payload"]["imageNumber"]):
+            result = jobQueue.loadResult(job)
+            resultStore.addCase(runId, result["caseName"], result["landmarkErrors"], result["runtimeSeconds"], result["peakMemoryMB"])
+        runIds.append(runId)
+    return runIds
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Registration job queue on a shared filesystem.")
+    parser.add_argument("queue", help="queue directory, shared by all nodes")
+    parser.add_argument("--lease", type=float, default=300, help="seconds without heartbeat before a job is retried")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    submitParser = subparsers.add_parser("submit", help="one job per case and parameter folder")
+    submitParser.add_argument("--data", default="data")
+    submitParser.add_argument("--parameters", nargs="+", default=["customParameters"], help="parameter folders")
+    submitParser.add_argument("--cases", type=int, nargs="+", default=[1, 2, 3, 4])
+    submitParser.add_argument("--no-segmentation", action="store_true")
+    submitParser.add_argument("--warm-start", default=None)
+    submitParser.add_argument("--max-attempts", type=int, default=3)
+    submitParser.add_argument("--retention", default="transformsAndPoints", choices=["all", "transformsAndPoints"], help="outputs kept per trial (outputWriter.py)")
+
+    workerParser = subparsers.add_parser("worker", help="process jobs")
+    workerParser.add_argument("--forever", action="store_true", help="keep polling when the queue is empty")
+    workerParser.add_argument("--heartbeat", type=float, default=30)
+    workerParser.add_argument("--volume-cache-mb", type=float, default=0, help="shared-memory volume cache of the node, 0 disables it")
+
+    subparsers.add_parser("status")
+    subparsers.add_parser("retry", help="retry the failed jobs")
+
+    collectParser = subparsers.add_parser("collect", help="store the finished jobs in the result store")
+    collectParser.add_argument("--name", required=True)
+    collectParser.add_argument("--database", default="evaluation/results.sqlite")
+    args = parser.parse_args()
+
+    jobQueue = JobQueue(args.queue, leaseSeconds=args.lease)
+    if args.command == "submit":
+        jobIds = submitStudy(jobQueue, args.data, args.parameters, args.cases, not args.no_segmentation, args.warm_start, args.max_attempts, args.retention)
+        print(f"Submitted {len(jobIds)} jobs")
+    elif args.command == "worker":
+        handlers = HANDLERS
+        if args.volume_cache_mb > 0:
+            from functools import partial
+            from volumeCache import SharedVolumeCache
+            handlers = {"register": partial(runRegistrationJob, volumeCache=SharedVolumeCache(capacityMB=args.volume_cache_mb))}
+        processed = Worker(jobQueue, handlers, heartbeatInterval=args.heartbeat).run(exitWhenEmpty=not args.forever)
+        print(f"Processed {processed} jobs")
+    elif args.command == "status":
+        print(jobQueue.counts())
+        for job in jobQueue.jobs(status="failed"):
+            lastLine = (job["error"] or "").strip().splitlines()[-1:]
+            print(f"job {job['jobId']} failed after {job['attempts']} attempts: {' '.join(lastLine)}")
+    elif args.command == "retry":
+        print(f"Retrying {jobQueue.retryFailed()} jobs")
+    elif args.command == "collect":
+        from resultStore import ResultStore
+        resultStore = ResultStore(args.database)
+        print(resultStore.report(collectStudy(jobQueue, resultStore, args.name)))
@@ -0,0 +1,203 @@
+# # -----------------------------------------------------------------------------
+# # Keypoint correspondences between the phases (Förstner keypoints, patch descriptors)
+# # Date Created: 19-10-2026
+# # -----------------------------------------------------------------------------
+
+import argparse
+import os
+import time
+
+import numpy as np
+import nibabel as nib
+from scipy import ndimage
+from scipy.spatial import cKDTree
+
+from utils import Utils
+
+
+class KeypointMatcher:
+    # Finds corresponding points of the fixed and moving image for elastix's CorrespondingPointsEuclideanDistanceMetric:
+    #   - detection: Förstner operator (det/trace of the structure tensor) on the lung, downsampled in-plane by
+    #     inPlaneFactor so the voxels are nearly isotropic. Local maxima at least minimumDistanceMM apart inside the
+    #     eroded lung mask are kept, the strongest maxKeypoints of them (mostly vessel bifurcations and crossings).
+    #   - descriptors: patchSize^3 intensities around each keypoint sampled every patchStepMM, zero mean and unit norm.
+    #   - matching: normalized correlation of all fixed against all moving descriptors in one matrix product, limited
+    #     to moving keypoints within searchRadiusMM of the fixed one shifted by the lung centroid motion. Matches must
+    #     be mutual best, score at least minimumScore and agree with the median displacement of their neighbours.
+    # Points are voxel indices (x,y,z) of the full-resolution images, the format of the landmark files.
+    util = Utils()
+
+    def __init__(self, maxKeypoints=3000, minimumDistanceMM=6.0, sigmaMM=1.5, inPlaneFactor=2, patchSize=7, patchStepMM=1.5,
+                 searchRadiusMM=30.0, minimumScore=0.7, consistencyMM=5.0, neighbours=8):
+        self.maxKeypoints = maxKeypoints
+        self.minimumDistanceMM = minimumDistanceMM
+        self.sigmaMM = sigmaMM
+        self.inPlaneFactor = inPlaneFactor
+        self.patchSize = patchSize
+        self.patchStepMM = patchStepMM
+        self.searchRadiusMM = searchRadiusMM
+        self.minimumScore = minimumScore
+        self.consistencyMM = consistencyMM
+        self.neighbours = neighbours
+
+    def match(self, fixedImagePath, movingImagePath, fixedMaskPath=None, movingMaskPath=None):
+        # returns fixed and moving points (n,3 voxel indices) of the accepted matches and their scores
+        fixed = self.prepare(fixedImagePath, fixedMaskPath)
+        moving = self.prepare(movingImagePath, movingMaskPath)
+        fixedGrid, movingGrid = self.detect(fixed), self.detect(moving)
+        fixedDescriptors, movingDescriptors = self.describe(fixed, fixedGrid), self.describe(moving, movingGrid)
+        fixedPoints, movingPoints = self.fullResolutionIndices(fixed, fixedGrid), self.fullResolutionIndices(moving, movingGrid)
+
+        # candidates: moving keypoints near the fixed keypoint shifted by the motion of the lung centroid
+        fixedMM, movingMM = fixedPoints * fixed["imageSpacing"], movingPoints * moving["imageSpacing"]
+        predictedMM = fixedMM + moving["centroidMM"] - fixed["centroidMM"]
+        squaredDistances = (predictedMM ** 2).sum(axis=1)[:, None] + (movingMM ** 2).sum(axis=1)[None, :] - 2 * predictedMM @ movingMM.T
+        scores = fixedDescriptors @ movingDescriptors.T
+        scores[squaredDistances > self.searchRadiusMM ** 2] = -np.inf
+
+        best = np.argmax(scores, axis=1)
+        bestScores = scores[np.arange(len(best)), best]
+        mutual = np.argmax(scores, axis=0)[best] == np.arange(len(best))
+        accepted = mutual & (bestScores >= self.minimumScore)
+        fixedPoints, movingPoints, bestScores = fixedPoints[accepted], movingPoints[best[accepted]], bestScores[accepted]
+
+        consistent = self.consistentMatches(fixedMM[accepted], movingMM[best[accepted]] - fixedMM[accepted])
+        return fixedPoints[consistent], movingPoints[consistent], bestScores[consistent]
+
+    #################################
+    ### DETECTION ###################
+    #################################
+
+    def prepare(self, imagePath, maskPath=None):
+        # image and mask cropped to the lung and block averaged in-plane, smoothed with sigmaMM
+        image = nib.load(imagePath)
+        data = np.asarray(image.dataobj, dtype=np.float32)
+        spacing = np.array(image.header.get_zooms()[:3], dtype=np.float64)
+        mask = np.asarray(nib.load(maskPath).dataobj) > 0 if maskPath is not None else np.ones(data.shape, dtype=bool)
+        if not mask.any():
+            raise ValueError(f"The lung mask {maskPath} is empty")
+        lower = np.array([np.flatnonzero(mask.any(axis=other)).min() for other in [(1, 2), (0, 2), (0, 1)]])
+        upper = np.array([np.flatnonzero(mask.any(axis=other)).max() + 1 for other in [(1, 2), (0, 2), (0, 1)]])
+        crop = tuple(slice(low, high) for low, high in zip(lower, upper))
+        factors = np.array([self.inPlaneFactor, self.inPlaneFactor, 1])
+        data = self.blockAverage(data[crop], factors)
+        mask = self.blockAverage(mask[crop].astype(np.float32), factors) > 0.5
+        imageSpacing, spacing = spacing, spacing * factors
+        data = ndimage.gaussian_filter(data, self.sigmaMM / spacing)
+        # keypoints and patches away from the lung boundary, where segmented images have their strongest edges
+        erosion = max(1, int(np.ceil(self.patchSize * self.patchStepMM / 2 / spacing.min())))
+        innerMask = ndimage.binary_erosion(mask, iterations=erosion)
+        prepared = {"data": data, "mask": innerMask if innerMask.any() else mask, "spacing": spacing, "imageSpacing": imageSpacing, "offset": lower, "factors": factors}
+        prepared["centroidMM"] = self.fullResolutionIndices(prepared, np.argwhere(mask).mean(axis=0)) * imageSpacing
+        return prepared
+
+    @staticmethod
+    def blockAverage(data, factors):
+        shape = (np.array(data.shape) // factors) * factors
+        data = data[:shape[0], :shape[1], :shape[2]]
+        return data.reshape(shape[0] // factors[0], factors[0], shape[1] // factors[1], factors[1], shape[2] // factors[2], factors[2]).mean(axis=(1, 3, 5))
+
+    def detect(self, prepared):
+        # Förstner interest det(T)/trace(T) of the structure tensor T, maxima inside the mask (voxel indices of the prepared grid)
+        data, spacing = prepared["data"], prepared["spacing"]
+        gradients = np.gradient(data, *spacing)
+        sigma = self.sigmaMM / spacing
+        tensor = {}
+        for i in range(3):
+            for j in range(i, 3):
+                tensor[i, j] = ndimage.gaussian_filter(gradients[i] * gradients[j], sigma)
+        del gradients
+        determinant = (tensor[0, 0] * (tensor[1, 1] * tensor[2, 2] - tensor[1, 2] ** 2)
+                       - tensor[0, 1] * (tensor[0, 1] * tensor[2, 2] - tensor[1, 2] * tensor[0, 2])
+                       + tensor[0, 2] * (tensor[0, 1] * tensor[1, 2] - tensor[1, 1] * tensor[0, 2]))
+        interest = determinant / (tensor[0, 0] + tensor[1, 1] + tensor[2, 2] + 1e-6)
+        del tensor, determinant
+
+        window = np.maximum(1, np.round(self.minimumDistanceMM / spacing)).astype(int) | 1
+        maxima = (interest == ndimage.maximum_filter(interest, size=window)) & prepared["mask"] & (interest > 0)
+        points = np.argwhere(maxima)
+        strengths = interest[maxima]
+        return points[np.argsort(strengths)[::-1][:self.maxKeypoints]].astype(np.float64)
+
+    #################################
+    ### DESCRIPTORS #################
+    #################################
+
+    def describe(self, prepared, points):
+        # patches on a physical grid (same in both phases whatever the spacing), zero mean and unit norm per patch
+        radius = (self.patchSize - 1) / 2
+        offsetsMM = (np.arange(self.patchSize) - radius) * self.patchStepMM
+        grid = np.stack(np.meshgrid(offsetsMM, offsetsMM, offsetsMM, indexing="ij"), axis=-1).reshape(-1, 3)
+        coordinates = points[:, None, :] + grid[None, :, :] / prepared["spacing"]
+        patches = ndimage.map_coordinates(prepared["data"], coordinates.reshape(-1, 3).T, order=1, mode="nearest").reshape(len(points), -1)
+        patches -= patches.mean(axis=1, keepdims=True)
+        return patches / (np.linalg.norm(patches, axis=1, keepdims=True) + 1e-6)
+
+    #################################
+    ### MATCHES #####################
+    #################################
+
+    def consistentMatches(self, pointsMM, displacementsMM):
+        # a match is kept when its displacement is within consistencyMM of the median of its neighbouring matches
+        if len(pointsMM) <= self.neighbours:
+            return np.ones(len(pointsMM), dtype=bool)
+        _, neighbours = cKDTree(pointsMM).query(pointsMM, k=self.neighbours + 1)
+        medians = np.median(displacementsMM[neighbours[:, 1:]], axis=1)
+        return np.linalg.norm(displacementsMM - medians, axis=1) <= self.consistencyMM
+
+    @staticmethod
+    def fullResolutionIndices(prepared, points):
+        # prepared grid -> voxel indices of the original image (block centres)
+        return (points + 0.5) * prepared["factors"] - 0.5 + prepared["offset"]
+
+    @staticmethod
+    def writePointFile(points, filePath):
+        # elastix point file with voxel indices
+        with open(filePath, 'w') as file:
+            file.write(f"index\n{len(points)}\n")
+            for point in points:
+                file.write(" ".join(f"{value:.2f}" for value in point) + "\n")
+        return filePath
+
+    def writeCorrespondences(self, fixedPoints, movingPoints, outputDirectory):
+        # fixed and moving point files for Registration.register(..., correspondences=...)
+        self.util.ensureFolderExists(outputDirectory)
+        return (self.writePointFile(fixedPoints, os.path.join(outputDirectory, "fixedKeypoints.txt")),
+                self.writePointFile(movingPoints, os.path.join(outputDirectory, "movingKeypoints.txt")))
+
+
+def withCorrespondingPoints(parameterMaps, weight=0.1, registrationTypes=("affine", "bspline"), droppedResolutions=0):
+    # adds CorrespondingPointsEuclideanDistanceMetric with the given weight to the maps of registrationTypes
+    # (the image metric keeps weight 1). droppedResolutions removes the coarsest levels of these maps, the
+    # correspondences bring the large motion the coarse levels were needed for
+    from registration import Registration
+    adapted = []
+    for registrationType, parameterMap in parameterMaps:
+        parameterMap = {key: list(values) for key, values in parameterMap.items()}
+        if registrationType in registrationTypes:
+            imageMetric = parameterMap["Metric"][0]
+            parameterMap["Registration"] = ["MultiMetricMultiResolutionRegistration"]
+            parameterMap["Metric"] = [imageMetric, "CorrespondingPointsEuclideanDistanceMetric"]
+            parameterMap["Metric0Weight"] = ["1.0"]
+            parameterMap["Metric1Weight"] = [str(weight)]
+            if droppedResolutions:
+                nResolutions = int(parameterMap["NumberOfResolutions"][0])
+                parameterMap = Registration.keepFinestResolutions(parameterMap, max(1, nResolutions - droppedResolutions))
+        adapted.append((registrationType, parameterMap))
+    return adapted
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Match keypoints between the inhale and exhale scan of a case and write the elastix point files.")
+    parser.add_argument("--fixed", required=True, help="fixed image, e.g. data/copd1/copd1_iBHCT.nii")
+    parser.add_argument("--moving", required=True, help="moving image, e.g. data/copd1/copd1_eBHCT.nii")
+    parser.add_argument("--fixed-mask", default=None)
+    parser.add_argument("--moving-mask", default=None)
+    parser.add_argument("--output", default="keypoints", help="folder for fixedKeypoints.txt and movingKeypoints.txt")
+    args = parser.parse_args()
+
+    matcher = KeypointMatcher()
+    startTime = time.perf_counter()
+    fixedPoints, movingPoints, scores = matcher.match(args.fixed, args.moving, args.fixed_mask, args.moving_mask)
+    print(f"{len(fixedPoints)} correspondences in {time.perf_counter() - startTime:.1f}s, mean score {scores.mean():.2f}")
+    print("written", *matcher.writeCorrespondences(fixedPoints, movingPoints, args.output))
@@ -4,23 +4,57 @@
 # # Date Created: 12-12-2023
 # # -----------------------------------------------------------------------------
 
-from utils import Utils
-from registration import Registration
+from utils import Utils, MemorySampler
 from evaluation import Evaluation
+from resultStore import ResultStore
+from stages import OverlappedStages
+from parameterMaps import ParameterMapBuilder
 import os
+import sys
 import csv
+import subprocess
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 
 class COPDgene:
     evaluation = Evaluation()
     utils = Utils()
 
-    def __init__(self, datasetDirectory, outputDirectory, parameterFolder):
+    def __init__(self, datasetDirectory, outputDirectory, parameterFolder, evalResultsDirectory="evaluation", volumeCache=None, adaptiveParameters=False, preset=None, outputWriter=None, keypoints=False, keypointWeight=0.1, keypointDroppedResolutions=0):
         self.datasetDirectory = datasetDirectory
+        self.volumeCache = volumeCache
+        # the parameter maps are read once, from the preset (parameterMaps.py: fast, balanced, accurate) or the parameter folder
+        self.preset = preset
+        self.parameterMaps = ParameterMapBuilder.resolve(preset or parameterFolder)
+        # parameter maps adapted to the geometry and lung volume of each case (parameterGenerator.py)
+        # (registration, itk, scipy and the other heavy modules are imported when a step needs them, so evaluating
+        # a result starts quickly)
+        self.parameterGenerator = None
+        if adaptiveParameters:
+            from parameterGenerator import ParameterGenerator
+            self.parameterGenerator = ParameterGenerator(self.parameterMaps)
+        # keypoint correspondences added to the image metric (keypoints.py), the coarsest keypointDroppedResolutions levels are skipped
+        self.keypointMatcher = None
+        if keypoints:
+            from keypoints import KeypointMatcher
+            self.keypointMatcher = KeypointMatcher()
+        self.keypointWeight = keypointWeight
+        self.keypointDroppedResolutions = keypointDroppedResolutions
+        # optional OutputWriter (outputWriter.py) shared by the registrations of all cases
+        self.outputWriter = outputWriter
         self.outputDirectory = outputDirectory
         self.parameterFolder = parameterFolder
-        self.evalResultsDirectory = "evaluation"
+        self.evalResultsDirectory = evalResultsDirectory
         self.utils.ensureFolderExists(self.evalResultsDirectory)
+        self.resultStore = ResultStore(os.path.join(self.evalResultsDirectory, "results.sqlite"))
+        # (runtime seconds, peak memory MB) per case. The memory is sampled in this process, it is None for cases
+        # that overlapped with another case because their memory cannot be told apart
+        self.caseRuntimes = {}
+        # registering cases -> whether another case ran at the same time
+        self.activeCases = {}
+        self.activeCasesLock = threading.Lock()
 
         # SPACINGS
         self.spacings = {
@@ -37,28 +71,151 @@ class COPDgene:
         }
 
 
-        # initialize registration
-        self.registration = Registration(
+        self.utils.ensureFolderExists(self.outputDirectory)
+        self._registration = None
+
+    @property
+    def registration(self):
+        # registration into outputDirectory, created on first use
+        if self._registration is None:
+            self._registration = self.createRegistration(self.outputDirectory)
+        return self._registration
+
+    def createRegistration(self, outputDirectory):
+        from registration import Registration
+        return Registration(
             self.parameterFolder, 
-            outputDirectory = self.outputDirectory,
+            outputDirectory = outputDirectory,
             usePreprocessing=False,
             storeTransformParameterMaps = True,
             storeImage = True,
             storePointFile = True,
-            logToConsole=True
+            logToConsole=True,
+            volumeCache=self.volumeCache,
+            parameterMaps=self.parameterMaps,
+            outputWriter=self.outputWriter
             )
 
+    #################################
+    ### SEGMENTATION FUNCTIONS ######
+    #################################
+
+    def segmentCase(self, imageNumber, streaming=False):
+        # segments the inhale and exhale scans of a case
+        for status in ["i", "e"]:
+            subprocess.run(self.getSegmentationCommand(imageNumber, status, streaming), check=True)
+
+    def getSegmentationCommand(self, imageNumber, status, streaming=False):
+        # segmentation/main.py runs in its own process: it is CPU-bound python and its modules shadow preprocessing.py
+        caseDirectory = os.path.join(self.datasetDirectory, f"copd{imageNumber}")
+        command = [
+            sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "segmentation", "main.py"),
+            "--input", os.path.join(caseDirectory, f"copd{imageNumber}_{status}BHCT.nii"),
+            "--segmented", os.path.join(caseDirectory, f"segmentations/copd{imageNumber}_{status}BHCT_segmented.nii"),
+            "--mask", os.path.join(caseDirectory, f"segmentations/copd{imageNumber}_{status}BHCT_mask.nii"),
+            ]
+        if streaming:
+            command.append("--streaming")
+        return command
+
     #################################
     ### REGISTRATION FUNCTIONS ######
     #################################
 
-    def registerTrain(self, segmentation=False):
-        imageNumbers =[1,2,3,4]
+    def registerTrain(self, segmentation=False, warmStartDirectory=None):
+        # warmStartDirectory: folder with the flow_copd<N>.nii.gz fields of voxelmorph/inference.py used as initial transforms
+        self.registerCases([1, 2, 3, 4], segmentation, warmStartDirectory)
+
+    def registerCases(self, imageNumbers, segmentation=False, warmStartDirectory=None, numberOfWorkers=1):
+        # registers the cases, numberOfWorkers at a time (each case has its own Registration). With an output
+        # writer the next case registers while the outputs of the previous one are written
+        with ThreadPoolExecutor(max_workers=numberOfWorkers) as executor:
+            futures = [executor.submit(self.registerCase, imageNumber, segmentation, warmStartDirectory, False) for imageNumber in imageNumbers]
+            for future in futures:
+                future.result()
+        self.flushOutputs()
+
+    def registerCase(self, imageNumber, segmentation=False, warmStartDirectory=None, waitForOutputs=True):
+        # each case gets its own Registration, so cases can be registered concurrently (see pipeline.py).
+        # waitForOutputs: returns only once the outputs of the output writer are on disk
+        paths = self.initRegistrationPathsDict(imageNumber, segmentation)
+        initialDisplacementField = None
+        if warmStartDirectory:
+            initialDisplacementField = self.getWarmStartPath(warmStartDirectory, imageNumber)
+        parameterMaps = None
+        if self.parameterGenerator is not None:
+            maskPath = self.getMaskPath(imageNumber)
+            parameterMaps = self.parameterGenerator.generate(paths["fixedImagePath"], maskPath if os.path.exists(maskPath) else None)
+        registration = self.createRegistration(paths["outputDirectory"])
+        startTime = time.perf_counter()
+        correspondences = None
+        if self.keypointMatcher is not None:
+            from keypoints import withCorrespondingPoints
+            correspondences = self.matchKeypoints(imageNumber, paths)
+            parameterMaps = withCorrespondingPoints(parameterMaps or self.parameterMaps, self.keypointWeight, droppedResolutions=self.keypointDroppedResolutions)
+        with self.activeCasesLock:
+            for caseNumber in self.activeCases:
+                self.activeCases[caseNumber] = True
+            self.activeCases[imageNumber] = bool(self.activeCases)
+        try:
+            with MemorySampler() as memorySampler:
+                registration.register(paths["fixedImagePath"], paths["movingImagePath"], paths["pointFilePath"], initialDisplacementField, parameterMaps, correspondences)
+        finally:
+            with self.activeCasesLock:
+                overlapped = self.activeCases.pop(imageNumber)
+        peakMemory = None if overlapped else memorySampler.peakMB
+        self.caseRuntimes[f"copd{imageNumber}"] = (time.perf_counter() - startTime, peakMemory)
+        if waitForOutputs:
+            self.flushOutputs()
+
+    def matchKeypoints(self, imageNumber, paths):
+        # fixed and moving keypoint files in outputDirectory/copd<N>/keypoints, inside the lung masks when they exist
+        masks = [self.getMaskPath(imageNumber, status) for status in ["i", "e"]]
+        masks = masks if all(os.path.exists(mask) for mask in masks) else [None, None]
+        startTime = time.perf_counter()
+        fixedPoints, movingPoints, _ = self.keypointMatcher.match(paths["fixedImagePath"], paths["movingImagePath"], *masks)
+        print(f"copd{imageNumber}: {len(fixedPoints)} keypoint correspondences in {time.perf_counter() - startTime:.1f}s")
+        return self.keypointMatcher.writeCorrespondences(fixedPoints, movingPoints, os.path.join(paths["outputDirectory"], "keypoints"))
+
+    def flushOutputs(self):
+        if self.outputWriter is not None:
+            self.outputWriter.flush()
+            print(self.outputWriter.summary())
+
+    def previewTrain(self, imageNumbers=(1, 2, 3, 4), segmentation=False, factor=4):
+        # approximate TRE of every case in seconds (Registration.preview), written to evaluation/preview_tre.csv
+        rows = []
         for imageNumber in imageNumbers:
             paths = self.initRegistrationPathsDict(imageNumber, segmentation)
-            self.registration.setOutputDirectory(paths["outputDirectory"])
-            self.registration.register(paths["fixedImagePath"], paths["movingImagePath"], paths["pointFilePath"])
-
+            registration = self.createRegistration(paths["outputDirectory"])
+            result = registration.preview(paths["fixedImagePath"], paths["movingImagePath"], paths["pointFilePath"], self.getGroundTruthPath(imageNumber), factor=factor)
+            rows.append([f"copd{imageNumber}", result["tre"], result["seconds"]])
+            print(f"copd{imageNumber}: preview TRE {result['tre']:.2f} mm in {result['seconds']:.1f}s")
+        with open(os.path.join(self.evalResultsDirectory, "preview_tre.csv"), mode='w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(["Image", "TRE", "seconds"])
+            writer.writerows(rows)
+        return rows
+
+    def monitorCase(self, imageNumber, segmentation=False, everyIterations=None, toleranceMM=0.1):
+        # registers a case in monitoring mode, the convergence table and the schedule report are written to
+        # outputDirectory/copd<N>/convergence. everyIterations adds checkpoints within the resolutions
+        from convergenceMonitor import ConvergenceMonitor
+        paths = self.initRegistrationPathsDict(imageNumber, segmentation)
+        monitor = ConvergenceMonitor(os.path.join(paths["outputDirectory"], "convergence"), self.getGroundTruthPath(imageNumber), everyIterations)
+        registration = self.createRegistration(paths["outputDirectory"])
+        registration.convergenceMonitor = monitor
+        registration.register(paths["fixedImagePath"], paths["movingImagePath"], paths["pointFilePath"])
+        monitor.writeReport(toleranceMM)
+        print(monitor.report(toleranceMM))
+        return monitor
+
+    def getMaskPath(self, imageNumber, status="i"):
+        return os.path.join(self.datasetDirectory, f"copd{imageNumber}/segmentations/copd{imageNumber}_{status}BHCT_mask.nii")
+
+    @staticmethod
+    def getWarmStartPath(warmStartDirectory, imageNumber):
+        return os.path.join(warmStartDirectory, f"flow_copd{imageNumber}.nii.gz")
 
     def initRegistrationPathsDict(self, imageNumber, segmentation):
         # creates a path dict with inhale as moving and exhale as fixed
@@ -83,40 +240,105 @@ class COPDgene:
     def predictTrain(self):
         imageNumbers = [1,2,3,4]
         for imageNumber in imageNumbers:
-            folderName = f"copd{imageNumber}"
-            pointFilePath = os.path.join(self.outputDirectory, folderName, "outputpoints.txt")
-            outputFilePath = os.path.join(self.outputDirectory, f"prediction_copd{imageNumber}.txt")
-            self.evaluation.extractOutputPoints(pointFilePath, outputFilePath)
+            self.predictCase(imageNumber)
+
+    def predictCase(self, imageNumber):
+        self.evaluation.extractOutputPoints(self.getOutputPointsPath(imageNumber), self.getPredictionPath(imageNumber))
+
+    def getOutputPointsPath(self, imageNumber):
+        return os.path.join(self.outputDirectory, f"copd{imageNumber}", "outputpoints.txt")
+
+    def getPredictionPath(self, imageNumber):
+        return os.path.join(self.outputDirectory, f"prediction_copd{imageNumber}.txt")
 
 
     #################################
     ### EVALUATION FUNCTIONS ########
     #################################
     
-    def evaluateTrain(self, resultName):
-        imageNumbers = [1, 2, 3, 4]
+    def evaluateTrain(self, resultName, imageNumbers=(1, 2, 3, 4)):
+        landmarkErrorsPerCase = {imageNumber: self.computeLandmarkErrors(imageNumber) for imageNumber in imageNumbers}
+        return self.storeResults(resultName, landmarkErrorsPerCase)
+
+    def evaluateCase(self, imageNumber):
+        # prediction and landmark errors of a registered case
+        self.predictCase(imageNumber)
+        return self.computeLandmarkErrors(imageNumber)
+
+    def computeLandmarkErrors(self, imageNumber):
+        # errors in mm between the predicted and the ground truth exhale landmarks
+        pointSet1 = self.evaluation.readPointsFromFile(self.getPredictionPath(imageNumber))
+        pointSet2 = self.evaluation.readPointsFromFile(self.getGroundTruthPath(imageNumber))
+
+        normalizedPointSet1 = self.evaluation.normalizePoints(pointSet1, self.spacings[f"copd{imageNumber}"])
+        normalizedPointSet2 = self.evaluation.normalizePoints(pointSet2, self.spacings[f"copd{imageNumber}"])
+        return self.evaluation.landmarkErrors(normalizedPointSet1, normalizedPointSet2)
+
+    def storeResults(self, resultName, landmarkErrorsPerCase):
+        # writes the TRE csv and adds the run to the result store, returns the run id
+        imageNumbers = sorted(landmarkErrorsPerCase)
         treValues = []
-        with open(os.path.join(self.evalResultsDirectory, f"tre_in_mm_{resultName}.csv"), mode='w', newline='') as file:
+        groundTruthPaths = [self.getGroundTruthPath(imageNumber) for imageNumber in imageNumbers]
+        runId = self.resultStore.addRun(
+            resultName,
+            parameterHash=ParameterMapBuilder.hashOf(self.parameterMaps) if self.preset else self.resultStore.hashParameterFolder(self.parameterFolder),
+            datasetVersion=self.resultStore.hashFiles(groundTruthPaths),
+            parameterFolder=f"preset:{self.preset}" if self.preset else self.parameterFolder
+            )
+        with open(self.getTrePath(resultName), mode='w', newline='') as file:
             writer = csv.writer(file)
             writer.writerow(["Image", "TRE"])  
 
             for imageNumber in imageNumbers:
-                pointSetPath1 = os.path.join(self.outputDirectory, f"prediction_copd{imageNumber}.txt")
-                pointSetPath2 = os.path.join(self.datasetDirectory, f"copd{imageNumber}/copd{imageNumber}_300_eBH_xyz_r1.txt")
-
-
-                pointSet1 = self.evaluation.readPointsFromFile(pointSetPath1)
-                pointSet2 = self.evaluation.readPointsFromFile(pointSetPath2)
-
-                normalizedPointSet1 = self.evaluation.normalizePoints(pointSet1, self.spacings[f"copd{imageNumber}"])
-                normalizedPointSet2 = self.evaluation.normalizePoints(pointSet2, self.spacings[f"copd{imageNumber}"])
-
-                tre = self.evaluation.targetRegistrationError(normalizedPointSet1, normalizedPointSet2)
+                landmarkErrors = landmarkErrorsPerCase[imageNumber]
+                tre = np.mean(landmarkErrors)
                 treValues.append(tre)
+                runtime, peakMemory = self.caseRuntimes.get(f"copd{imageNumber}", (None, None))
+                self.resultStore.addCase(runId, f"copd{imageNumber}", landmarkErrors, runtime, peakMemory)
                 writer.writerow([f"copd{imageNumber}", tre])
 
             writer.writerow([f"mean", np.mean(treValues)])
             writer.writerow([f"std", np.std(treValues)])
+        return runId
+
+    #################################
+    ### OVERLAPPED EXECUTION ########
+    #################################
+
+    def runOverlapped(self, resultName, imageNumbers=(1, 2, 3, 4), segmentation=True, streaming=False, warmStartDirectory=None, queueSize=1, registrationWorkers=1):
+        # segments case N+1 and evaluates case N-1 while elastix registers case N. The queues only hold case numbers,
+        # queueSize bounds how many segmented cases wait for registration. Cases failing in a stage are left out of the run
+        stages = [
+            ("register", lambda imageNumber: self.registerCase(imageNumber, segmentation, warmStartDirectory), registrationWorkers),
+            ("evaluate", self.evaluateCase, 1),
+            ]
+        if segmentation:
+            stages.insert(0, ("segment", lambda imageNumber: self.segmentCase(imageNumber, streaming), 1))
+        overlappedStages = OverlappedStages(stages, queueSize=queueSize)
+        landmarkErrorsPerCase = overlappedStages.run(imageNumbers)
+        print(overlappedStages.summary())
+        if not landmarkErrorsPerCase:
+            raise RuntimeError(f"All cases failed: {overlappedStages.failures}")
+        return self.storeResults(resultName, landmarkErrorsPerCase)
+
+    def analyzeTrain(self, resultName, imageNumbers=(1, 2, 3, 4), slabSize=4, numberOfWorkers=None):
+        # jacobian determinant statistics of the registered cases inside the inhale lung mask
+        from deformationAnalysis import DeformationAnalysis
+        rows = []
+        for imageNumber in imageNumbers:
+            analysis = DeformationAnalysis(self.getMaskPath(imageNumber), slabSize=slabSize, numberOfWorkers=numberOfWorkers)
+            parameterFiles = analysis.findParameterFiles(os.path.join(self.outputDirectory, f"copd{imageNumber}", "transformParameterMaps"))
+            summaries = analysis.analyzeTransform(parameterFiles)
+            rows.extend(dict(summary, case=f"copd{imageNumber}", region=region) for region, summary in summaries.items())
+        filePath = os.path.join(self.evalResultsDirectory, f"jacobian_{resultName}.csv")
+        DeformationAnalysis.writeCsv(rows, filePath)
+        return filePath
+
+    def getTrePath(self, resultName):
+        return os.path.join(self.evalResultsDirectory, f"tre_in_mm_{resultName}.csv")
+
+    def getGroundTruthPath(self, imageNumber):
+        return os.path.join(self.datasetDirectory, f"copd{imageNumber}/copd{imageNumber}_300_eBH_xyz_r1.txt")
 
 
 
@@ -127,13 +349,18 @@ if __name__ == "__main__":
     datasetDirectory = "data"
     outputDirectory = "results"
     parameterFolder = "customParameters"
+    overlapped = False # segment, register and evaluate different cases at the same time
 
 
     # FUNCTION CALLS
     copdgene = COPDgene(datasetDirectory, outputDirectory, parameterFolder)
-    copdgene.registerTrain(segmentation=True)
-    copdgene.predictTrain()
-    copdgene.evaluateTrain("NAME_OF_THE_TEST")
+    if overlapped:
+        runId = copdgene.runOverlapped("NAME_OF_THE_TEST", segmentation=True)
+    else:
+        copdgene.registerTrain(segmentation=True)
+        copdgene.predictTrain()
+        runId = copdgene.evaluateTrain("NAME_OF_THE_TEST")
+    print(copdgene.resultStore.report([runId]))
 
 
 
@@ -102,44 +102,48 @@ def read_raw(
     os.remove(fp.name)
     return img
 
-def main():
-    # List of parameters for each image case
-    image_cases = [
-        {"raw_file_name": "data/copd1/copd1_eBHCT.img", "out_file_name": "data/copd1/copd1_eBHCT.nii", "big_endian": False, "sitk_pixel_type": sitk.sitkInt16, "sz": [512, 512, 121], "spacing": ["0.625", "0.625", "2.5"]},
-        {"raw_file_name": "data/copd1/copd1_iBHCT.img", "out_file_name": "data/copd1/copd1_iBHCT.nii", "big_endian": False, "sitk_pixel_type": sitk.sitkInt16, "sz": [512, 512, 121], "spacing": ["0.625", "0.625", "2.5"]},
-        
-        {"raw_file_name": "data/copd2/copd2_eBHCT.img", "out_file_name": "data/copd2/copd2_eBHCT.nii", "big_endian": False, "sitk_pixel_type": sitk.sitkInt16, "sz": [512, 512, 102], "spacing": ["0.645", "0.645", "2.5"]},
-        {"raw_file_name": "data/copd2/copd2_iBHCT.img", "out_file_name": "data/copd2/copd2_iBHCT.nii", "big_endian": False, "sitk_pixel_type": sitk.sitkInt16, "sz": [512, 512, 102], "spacing": ["0.645", "0.645", "2.5"]},
-        
-        {"raw_file_name": "data/copd3/copd3_eBHCT.img", "out_file_name": "data/copd3/copd3_eBHCT.nii", "big_endian": False, "sitk_pixel_type": sitk.sitkInt16, "sz": [512, 512, 126], "spacing": ["0.652", "0.652", "2.5"]},
-        {"raw_file_name": "data/copd3/copd3_iBHCT.img", "out_file_name": "data/copd3/copd3_iBHCT.nii", "big_endian": False, "sitk_pixel_type": sitk.sitkInt16, "sz": [512, 512, 126], "spacing": ["0.652", "0.652", "2.5"]},
-        
-        {"raw_file_name": "data/copd4/copd4_eBHCT.img", "out_file_name": "data/copd4/copd4_eBHCT.nii", "big_endian": False, "sitk_pixel_type": sitk.sitkInt16, "sz": [512, 512, 126], "spacing": ["0.590", "0.590", "2.5"]},
-        {"raw_file_name": "data/copd4/copd4_iBHCT.img", "out_file_name": "data/copd4/copd4_iBHCT.nii", "big_endian": False, "sitk_pixel_type": sitk.sitkInt16, "sz": [512, 512, 126], "spacing": ["0.590", "0.590", "2.5"]},
-
-        # TEST SET
-        {"raw_file_name": "data/copd5/copd5_eBHCT.img", "out_file_name": "data/copd5/copd5_eBHCT.nii", "big_endian": False, "sitk_pixel_type": sitk.sitkInt16, "sz": [512, 512, 131], "spacing": ["0.647", "0.647", "2.5"]},
-        {"raw_file_name": "data/copd5/copd5_iBHCT.img", "out_file_name": "data/copd5/copd5_iBHCT.nii", "big_endian": False, "sitk_pixel_type": sitk.sitkInt16, "sz": [512, 512, 131], "spacing": ["0.647", "0.647", "2.5"]},
-
-        {"raw_file_name": "data/copd6/copd6_eBHCT.img", "out_file_name": "data/copd6/copd6_eBHCT.nii", "big_endian": False, "sitk_pixel_type": sitk.sitkInt16, "sz": [512, 512, 119], "spacing": ["0.633", "0.633", "2.5"]},
-        {"raw_file_name": "data/copd6/copd6_iBHCT.img", "out_file_name": "data/copd6/copd6_iBHCT.nii", "big_endian": False, "sitk_pixel_type": sitk.sitkInt16, "sz": [512, 512, 119], "spacing": ["0.633", "0.633", "2.5"]},
-
+# List of parameters for each image case
+IMAGE_CASES = [
+    {"raw_file_name": "data/copd1/copd1_eBHCT.img", "out_file_name": "data/copd1/copd1_eBHCT.nii", "big_endian": False, "sitk_pixel_type": sitk.sitkInt16, "sz": [512, 512, 121], "spacing": ["0.625", "0.625", "2.5"]},
+    {"raw_file_name": "data/copd1/copd1_iBHCT.img", "out_file_name": "data/copd1/copd1_iBHCT.nii", "big_endian": False, "sitk_pixel_type": sitk.sitkInt16, "sz": [512, 512, 121], "spacing": ["0.625", "0.625", "2.5"]},
+    
+    {"raw_file_name": "data/copd2/copd2_eBHCT.img", "out_file_name": "data/copd2/copd2_eBHCT.nii", "big_endian": False, "sitk_pixel_type": sitk.sitkInt16, "sz": [512, 512, 102], "spacing": ["0.645", "0.645", "2.5"]},
+    {"raw_file_name": "data/copd2/copd2_iBHCT.img", "out_file_name": "data/copd2/copd2_iBHCT.nii", "big_endian": False, "sitk_pixel_type": sitk.sitkInt16, "sz": [512, 512, 102], "spacing": ["0.645", "0.645", "2.5"]},
     
-        {"raw_file_name": "data/copd0/copd0_eBHCT.img", "out_file_name": "data/copd0/copd0_eBHCT.nii", "big_endian": False, "sitk_pixel_type": sitk.sitkInt16, "sz": [256, 256, 94], "spacing": ["0.97", "0.97", "2.5"]},
-        {"raw_file_name": "data/copd0/copd0_iBHCT.img", "out_file_name": "data/copd0/copd0_iBHCT.nii", "big_endian": False, "sitk_pixel_type": sitk.sitkInt16, "sz": [256, 256, 94], "spacing": ["0.97", "0.97", "2.5"]},
+    {"raw_file_name": "data/copd3/copd3_eBHCT.img", "out_file_name": "data/copd3/copd3_eBHCT.nii", "big_endian": False, "sitk_pixel_type": sitk.sitkInt16, "sz": [512, 512, 126], "spacing": ["0.652", "0.652", "2.5"]},
+    {"raw_file_name": "data/copd3/copd3_iBHCT.img", "out_file_name": "data/copd3/copd3_iBHCT.nii", "big_endian": False, "sitk_pixel_type": sitk.sitkInt16, "sz": [512, 512, 126], "spacing": ["0.652", "0.652", "2.5"]},
+    
+    {"raw_file_name": "data/copd4/copd4_eBHCT.img", "out_file_name": "data/copd4/copd4_eBHCT.nii", "big_endian": False, "sitk_pixel_type": sitk.sitkInt16, "sz": [512, 512, 126], "spacing": ["0.590", "0.590", "2.5"]},
+    {"raw_file_name": "data/copd4/copd4_iBHCT.img", "out_file_name": "data/copd4/copd4_iBHCT.nii", "big_endian": False, "sitk_pixel_type": sitk.sitkInt16, "sz": [512, 512, 126], "spacing": ["0.590", "0.590", "2.5"]},
 
-    ]
+    # TEST SET
+    {"raw_file_name": "data/copd5/copd5_eBHCT.img", "out_file_name": "data/copd5/copd5_eBHCT.nii", "big_endian": False, "sitk_pixel_type": sitk.sitkInt16, "sz": [512, 512, 131], "spacing": ["0.647", "0.647", "2.5"]},
+    {"raw_file_name": "data/copd5/copd5_iBHCT.img", "out_file_name": "data/copd5/copd5_iBHCT.nii", "big_endian": False, "sitk_pixel_type": sitk.sitkInt16, "sz": [512, 512, 131], "spacing": ["0.647", "0.647", "2.5"]},
+
+    {"raw_file_name": "data/copd6/copd6_eBHCT.img", "out_file_name": "data/copd6/copd6_eBHCT.nii", "big_endian": False, "sitk_pixel_type": sitk.sitkInt16, "sz": [512, 512, 119], "spacing": ["0.633", "0.633", "2.5"]},
+    {"raw_file_name": "data/copd6/copd6_iBHCT.img", "out_file_name": "data/copd6/copd6_iBHCT.nii", "big_endian": False, "sitk_pixel_type": sitk.sitkInt16, "sz": [512, 512, 119], "spacing": ["0.633", "0.633", "2.5"]},
 
-    for case in image_cases:
-        image = read_raw(
-            binary_file_name=case["raw_file_name"],
-            image_size=case["sz"],
-            sitk_pixel_type=case["sitk_pixel_type"],
-            big_endian=case["big_endian"],
-            image_spacing=case["spacing"]
-        )
 
-        sitk.WriteImage(image, case["out_file_name"])
+    {"raw_file_name": "data/copd0/copd0_eBHCT.img", "out_file_name": "data/copd0/copd0_eBHCT.nii", "big_endian": False, "sitk_pixel_type": sitk.sitkInt16, "sz": [256, 256, 94], "spacing": ["0.97", "0.97", "2.5"]},
+    {"raw_file_name": "data/copd0/copd0_iBHCT.img", "out_file_name": "data/copd0/copd0_iBHCT.nii", "big_endian": False, "sitk_pixel_type": sitk.sitkInt16, "sz": [256, 256, 94], "spacing": ["0.97", "0.97", "2.5"]},
+
+]
+
+
+def convertImage(case):
+    # reads one raw image of IMAGE_CASES and stores it as .nii
+    image = read_raw(
+        binary_file_name=case["raw_file_name"],
+        image_size=case["sz"],
+        sitk_pixel_type=case["sitk_pixel_type"],
+        big_endian=case["big_endian"],
+        image_spacing=case["spacing"]
+    )
+    sitk.WriteImage(image, case["out_file_name"])
+
+def main():
+    for case in IMAGE_CASES:
+        convertImage(case)
 
 if __name__ == "__main__":
     main()
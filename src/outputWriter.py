@@ -0,0 +1,175 @@
+# # -----------------------------------------------------------------------------
+# # Background writer for the registration outputs (bounded queue, compression, retention)
+# # Date Created: 19-10-2026
+# # -----------------------------------------------------------------------------
+
+import argparse
+import fnmatch
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+import nibabel as nib
+
+
+# what each retention policy keeps of a registration: transform parameter maps, warped image, transformed points
+RETENTION = {
+    "all": {"transforms", "images", "points"},
+    "transformsAndPoints": {"transforms", "points"},
+    }
+# files of an output folder that only the "all" policy keeps
+IMAGE_PATTERNS = ["*_registered.nii", "*_registered.nii.gz", "*_registered.mha", "*_registered.mhd", "*_registered.raw"]
+
+
+class OutputWriter:
+    # Writes the outputs of Registration (Registration(..., outputWriter=OutputWriter(...))) on worker threads
+    # while the next case registers. The queue holds at most maxQueued pending cases, a full queue blocks submit
+    # (write stall) so the warped images waiting in memory stay bounded. Warped images are stored as
+    # imageExtension (".nii.gz" compressed, ".nii") with imageType:
+    #   - "float32": the values of elastix
+    #   - "int16": rounded and clipped, exact for CT in HU
+    #   - "scaledInt16": int16 with the scale slope/intercept of the header, 16 bit integers spread over the
+    #     value range of the image (not half floats)
+    # An error of a worker is raised by the next flush.
+    STOP = object()
+    IMAGE_TYPES = ["float32", "int16", "scaledInt16"]
+
+    def __init__(self, maxQueued=2, numberOfWorkers=1, imageExtension=".nii.gz", imageType="float32", retention="all"):
+        if imageExtension not in [".nii", ".nii.gz"]:
+            raise ValueError(f"Unsupported image extension {imageExtension}, use .nii or .nii.gz")
+        if imageType not in self.IMAGE_TYPES:
+            raise ValueError(f"Unknown image type {imageType}, use one of {self.IMAGE_TYPES}")
+        if retention not in RETENTION:
+            raise ValueError(f"Unknown retention policy {retention}, use one of {list(RETENTION)}")
+        self.imageExtension = imageExtension
+        self.imageType = imageType
+        self.retention = retention
+        self.tasks = queue.Queue(maxsize=maxQueued)
+        self.errors = []
+        self.lock = threading.Lock()
+        # statistics: seconds callers waited for a free slot, seconds spent writing, bytes of the written images
+        self.stallSeconds = 0.0
+        self.writeSeconds = 0.0
+        self.bytesWritten = 0
+        self.workers = [threading.Thread(target=self.work, daemon=True) for _ in range(numberOfWorkers)]
+        for worker in self.workers:
+            worker.start()
+
+    def keeps(self, kind):
+        # kind: "transforms", "images" or "points"
+        return kind in RETENTION[self.retention]
+
+    #################################
+    ### QUEUE #######################
+    #################################
+
+    def submit(self, function, *args):
+        # function(*args) runs on a worker thread, blocks while maxQueued tasks are pending
+        startTime = time.perf_counter()
+        self.tasks.put((function, args))
+        with self.lock:
+            self.stallSeconds += time.perf_counter() - startTime
+
+    def work(self):
+        while True:
+            task = self.tasks.get()
+            if task is self.STOP:
+                self.tasks.task_done()
+                return
+            function, args = task
+            startTime = time.perf_counter()
+            try:
+                function(*args)
+            except Exception as error:
+                with self.lock:
+                    self.errors.append(error)
+            finally:
+                with self.lock:
+                    self.writeSeconds += time.perf_counter() - startTime
+                self.tasks.task_done()
+
+    def flush(self):
+        # waits until every submitted output is on disk
+        self.tasks.join()
+        with self.lock:
+            errors, self.errors = self.errors, []
+        if errors:
+            raise RuntimeError(f"{len(errors)} output(s) could not be written") from errors[0]
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            for _ in self.workers:
+                self.tasks.put(self.STOP)
+            for worker in self.workers:
+                worker.join()
+
+    def summary(self):
+        return f"outputs: {self.bytesWritten / 1024 ** 2:.1f} MB of images written in {self.writeSeconds:.1f}s, callers stalled {self.stallSeconds:.1f}s"
+
+    #################################
+    ### IMAGES ######################
+    #################################
+
+    def writeImage(self, array, spacing, origin, direction, filePath):
+        # array: itk array (z,y,x), spacing/origin (x,y,z) and direction 3x3 of the itk image (LPS)
+        data = np.transpose(np.asarray(array), (2, 1, 0))
+        if self.imageType == "int16":
+            data = np.clip(np.rint(data), np.iinfo(np.int16).min, np.iinfo(np.int16).max).astype(np.int16)
+        elif self.imageType == "float32":
+            data = data.astype(np.float32, copy=False)
+        image = nib.Nifti1Image(data, self.affineOf(spacing, origin, direction))
+        if self.imageType == "scaledInt16":
+            # nibabel scales the floats into int16 and stores slope and intercept in the header
+            image.set_data_dtype(np.int16)
+        nib.save(image, filePath)
+        with self.lock:
+            self.bytesWritten += os.path.getsize(filePath)
+        return filePath
+
+    @staticmethod
+    def affineOf(spacing, origin, direction):
+        # voxel index (x,y,z) -> RAS mm, itk stores the geometry in LPS
+        affine = np.eye(4)
+        affine[:3, :3] = np.asarray(direction, dtype=np.float64) @ np.diag(np.asarray(spacing, dtype=np.float64))
+        affine[:3, 3] = np.asarray(origin, dtype=np.float64)
+        return np.diag([-1.0, -1.0, 1.0, 1.0]) @ affine
+
+
+#################################
+### RETENTION ###################
+#################################
+
+def applyRetention(directory, retention="transformsAndPoints", olderThanDays=0, dryRun=False):
+    # deletes the files of the output folders below directory that the retention policy does not keep,
+    # only files older than olderThanDays. Returns (deleted paths, freed bytes)
+    patterns = [] if "images" in RETENTION[retention] else IMAGE_PATTERNS
+    cutoff = time.time() - olderThanDays * 24 * 3600
+    deleted, freedBytes = [], 0
+    for root, _, fileNames in os.walk(directory):
+        for fileName in fileNames:
+            path = os.path.join(root, fileName)
+            if not any(fnmatch.fnmatch(fileName, pattern) for pattern in patterns) or os.path.getmtime(path) > cutoff:
+                continue
+            freedBytes += os.path.getsize(path)
+            deleted.append(path)
+            if not dryRun:
+                os.remove(path)
+    return deleted, freedBytes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Apply a retention policy to old registration outputs (e.g. the job folders of a sweep).")
+    parser.add_argument("directory", help="folder with the registration outputs, searched recursively")
+    parser.add_argument("--retention", default="transformsAndPoints", choices=list(RETENTION))
+    parser.add_argument("--older-than-days", type=float, default=0)
+    parser.add_argument("--dry-run", action="store_true", help="only list the files")
+    args = parser.parse_args()
+
+    deleted, freedBytes = applyRetention(args.directory, args.retention, args.older_than_days, args.dry_run)
+    for path in deleted:
+        print(path)
+    print(f"{'would free' if args.dry_run else 'freed'} {freedBytes / 1024 ** 2:.1f} MB in {len(deleted)} files")
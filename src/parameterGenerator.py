@@ -0,0 +1,140 @@
+# # -----------------------------------------------------------------------------
+# # Parameter maps adapted to the geometry and the lung volume of each case
+# # Date Created: 19-10-2026
+# # -----------------------------------------------------------------------------
+
+import argparse
+import os
+
+import numpy as np
+import nibabel as nib
+
+from utils import Utils
+from parameterMaps import ParameterMapBuilder, writeParameterMap
+
+
+class ParameterGenerator:
+    # Takes parameter maps (a folder, a preset of parameterMaps.py or built maps) as templates and replaces the geometry dependent values per case:
+    #   - pyramid: per axis shrink factors so that every level has (nearly) isotropic voxels, e.g. no slice
+    #     axis downsampled as much as the in-plane axes when slices are 4x thicker. Levels whose lung would
+    #     be smaller than minimumLungVoxels along an axis are dropped.
+    #   - B-spline grid: FinalGridSpacingInPhysicalUnits from the lung size (controlPointsAcrossLung nodes
+    #     across the cube root of the lung volume), clamped to gridSpacingRangeMM.
+    #   - samples: NumberOfSpatialSamples per level, at most the number of lung voxels at that level and at
+    #     most the template value.
+    #   - MaximumStepLength (mm): the finest spacing of the case.
+    # The lung is read from the mask of the fixed image, without mask the whole image is used.
+    util = Utils()
+
+    def __init__(self, parameters, minimumLungVoxels=16, controlPointsAcrossLung=24, gridSpacingRangeMM=(5.0, 20.0), minimumSamples=2000):
+        self.minimumLungVoxels = minimumLungVoxels
+        self.controlPointsAcrossLung = controlPointsAcrossLung
+        self.gridSpacingRangeMM = gridSpacingRangeMM
+        self.minimumSamples = minimumSamples
+        # (registration type, map) in application order, the type names the stored transform parameter maps
+        self.templates = ParameterMapBuilder.resolve(parameters)
+
+    def generate(self, fixedImagePath, maskPath=None):
+        # in-memory parameter maps for Registration.register(..., parameterMaps=...)
+        geometry = self.measureGeometry(fixedImagePath, maskPath)
+        return [(registrationType, self.adapt(template, geometry)) for registrationType, template in self.templates]
+
+    #################################
+    ### GEOMETRY ####################
+    #################################
+
+    @staticmethod
+    def measureGeometry(fixedImagePath, maskPath=None):
+        # spacing (x,y,z) in mm, lung extent in mm and lung volume in mm3, only the header of the image is read
+        image = nib.load(fixedImagePath)
+        spacing = np.array(image.header.get_zooms()[:3], dtype=np.float64)
+        if maskPath is None:
+            extent = np.array(image.shape[:3]) * spacing
+            return {"spacing": spacing, "lungExtent": extent, "lungVolume": float(np.prod(extent)), "lungVoxels": int(np.prod(image.shape[:3]))}
+
+        mask = np.asanyarray(nib.load(maskPath, mmap=True).dataobj) > 0
+        if not mask.any():
+            raise ValueError(f"The lung mask {maskPath} is empty")
+        extent = np.array([(indices.max() - indices.min() + 1) for indices in (np.flatnonzero(mask.any(axis=other)) for other in [(1, 2), (0, 2), (0, 1)])]) * spacing
+        lungVoxels = int(mask.sum())
+        return {"spacing": spacing, "lungExtent": extent, "lungVolume": lungVoxels * float(np.prod(spacing)), "lungVoxels": lungVoxels}
+
+    def pyramidScheduleFor(self, geometry, nResolutions):
+        # shrink factors per level (coarse to fine) and axis. The in-plane factor halves from level to level,
+        # the other axes follow the physical resolution of the finest axis
+        spacing = geometry["spacing"]
+        schedule = []
+        for level in range(nResolutions):
+            targetSpacing = spacing.min() * 2 ** (nResolutions - 1 - level)
+            factors = np.maximum(1, np.round(targetSpacing / spacing)).astype(int)
+            schedule.append(factors)
+        # coarse levels on which the lung would be too small are removed
+        while len(schedule) > 1 and np.any(geometry["lungExtent"] / (schedule[0] * spacing) < self.minimumLungVoxels):
+            schedule.pop(0)
+        return schedule
+
+    def gridSpacingFor(self, geometry):
+        gridSpacing = np.cbrt(geometry["lungVolume"]) / self.controlPointsAcrossLung
+        return float(np.clip(gridSpacing, *self.gridSpacingRangeMM))
+
+    def samplesFor(self, geometry, schedule, templateSamples):
+        # random coordinate samples beyond the number of lung voxels of a level only repeat voxels
+        samples = []
+        for factors in schedule:
+            lungVoxels = geometry["lungVoxels"] / np.prod(factors)
+            samples.append(int(min(templateSamples, max(self.minimumSamples, lungVoxels))))
+        return samples
+
+    #################################
+    ### MAPS ########################
+    #################################
+
+    def adapt(self, template, geometry):
+        parameterMap = {key: list(values) for key, values in template.items()}
+        templateResolutions = int(parameterMap.get("NumberOfResolutions", ["1"])[0])
+        schedule = self.pyramidScheduleFor(geometry, templateResolutions)
+        nResolutions = len(schedule)
+
+        parameterMap["NumberOfResolutions"] = [str(nResolutions)]
+        parameterMap["ImagePyramidSchedule"] = [str(factor) for factors in schedule for factor in factors]
+        for key in ["FixedImagePyramidSchedule", "MovingImagePyramidSchedule"]:
+            parameterMap.pop(key, None)
+
+        # per resolution values of the template keep their finest levels
+        for key in ["MaximumNumberOfIterations", "GridSpacingSchedule"]:
+            values = parameterMap.get(key)
+            if values and len(values) == templateResolutions:
+                parameterMap[key] = values[-nResolutions:]
+            elif values and key == "GridSpacingSchedule":
+                parameterMap.pop(key)
+
+        if "NumberOfSpatialSamples" in parameterMap:
+            templateSamples = int(float(parameterMap["NumberOfSpatialSamples"][-1]))
+            parameterMap["NumberOfSpatialSamples"] = [str(samples) for samples in self.samplesFor(geometry, schedule, templateSamples)]
+
+        if "MaximumStepLength" in parameterMap:
+            parameterMap["MaximumStepLength"] = [f"{geometry['spacing'].min():.3f}"]
+
+        if parameterMap.get("Transform", [""])[0] == "BSplineTransform":
+            parameterMap.pop("FinalGridSpacingInVoxels", None)
+            parameterMap["FinalGridSpacingInPhysicalUnits"] = [f"{self.gridSpacingFor(geometry):.2f}"]
+        return parameterMap
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print (or write) the parameter maps adapted to one case.")
+    parser.add_argument("--parameters", default="customParameters", help="folder with the template parameter files or a preset (fast, balanced, accurate)")
+    parser.add_argument("--fixed", required=True, help="fixed image of the case, e.g. data/copd1/copd1_iBHCT.nii")
+    parser.add_argument("--mask", default=None, help="lung mask of the fixed image")
+    parser.add_argument("--output", default=None, help="folder for the adapted parameter files")
+    args = parser.parse_args()
+
+    generator = ParameterGenerator(args.parameters)
+    for registrationType, parameterMap in generator.generate(args.fixed, args.mask):
+        print(registrationType)
+        for key in ["NumberOfResolutions", "ImagePyramidSchedule", "MaximumNumberOfIterations", "NumberOfSpatialSamples", "FinalGridSpacingInPhysicalUnits"]:
+            if key in parameterMap:
+                print(f"  {key}: {' '.join(parameterMap[key])}")
+        if args.output:
+            Utils.ensureFolderExists(args.output)
+            writeParameterMap(parameterMap, os.path.join(args.output, registrationType + ".txt"))
@@ -0,0 +1,294 @@
+# # -----------------------------------------------------------------------------
+# # In-memory elastix parameter maps: validated builder and speed/accuracy presets
+# # Date Created: 19-10-2026
+# # -----------------------------------------------------------------------------
+
+import argparse
+import copy
+import hashlib
+import json
+import logging
+import os
+import re
+import shlex
+
+from utils import Utils
+
+
+#################################
+### SCHEMA ######################
+#################################
+
+# value type and allowed values of the parameters that are checked, other elastix parameters are passed on as they are
+SCHEMA = {
+    "Registration": ("string", {"MultiResolutionRegistration", "MultiMetricMultiResolutionRegistration"}),
+    "Transform": ("string", {"TranslationTransform", "EulerTransform", "SimilarityTransform", "AffineTransform", "BSplineTransform", "RecursiveBSplineTransform"}),
+    "Metric": ("string", {"AdvancedMattesMutualInformation", "AdvancedNormalizedCorrelation", "AdvancedMeanSquares", "NormalizedMutualInformation", "CorrespondingPointsEuclideanDistanceMetric", "TransformBendingEnergyPenalty"}),
+    "Optimizer": ("string", {"AdaptiveStochasticGradientDescent", "StandardGradientDescent", "QuasiNewtonLBFGS", "RegularStepGradientDescent"}),
+    "ImageSampler": ("string", {"Random", "RandomCoordinate", "RandomSparseMask", "Full", "Grid"}),
+    "NumberOfResolutions": ("int", None),
+    "ImagePyramidSchedule": ("int", None),
+    "GridSpacingSchedule": ("float", None),
+    "MaximumNumberOfIterations": ("int", None),
+    "NumberOfSpatialSamples": ("int", None),
+    "NumberOfHistogramBins": ("int", None),
+    "MaximumNumberOfSamplingAttempts": ("int", None),
+    "BSplineInterpolationOrder": ("int", {"0", "1", "2", "3", "4", "5"}),
+    "FinalBSplineInterpolationOrder": ("int", {"0", "1", "2", "3", "4", "5"}),
+    "FinalGridSpacingInVoxels": ("float", None),
+    "FinalGridSpacingInPhysicalUnits": ("float", None),
+    "MaximumStepLength": ("float", None),
+    "SP_a": ("float", None),
+    "SP_A": ("float", None),
+    "SP_alpha": ("float", None),
+    "AutomaticScalesEstimation": ("bool", None),
+    "AutomaticTransformInitialization": ("bool", None),
+    "AutomaticParameterEstimation": ("bool", None),
+    "UseAdaptiveStepSizes": ("bool", None),
+    "NewSamplesEveryIteration": ("bool", None),
+    "UseRandomSampleRegion": ("bool", None),
+    "WriteResultImage": ("bool", None),
+    "HowToCombineTransforms": ("string", {"Compose", "Add"}),
+}
+REQUIRED = ["Registration", "Transform", "Metric", "Optimizer", "NumberOfResolutions"]
+# parameters with one value, one value per resolution or one value per resolution and axis
+PER_RESOLUTION = {"ImagePyramidSchedule", "GridSpacingSchedule", "MaximumNumberOfIterations", "NumberOfSpatialSamples"}
+PER_AXIS = {"FinalGridSpacingInVoxels", "FinalGridSpacingInPhysicalUnits"}
+DIMENSION = 3
+
+
+#################################
+### PRESETS #####################
+#################################
+
+# the custom parameter set of the challenge, the base of every preset. It is read from the parameter files, so
+# the balanced preset is always the folder the README results were measured with
+PRESET_BASE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "customParameters")
+
+# preset name -> {registration type: changes to the custom parameter set}. Only balanced has a measured profile,
+# fast and accurate are experimental until they are benchmarked (EXPERIMENTAL_PRESETS)
+PRESETS = {
+    # experimental: full resolution is skipped: the affine stops at 1/2, the B-spline at 1/2 in-plane with fewer iterations and samples
+    "fast": {
+        "affine": {"NumberOfResolutions": 4, "ImagePyramidSchedule": [16, 8, 4, 2], "MaximumNumberOfIterations": 1000},
+        "bspline": {"NumberOfResolutions": 5, "ImagePyramidSchedule": [16, 16, 3, 10, 10, 2, 8, 8, 2, 4, 4, 1, 2, 2, 1], "MaximumNumberOfIterations": 300, "NumberOfSpatialSamples": 10000},
+        },
+    # the parameter set of the challenge
+    "balanced": {"affine": {}, "bspline": {}},
+    # experimental: finer B-spline grid, more iterations and samples
+    "accurate": {
+        "affine": {},
+        "bspline": {"FinalGridSpacingInVoxels": [6.0, 6.0, 3.0], "MaximumNumberOfIterations": 1500, "NumberOfSpatialSamples": 50000},
+        },
+}
+
+# runtime per case and TRE over COPD1-4 (with lung segmentation) measured for the presets, see the README table.
+# Presets without a recorded profile are experimental, their speed and accuracy are design intentions only. They
+# are measured with "python src/parameterMaps.py benchmark" and get a profile here once the numbers are known
+PRESET_PROFILES = {
+    "balanced": {"minutesPerCase": 4.65, "meanTre": 3.41, "stdTre": 1.42, "source": "README Table 1, custom affine + bspline + segmentation"},
+}
+EXPERIMENTAL_PRESETS = [name for name in PRESETS if name not in PRESET_PROFILES]
+
+
+def readParameterMap(filePath):
+    # elastix parameter file -> {key: [values as strings]}, the format of itk.ParameterObject maps
+    parameterMap = {}
+    with open(filePath, 'r') as file:
+        for line in file:
+            match = re.match(r"^\s*\((\w+)\s+(.*)\)\s*$", line.split("//")[0])
+            if match:
+                parameterMap[match.group(1)] = shlex.split(match.group(2))
+    return parameterMap
+
+
+def writeParameterMap(parameterMap, filePath):
+    # elastix text format, strings quoted and numbers as they are
+    with open(filePath, 'w') as file:
+        for key, values in parameterMap.items():
+            formatted = [value if re.fullmatch(r"-?[\d.]+(e-?\d+)?", value) else f'"{value}"' for value in values]
+            file.write(f"({key} {' '.join(formatted)})\n")
+
+
+class ParameterMapBuilder:
+    # Builds the parameter maps Registration takes directly: [(registration type, {key: [values as strings]})] in
+    # application order (rigid -> affine -> bspline). Values are given as python values and checked against SCHEMA
+    # when the maps are built, the maps of a folder or preset are read once and reused for every case.
+    util = Utils()
+
+    def __init__(self):
+        self.stages = {}
+
+    def add(self, registrationType, parameters):
+        if registrationType in self.stages:
+            raise ValueError(f"The {registrationType} stage already exists")
+        self.stages[registrationType] = {key: self.toStrings(value) for key, value in parameters.items()}
+        return self
+
+    def update(self, registrationType, **parameters):
+        # changes parameters of a stage, None removes a parameter
+        if registrationType not in self.stages:
+            raise KeyError(f"No {registrationType} stage, stages are {list(self.stages)}")
+        for key, value in parameters.items():
+            if value is None:
+                self.stages[registrationType].pop(key, None)
+            else:
+                self.stages[registrationType][key] = self.toStrings(value)
+        return self
+
+    def remove(self, registrationType):
+        del self.stages[registrationType]
+        return self
+
+    def build(self):
+        if not self.stages:
+            raise ValueError("No registration stage")
+        errors = [f"{registrationType}: {error}" for registrationType, parameterMap in self.stages.items() for error in self.validate(parameterMap)]
+        if errors:
+            raise ValueError("Invalid parameter maps:\n" + "\n".join(errors))
+        order = sorted(self.stages, key=self.util.getRegistrationSortKey)
+        return [(registrationType, copy.deepcopy(self.stages[registrationType])) for registrationType in order]
+
+    #################################
+    ### SOURCES #####################
+    #################################
+
+    @classmethod
+    def fromPreset(cls, name):
+        if name not in PRESETS:
+            raise KeyError(f"Unknown preset {name}, presets are {list(PRESETS)}")
+        if name in EXPERIMENTAL_PRESETS:
+            logging.warning(f"The preset {name} is experimental, its runtime and TRE have not been measured yet")
+        builder = cls.fromFolder(PRESET_BASE_FOLDER)
+        for registrationType, changes in PRESETS[name].items():
+            builder.update(registrationType, **changes)
+        return builder
+
+    @classmethod
+    def fromFolder(cls, parameterFolder):
+        # every file of the folder must be a .txt parameter file named after its registration type
+        builder = cls()
+        strayFiles = []
+        for filePath in sorted(cls.util.getAllFiles(parameterFolder)):
+            registrationType = os.path.basename(filePath).split(".")[0]
+            if not filePath.endswith(".txt") or cls.util.getRegistrationSortKey(filePath)[0] == 99:
+                strayFiles.append(os.path.basename(filePath))
+                continue
+            builder.stages[registrationType] = readParameterMap(filePath)
+        if strayFiles:
+            raise ValueError(f"{parameterFolder} contains files that are not rigid/affine/bspline parameter files: {strayFiles}")
+        return builder
+
+    @classmethod
+    def resolve(cls, parameters):
+        # a preset name, a parameter folder or already built maps -> built maps
+        if isinstance(parameters, str):
+            return cls.fromPreset(parameters).build() if parameters in PRESETS else cls.fromFolder(parameters).build()
+        builder = cls()
+        for registrationType, parameterMap in parameters:
+            builder.stages[registrationType] = {key: list(values) for key, values in parameterMap.items()}
+        return builder.build()
+
+    #################################
+    ### VALIDATION ##################
+    #################################
+
+    @staticmethod
+    def toStrings(value):
+        # python value(s) -> elastix strings
+        values = value if isinstance(value, (list, tuple)) else [value]
+        return ["true" if v is True else "false" if v is False else str(v) for v in values]
+
+    @staticmethod
+    def validate(parameterMap):
+        # returns the list of problems of a parameter map
+        errors = [f"{key} is missing" for key in REQUIRED if key not in parameterMap]
+        for key, values in parameterMap.items():
+            if key not in SCHEMA:
+                continue
+            kind, allowed = SCHEMA[key]
+            for value in values:
+                if kind == "int" and not value.lstrip("-").isdigit():
+                    errors.append(f"{key} must be an integer, got {value}")
+                elif kind == "float":
+                    try:
+                        float(value)
+                    except ValueError:
+                        errors.append(f"{key} must be a number, got {value}")
+                elif kind == "bool" and value not in ("true", "false"):
+                    errors.append(f"{key} must be true or false, got {value}")
+                if allowed is not None and value not in allowed:
+                    errors.append(f"{key} must be one of {sorted(allowed)}, got {value}")
+
+        nResolutions = parameterMap.get("NumberOfResolutions", ["1"])[0]
+        nResolutions = int(nResolutions) if nResolutions.isdigit() else 1
+        for key in PER_RESOLUTION & set(parameterMap):
+            allowedLengths = {nResolutions, nResolutions * DIMENSION} if "Schedule" in key else {1, nResolutions}
+            if len(parameterMap[key]) not in allowedLengths:
+                errors.append(f"{key} has {len(parameterMap[key])} values, expected {sorted(allowedLengths)} for {nResolutions} resolutions")
+        for key in PER_AXIS & set(parameterMap):
+            if len(parameterMap[key]) not in (1, DIMENSION):
+                errors.append(f"{key} has {len(parameterMap[key])} values, expected 1 or {DIMENSION}")
+        return errors
+
+    @staticmethod
+    def hashOf(parameterMaps, length=12):
+        # content hash of built maps, the parameterHash of the result store for presets
+        return hashlib.sha1(json.dumps(parameterMaps, sort_keys=True).encode()).hexdigest()[:length]
+
+
+def presetProfile(name, resultStore=None):
+    # latest benchmark of the preset in the result store (run preset_<name>), else the recorded profile
+    if resultStore is not None:
+        runs = resultStore.runs(name=f"preset_{name}")
+        if runs:
+            summary = resultStore.summary(runs[0]["runId"])
+            nCases = len(resultStore.cases(runs[0]["runId"]))
+            minutesPerCase = summary["totalRuntimeSeconds"] / nCases / 60 if summary["totalRuntimeSeconds"] else None
+            return {"minutesPerCase": minutesPerCase, "meanTre": summary["meanTre"], "stdTre": summary["stdTre"], "source": f"result store run {runs[0]['runId']} ({runs[0]['created']})"}
+    return PRESET_PROFILES.get(name)
+
+
+def benchmarkPresets(presets, datasetDirectory="data", outputDirectory="results", imageNumbers=(1, 2, 3, 4), numberOfWorkers=1):
+    # registers and evaluates the cases with each preset, stored as preset_<name> runs of the result store
+    from main import COPDgene
+    runIds = {}
+    for name in presets:
+        copdgene = COPDgene(datasetDirectory, os.path.join(outputDirectory, f"preset_{name}"), None, preset=name)
+        copdgene.registerCases(list(imageNumbers), segmentation=True, numberOfWorkers=numberOfWorkers)
+        for imageNumber in imageNumbers:
+            copdgene.predictCase(imageNumber)
+        runIds[name] = copdgene.evaluateTrain(f"preset_{name}", list(imageNumbers))
+        print(copdgene.resultStore.report([runIds[name]]))
+    return runIds
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="List, write or benchmark the parameter presets.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("list", help="presets with their runtime/TRE profile")
+    writeParser = subparsers.add_parser("write", help="write a preset as parameter files")
+    writeParser.add_argument("preset", choices=list(PRESETS))
+    writeParser.add_argument("folder")
+    benchmarkParser = subparsers.add_parser("benchmark", help="register and evaluate COPD1-4 with presets, stored as preset_<name> runs")
+    benchmarkParser.add_argument("--presets", nargs="+", default=list(PRESETS), choices=list(PRESETS))
+    benchmarkParser.add_argument("--data", default="data")
+    benchmarkParser.add_argument("--output", default="results")
+    args = parser.parse_args()
+
+    if args.command == "list":
+        from resultStore import ResultStore
+        resultStore = ResultStore() if os.path.exists("evaluation/results.sqlite") else None
+        for name in PRESETS:
+            profile = presetProfile(name, resultStore)
+            experimental = " [experimental]" if name in EXPERIMENTAL_PRESETS else ""
+            if profile is None:
+                print(f"{name:>9}{experimental}: not benchmarked yet")
+            else:
+                minutes = f"{profile['minutesPerCase']:.1f} min/case" if profile["minutesPerCase"] is not None else "- min/case"
+                print(f"{name:>9}{experimental}: {minutes}, TRE {profile['meanTre']:.2f} ± {profile['stdTre']:.2f} mm ({profile['source']})")
+    elif args.command == "write":
+        Utils.ensureFolderExists(args.folder)
+        for registrationType, parameterMap in ParameterMapBuilder.fromPreset(args.preset).build():
+            writeParameterMap(parameterMap, os.path.join(args.folder, registrationType + ".txt"))
+    else:
+        benchmarkPresets(args.presets, args.data, args.output)
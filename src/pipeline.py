@@ -0,0 +1,308 @@
+# # -----------------------------------------------------------------------------
+# # Incremental pipeline runner: raw images -> .nii -> masks -> registration -> predictions -> TRE
+# # Date Created: 19-10-2026
+# # -----------------------------------------------------------------------------
+
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from utils import Utils
+
+
+class Task:
+    # a node of the pipeline: action() reads the input files and writes the output files.
+    # parameters are everything else the outputs depend on (must be json serializable)
+    def __init__(self, name, action, inputs=(), outputs=(), parameters=None):
+        self.name = name
+        self.action = action
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.parameters = parameters or {}
+
+
+class Pipeline:
+    # Make-style runner. A task depends on the tasks producing its inputs. It is rerun when one of its outputs
+    # is missing or when the fingerprint of its input contents and parameters changed since its last success.
+    # Because inputs are fingerprinted by content, a rerun upstream task that writes identical files does not
+    # invalidate the tasks after it. Independent tasks run concurrently.
+    util = Utils()
+
+    def __init__(self, stateFile="results/pipeline_state.json", maxWorkers=2):
+        self.stateFile = stateFile
+        self.maxWorkers = maxWorkers
+        self.tasks = {}
+        self.producers = {}
+        self.state = self.loadState()
+
+    def add(self, task):
+        if task.name in self.tasks:
+            raise ValueError(f"Task {task.name} already exists")
+        for output in task.outputs:
+            path = os.path.abspath(output)
+            if path in self.producers:
+                raise ValueError(f"{output} is produced by {self.producers[path]} and {task.name}")
+            self.producers[path] = task.name
+        self.tasks[task.name] = task
+        return task
+
+    #################################
+    ### GRAPH #######################
+    #################################
+
+    def getDependencies(self, task):
+        return {self.producers[os.path.abspath(path)] for path in task.inputs if os.path.abspath(path) in self.producers}
+
+    def selectTasks(self, targets=None):
+        # the targets and everything upstream of them, all tasks by default
+        if not targets:
+            return set(self.tasks)
+        selected = set()
+        stack = list(targets)
+        while stack:
+            name = stack.pop()
+            if name not in self.tasks:
+                raise KeyError(f"Unknown task {name}")
+            if name not in selected:
+                selected.add(name)
+                stack.extend(self.getDependencies(self.tasks[name]))
+        return selected
+
+    #################################
+    ### FINGERPRINTS ################
+    #################################
+
+    def loadState(self):
+        if os.path.exists(self.stateFile):
+            with open(self.stateFile, 'r') as file:
+                return json.load(file)
+        return {"tasks": {}, "files": {}}
+
+    def saveState(self):
+        # written after every finished task, an interrupted run keeps what it already did
+        folderPath = os.path.dirname(self.stateFile)
+        if folderPath:
+            self.util.ensureFolderExists(folderPath)
+        temporaryPath = self.stateFile + ".tmp"
+        with open(temporaryPath, 'w') as file:
+            json.dump(self.state, file, indent=1, sort_keys=True)
+        os.replace(temporaryPath, self.stateFile)
+
+    def hashFile(self, filePath):
+        # content hash, recomputed only when size or modification time changed
+        stat = os.stat(filePath)
+        key = os.path.abspath(filePath)
+        cached = self.state["files"].get(key)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+        digest = hashlib.sha1()
+        with open(filePath, 'rb') as file:
+            for block in iter(lambda: file.read(2**20), b""):
+                digest.update(block)
+        self.state["files"][key] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+        return digest.hexdigest()
+
+    def fingerprint(self, task):
+        missingInputs = [path for path in task.inputs if not os.path.exists(path)]
+        if missingInputs:
+            raise FileNotFoundError(f"{task.name}: missing inputs {missingInputs}")
+        content = {
+            "inputs": {path: self.hashFile(path) for path in sorted(task.inputs)},
+            "parameters": task.parameters,
+        }
+        return hashlib.sha1(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+    def isUpToDate(self, task, fingerprint):
+        if not all(os.path.exists(path) for path in task.outputs):
+            return False
+        return self.state["tasks"].get(task.name) == fingerprint
+
+    #################################
+    ### EXECUTION ###################
+    #################################
+
+    def run(self, targets=None, force=False, dryRun=False):
+        # returns {task name: status}, status is one of done, up to date, would run, failed or blocked.
+        # A dry run does not write the state file
+        selected = self.selectTasks(targets)
+        pending = {name: self.getDependencies(self.tasks[name]) & selected for name in selected}
+        statuses = {}
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=self.maxWorkers) as executor:
+            while pending or running:
+                for name in self.getReadyTasks(pending, statuses):
+                    task = self.tasks[name]
+                    dependencyStatuses = {statuses[dependency] for dependency in self.getDependencies(task) & selected}
+                    if dependencyStatuses & {"failed", "blocked"}:
+                        statuses[name] = "blocked"
+                    elif dryRun and "would run" in dependencyStatuses:
+                        statuses[name] = "would run"
+                    else:
+                        try:
+                            fingerprint = self.fingerprint(task)
+                        except FileNotFoundError as e:
+                            statuses[name] = "failed"
+                            print(f"[failed] {e}")
+                            continue
+                        if not force and self.isUpToDate(task, fingerprint):
+                            statuses[name] = "up to date"
+                        elif dryRun:
+                            statuses[name] = "would run"
+                        else:
+                            print(f"[run] {name}")
+                            running[executor.submit(self.execute, task)] = (name, fingerprint)
+                            continue
+                    print(f"[{statuses[name]}] {name}")
+
+                if not running:
+                    if pending and not self.getReadyTasks(pending, statuses, remove=False):
+                        raise RuntimeError(f"Dependency cycle between {sorted(pending)}")
+                    continue
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name, fingerprint = running.pop(future)
+                    try:
+                        seconds = future.result()
+                    except Exception as e:
+                        statuses[name] = "failed"
+                        print(f"[failed] {name}: {e}")
+                        continue
+                    statuses[name] = "done"
+                    self.state["tasks"][name] = fingerprint
+                    self.saveState()
+                    print(f"[done] {name} ({seconds:.1f}s)")
+
+        if not dryRun:
+            self.saveState()
+        return statuses
+
+    @staticmethod
+    def getReadyTasks(pending, statuses, remove=True):
+        # tasks whose dependencies all have a status, removed from pending
+        ready = [name for name, dependencies in pending.items() if all(dependency in statuses for dependency in dependencies)]
+        if remove:
+            for name in ready:
+                del pending[name]
+        return sorted(ready)
+
+    @staticmethod
+    def execute(task):
+        for output in task.outputs:
+            folderPath = os.path.dirname(output)
+            if folderPath:
+                os.makedirs(folderPath, exist_ok=True)
+        startTime = time.perf_counter()
+        task.action()
+        missingOutputs = [path for path in task.outputs if not os.path.exists(path)]
+        if missingOutputs:
+            raise FileNotFoundError(f"{task.name} did not write {missingOutputs}")
+        return time.perf_counter() - startTime
+
+
+#################################
+### COPDGENE PIPELINE ###########
+#################################
+
+# the code of segmentation/main.py, a changed threshold in these files makes the masks outdated
+SEGMENTATION_SOURCES = ["main.py", "lungSegmentation.py", "preprocessing.py", "postprocessing.py", "streamingSegmentation.py"]
+
+def buildCOPDgenePipeline(copdgene, resultName, imageNumbers=(1, 2, 3, 4), segmentation=True, streaming=False, warmStartDirectory=None, maxWorkers=2):
+    # raw .img -> .nii -> segmentation -> registration -> prediction -> TRE, per case where possible
+    from openImages import IMAGE_CASES, convertImage
+    from parameterMaps import ParameterMapBuilder
+    datasetDirectory = copdgene.datasetDirectory
+    pipeline = Pipeline(os.path.join(copdgene.outputDirectory, "pipeline_state.json"), maxWorkers=maxWorkers)
+    parameterFiles = sorted(copdgene.utils.getAllFiles(copdgene.parameterFolder)) if not copdgene.preset else []
+    segmentationDirectory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "segmentation")
+    segmentationSources = [os.path.join(segmentationDirectory, fileName) for fileName in SEGMENTATION_SOURCES]
+
+    for imageNumber in imageNumbers:
+        caseName = f"copd{imageNumber}"
+        for status in ["i", "e"]:
+            imageName = f"{caseName}_{status}BHCT"
+            niftiPath = os.path.join(datasetDirectory, caseName, imageName + ".nii")
+
+            # raw images are only converted when they exist, otherwise the .nii is a source
+            for case in IMAGE_CASES:
+                if os.path.basename(case["out_file_name"]) == imageName + ".nii":
+                    rebasedCase = dict(case, raw_file_name=os.path.join(datasetDirectory, caseName, imageName + ".img"), out_file_name=niftiPath)
+                    if os.path.exists(rebasedCase["raw_file_name"]):
+                        pipeline.add(Task(
+                            f"convert:{imageName}", lambda rebasedCase=rebasedCase: convertImage(rebasedCase),
+                            inputs=[rebasedCase["raw_file_name"]], outputs=[niftiPath],
+                            parameters={"sz": case["sz"], "spacing": case["spacing"], "big_endian": case["big_endian"]}))
+
+            if segmentation:
+                command = copdgene.getSegmentationCommand(imageNumber, status, streaming)
+                segmentedPath = command[command.index("--segmented") + 1]
+                maskPath = command[command.index("--mask") + 1]
+                pipeline.add(Task(
+                    f"segment:{imageName}", lambda command=command: subprocess.run(command, check=True),
+                    inputs=[niftiPath] + segmentationSources, outputs=[segmentedPath, maskPath], parameters={"streaming": streaming}))
+
+        paths = copdgene.initRegistrationPathsDict(imageNumber, segmentation)
+        registrationInputs = [paths["fixedImagePath"], paths["movingImagePath"], paths["pointFilePath"]] + parameterFiles
+        if warmStartDirectory:
+            registrationInputs.append(copdgene.getWarmStartPath(warmStartDirectory, imageNumber))
+        adaptiveParameters = copdgene.parameterGenerator is not None
+        keypoints = copdgene.keypointMatcher is not None
+        if adaptiveParameters and segmentation:
+            # the adapted maps depend on the lung mask
+            registrationInputs.append(copdgene.getMaskPath(imageNumber))
+        if keypoints and segmentation:
+            registrationInputs += [copdgene.getMaskPath(imageNumber, "i"), copdgene.getMaskPath(imageNumber, "e")]
+        pipeline.add(Task(
+            f"register:{caseName}", lambda imageNumber=imageNumber: copdgene.registerCase(imageNumber, segmentation, warmStartDirectory),
+            inputs=registrationInputs, outputs=[copdgene.getOutputPointsPath(imageNumber)],
+            # the maps of a preset are defined in parameterMaps.py, not in files, their hash stands in for the files
+            parameters={"segmentation": segmentation, "warmStart": bool(warmStartDirectory), "adaptiveParameters": adaptiveParameters, "preset": copdgene.preset,
+                        "parameterMaps": ParameterMapBuilder.hashOf(copdgene.parameterMaps),
+                        "keypoints": [copdgene.keypointWeight, copdgene.keypointDroppedResolutions] if keypoints else None}))
+
+        pipeline.add(Task(
+            f"predict:{caseName}", lambda imageNumber=imageNumber: copdgene.predictCase(imageNumber),
+            inputs=[copdgene.getOutputPointsPath(imageNumber)], outputs=[copdgene.getPredictionPath(imageNumber)]))
+
+    pipeline.add(Task(
+        "evaluate", lambda: copdgene.evaluateTrain(resultName, list(imageNumbers)),
+        inputs=[copdgene.getPredictionPath(n) for n in imageNumbers] + [copdgene.getGroundTruthPath(n) for n in imageNumbers],
+        outputs=[copdgene.getTrePath(resultName)], parameters={"resultName": resultName}))
+    return pipeline
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the COPDgene pipeline, only the steps whose inputs or parameters changed.")
+    parser.add_argument("--data", default="data")
+    parser.add_argument("--output", default="results")
+    parser.add_argument("--parameters", default="customParameters", help="elastix parameter folder")
+    parser.add_argument("--preset", default=None, choices=["fast", "balanced", "accurate"], help="parameter preset instead of the folder")
+    parser.add_argument("--name", default="NAME_OF_THE_TEST", help="name of the evaluation run")
+    parser.add_argument("--cases", type=int, nargs="+", default=[1, 2, 3, 4])
+    parser.add_argument("--no-segmentation", action="store_true", help="register the full scans")
+    parser.add_argument("--streaming", action="store_true", help="bounded memory segmentation")
+    parser.add_argument("--warm-start", default=None, help="folder with voxelmorph flow_copd<N>.nii.gz fields")
+    parser.add_argument("--adaptive-parameters", action="store_true", help="adapt pyramid, grid spacing and samples to each case (parameterGenerator.py)")
+    parser.add_argument("--keypoints", type=float, default=None, metavar="WEIGHT", help="add keypoint correspondences with this metric weight (keypoints.py)")
+    parser.add_argument("--keypoint-dropped-resolutions", type=int, default=0, help="coarse resolutions skipped with keypoints")
+    parser.add_argument("--workers", type=int, default=2, help="tasks running at the same time")
+    parser.add_argument("--targets", nargs="+", default=None, help="e.g. register:copd1, all tasks by default")
+    parser.add_argument("--force", action="store_true", help="rerun the selected tasks even if up to date")
+    parser.add_argument("--dry-run", action="store_true", help="only list what would run")
+    args = parser.parse_args()
+
+    from main import COPDgene
+    copdgene = COPDgene(args.data, args.output, args.parameters, adaptiveParameters=args.adaptive_parameters, preset=args.preset,
+                        keypoints=args.keypoints is not None, keypointWeight=args.keypoints if args.keypoints is not None else 0.1, keypointDroppedResolutions=args.keypoint_dropped_resolutions)
+    pipeline = buildCOPDgenePipeline(copdgene, args.name, args.cases, segmentation=not args.no_segmentation, streaming=args.streaming, warmStartDirectory=args.warm_start, maxWorkers=args.workers)
+    statuses = pipeline.run(args.targets, force=args.force, dryRun=args.dry_run)
+    if statuses.get("evaluate") == "done":
+        print(copdgene.resultStore.report([copdgene.resultStore.latestRunId(args.name)]))
+    if "failed" in statuses.values():
+        sys.exit(1)
@@ -6,23 +6,40 @@
 
 import itk # itk-elastix
 import numpy as np
+import nibabel as nib
 import os
+import time
 import logging
 
 from utils import Utils
 from preprocessing import Preprocessing
+from evaluation import Evaluation
+from deformationAnalysis import TransformChain
+from parameterMaps import ParameterMapBuilder, writeParameterMap, PER_AXIS
 
 class Registration:
 
     util = Utils()
 
-    def __init__(self, parameterFolder, outputDirectory="outputDirectory", usePreprocessing=False, storeTransformParameterMaps=True, storeImage=True, storePointFile=False, logToConsole=False):
+    def __init__(self, parameterFolder, outputDirectory="outputDirectory", usePreprocessing=False, storeTransformParameterMaps=True, storeImage=True, storePointFile=False, logToConsole=False, warmStartResolutions=2, warmStartIterationFactor=0.25, volumeCache=None, convergenceMonitor=None, parameterMaps=None, outputWriter=None):
         # SETTINGS
         self.parameterFolder = parameterFolder
+        # parameterMaps: a preset name (fast, balanced, accurate), a folder or maps of parameterMaps.py, read and validated once.
+        # Without it the files of parameterFolder are read for every registration
+        self.parameterMaps = ParameterMapBuilder.resolve(parameterMaps) if parameterMaps is not None else None
         self.outputDirectory = outputDirectory
         self.storeTransformParameterMaps = storeTransformParameterMaps
         self.storeImage = storeImage
         self.storePointFile = storePointFile
+        # schedule used when an initial displacement field is given: finest resolutions only, fewer iterations
+        self.warmStartResolutions = warmStartResolutions
+        self.warmStartIterationFactor = warmStartIterationFactor
+        # optional SharedVolumeCache (volumeCache.py): images are decoded once per node and attached from shared memory
+        self.volumeCache = volumeCache
+        # optional ConvergenceMonitor (convergenceMonitor.py): metric and TRE at the end of each resolution / every K iterations
+        self.convergenceMonitor = convergenceMonitor
+        # optional OutputWriter (outputWriter.py): transform maps and warped image are written in the background
+        self.outputWriter = outputWriter
 
         # FUNCTION CALLS
         self.initLogging(logToConsole)
@@ -48,31 +65,253 @@ class Registration:
             registrationTypeList.append(os.path.basename(parameterPath).split(".")[0])
         return parameterObject, registrationTypeList
 
-    def register(self, fixedImagePath, movingImagePath, pointFilePath=None):
-        # registers an image
-        fixedImage = self.util.loadImageFrom(fixedImagePath)
-        movingImage = self.util.loadImageFrom(movingImagePath)
-        parameterObject, self.registrationTypeList = self.initParamaterObject(self.parameterFolder)
+    @staticmethod
+    def initParameterObjectFrom(parameterMaps):
+        # initializes a parameter object with in-memory maps [(registration type, {key: [values]})] in application order
+        parameterObject = itk.ParameterObject.New()
+        registrationTypeList = []
+        for i, (registrationType, parameterMap) in enumerate(parameterMaps):
+            parameterObject.AddParameterMap(parameterMap)
+            logging.info(f"Successfully loaded the {registrationType} map. Application order: {i+1}.")
+            registrationTypeList.append(registrationType)
+        return parameterObject, registrationTypeList
+
+    def register(self, fixedImagePath, movingImagePath, pointFilePath=None, initialDisplacementField=None, parameterMaps=None, correspondences=None, initialTransform=None):
+        # registers an image. initialDisplacementField (e.g. a Voxelmorph flow, see voxelmorph/inference.py) warm starts the registration.
+        # parameterMaps (e.g. of parameterGenerator.py) replace the files of the parameter folder for this registration.
+        # correspondences: (fixed, moving) point files of keypoints.py for maps with CorrespondingPointsEuclideanDistanceMetric.
+        # initialTransform: elastix transform file (e.g. the last file of a chain of fourDCT.py) warm starting the registration
+        if self.volumeCache is None:
+            return self.registerImages(self.util.loadImageFrom(fixedImagePath), self.util.loadImageFrom(movingImagePath), fixedImagePath, movingImagePath, pointFilePath, initialDisplacementField, parameterMaps, correspondences, initialTransform)
+        # the shared volumes are released once the images viewing them are gone
+        with self.volumeCache.volume(fixedImagePath) as fixedVolume, self.volumeCache.volume(movingImagePath) as movingVolume:
+            return self.registerImages(fixedVolume.toItkImage(), movingVolume.toItkImage(), fixedImagePath, movingImagePath, pointFilePath, initialDisplacementField, parameterMaps, correspondences, initialTransform)
+
+    def registerImages(self, fixedImage, movingImage, fixedImagePath, movingImagePath, pointFilePath=None, initialDisplacementField=None, parameterMaps=None, correspondences=None, initialTransform=None):
+        parameterMaps = parameterMaps if parameterMaps is not None else self.parameterMaps
+        if parameterMaps is None:
+            parameterObject, self.registrationTypeList = self.initParamaterObject(self.parameterFolder)
+        else:
+            parameterObject, self.registrationTypeList = self.initParameterObjectFrom(parameterMaps)
 
         if self.usePreprocessing:
             logging.info(f"Applying Preprocessing.")
             fixedImage = self.applyPreprocessing(fixedImage)
             movingImage = self.applyPreprocessing(movingImage)
 
+        initialTransformPath = None
+        if initialDisplacementField is not None:
+            initialTransformPath = self.createInitialTransformFrom(initialDisplacementField, fixedImage, movingImagePath)
+            parameterObject = self.reduceSchedule(parameterObject)
+        elif initialTransform is not None:
+            initialTransformPath = initialTransform
+            parameterObject = self.reduceSchedule(parameterObject)
+
         logging.info(f"registering {movingImagePath} to {fixedImagePath}.")
-        resultImage, resultTransformParameters = itk.elastix_registration_method(fixedImage, movingImage, parameter_object=parameterObject, log_to_console=True)
+        if self.convergenceMonitor is None:
+            resultImage, resultTransformParameters = self.runElastix(fixedImage, movingImage, parameterObject, initialTransformPath, correspondences=correspondences)
+        else:
+            resultImage, resultTransformParameters = self.runMonitoredElastix(fixedImage, movingImage, parameterObject, initialTransformPath, pointFilePath, correspondences)
         logging.info(f"registered {movingImagePath} to {fixedImagePath}.")
 
+        if self.outputWriter is not None:
+            self.submitOutputs(resultImage, resultTransformParameters, movingImagePath)
+        else:
+            if self.storeTransformParameterMaps:
+                self.safeTransformParameterObject(resultTransformParameters, movingImagePath)
 
-        if self.storeTransformParameterMaps:
-            self.safeTransformParameterObject(resultTransformParameters, movingImagePath)
-
-        if self.storeImage:
-            self.safeImage(resultImage, movingImagePath)
+            if self.storeImage:
+                self.safeImage(resultImage, movingImagePath)
 
+        # the points stay on the calling thread: they are small, evaluated right away, and transformix needs the
+        # moving image, which may view a shared volume that is released once register returns
         if self.storePointFile:
             self.safeTransformedPointFile(pointFilePath, movingImage, resultTransformParameters)
 
+    @staticmethod
+    def runElastix(fixedImage, movingImage, parameterObject, initialTransformPath=None, outputDirectory=None, correspondences=None):
+        arguments = {"parameter_object": parameterObject, "log_to_console": True}
+        if initialTransformPath is not None:
+            arguments["initial_transform_parameter_file_name"] = initialTransformPath
+        if correspondences is not None:
+            arguments["fixed_point_set_file_name"], arguments["moving_point_set_file_name"] = correspondences
+        if outputDirectory is not None:
+            arguments["output_directory"] = outputDirectory
+        return itk.elastix_registration_method(fixedImage, movingImage, **arguments)
+
+    def runMonitoredElastix(self, fixedImage, movingImage, parameterObject, initialTransformPath, pointFilePath, correspondences=None):
+        # elastix writes its intermediate transforms into the monitor folder, evaluated once the registration is done
+        monitor = self.convergenceMonitor
+        parameterObject = monitor.prepare(parameterObject)
+        monitor.start()
+        try:
+            result = self.runElastix(fixedImage, movingImage, parameterObject, initialTransformPath, monitor.outputDirectory, correspondences)
+        finally:
+            monitor.stop()
+        monitor.collect(pointFilePath, self.registrationTypeList)
+        logging.info(f"Saved convergence table as {monitor.writeCsv()} and report as {monitor.writeReport()}.")
+        return result
+
+    #################################
+    ### WARM START ##################
+    #################################
+
+    def createInitialTransformFrom(self, displacementField, fixedImage, movingImagePath):
+        # stores a dense displacement field (x,y,z,3 in voxels of the fixed image, a .nii path or an array) as an
+        # elastix DeformationFieldTransform. The files stay next to the transform parameter maps, transformix needs them.
+        if isinstance(displacementField, str):
+            displacementField = np.asarray(nib.load(displacementField).dataobj, dtype=np.float32)
+        spacing = np.array(fixedImage.GetSpacing(), dtype=np.float64)
+        direction = itk.array_from_matrix(fixedImage.GetDirection())
+        # voxel displacement -> physical displacement, array axes (x,y,z) -> itk array axes (z,y,x)
+        physicalField = (displacementField * spacing) @ direction.T
+        fieldImage = itk.GetImageFromArray(np.ascontiguousarray(np.transpose(physicalField, (2, 1, 0, 3)), dtype=np.float32), is_vector=True)
+        fieldImage.SetSpacing(fixedImage.GetSpacing())
+        fieldImage.SetOrigin(fixedImage.GetOrigin())
+        fieldImage.SetDirection(fixedImage.GetDirection())
+
+        imageName, _ = self.util.splitNameFromExtension(movingImagePath)
+        folderPath = os.path.join(self.outputDirectory, "transformParameterMaps")
+        self.util.ensureFolderExists(folderPath)
+        fieldPath = os.path.abspath(os.path.join(folderPath, imageName + "_initialField.mhd"))
+        itk.imwrite(fieldImage, fieldPath)
+
+        transformPath = os.path.abspath(os.path.join(folderPath, imageName + "_initialTransform.txt"))
+        size = " ".join(str(s) for s in fixedImage.GetLargestPossibleRegion().GetSize())
+        with open(transformPath, 'w') as file:
+            file.write('(Transform "DeformationFieldTransform")\n')
+            file.write(f'(DeformationFieldFileName "{fieldPath}")\n')
+            file.write('(DeformationFieldInterpolationOrder 1)\n')
+            file.write('(NumberOfParameters 0)\n')
+            file.write('(InitialTransformParametersFileName "NoInitialTransform")\n')
+            file.write('(HowToCombineTransforms "Compose")\n')
+            file.write('(FixedImageDimension 3)\n(MovingImageDimension 3)\n')
+            file.write('(FixedInternalImagePixelType "float")\n(MovingInternalImagePixelType "float")\n')
+            file.write(f'(Size {size})\n(Index 0 0 0)\n')
+            file.write(f'(Spacing {" ".join(str(s) for s in fixedImage.GetSpacing())})\n')
+            file.write(f'(Origin {" ".join(str(o) for o in fixedImage.GetOrigin())})\n')
+            file.write(f'(Direction {" ".join(str(d) for d in direction.T.flatten())})\n')
+            file.write('(UseDirectionCosines "true")\n')
+        logging.info(f"Saved initial displacement field as {fieldPath}.")
+        return transformPath
+
+    def reduceSchedule(self, parameterObject):
+        # keeps the finest warmStartResolutions resolutions and scales the iterations by warmStartIterationFactor.
+        # The automatic initialization is disabled, it would discard the initial transform's alignment.
+        for index in range(parameterObject.GetNumberOfParameterMaps()):
+            parameterMap = self.keepFinestResolutions(dict(parameterObject.GetParameterMap(index)), self.warmStartResolutions, self.warmStartIterationFactor)
+            parameterMap["AutomaticTransformInitialization"] = ["false"]
+            parameterObject.SetParameterMap(index, parameterMap)
+            logging.info(f"Warm start schedule for map {index+1}: {parameterMap['NumberOfResolutions'][0]} resolutions, iterations {parameterMap.get('MaximumNumberOfIterations')}.")
+        return parameterObject
+
+    @staticmethod
+    def keepFinestResolutions(parameterMap, nResolutionsKept, iterationFactor=1.0):
+        # removes the coarsest resolutions of a parameter map and scales its iterations. Every option with one value
+        # per resolution is trimmed (NumberOfSpatialSamples, SP_a, Metric0Weight, ...): the numeric or true/false
+        # options with NumberOfResolutions values, except the per axis ones. Lists of components such as the
+        # Metric of a multi-metric registration are not values per resolution and stay as they are
+        nResolutions = int(parameterMap.get("NumberOfResolutions", ("1",))[0])
+        nKept = min(nResolutionsKept, nResolutions)
+        if "MaximumNumberOfIterations" in parameterMap:
+            parameterMap["MaximumNumberOfIterations"] = [str(max(1, int(float(value) * iterationFactor))) for value in parameterMap["MaximumNumberOfIterations"]]
+        for key, values in parameterMap.items():
+            if key.endswith("Schedule") and len(values) % nResolutions == 0:
+                valuesPerResolution = len(values) // nResolutions
+                parameterMap[key] = values[-nKept * valuesPerResolution:]
+            elif len(values) == nResolutions > 1 and key not in PER_AXIS and all(Registration.isOptionValue(value) for value in values):
+                parameterMap[key] = values[-nKept:]
+        parameterMap["NumberOfResolutions"] = [str(nKept)]
+        return parameterMap
+
+    @staticmethod
+    def isOptionValue(value):
+        # a number or true/false, not the name of a component
+        if str(value).lower() in ("true", "false"):
+            return True
+        try:
+            float(value)
+            return True
+        except ValueError:
+            return False
+
+    #################################
+    ### PREVIEW #####################
+    #################################
+
+    def preview(self, fixedImagePath, movingImagePath, pointFilePath, groundTruthPointPath=None, factor=4, resolutions=2, iterationFactor=0.2, maximumSamples=5000, parameterMaps=None):
+        # approximate registration on images downsampled by factor (in-plane, the slice axis follows the physical
+        # resolution). The trimmed maps run on the small images, the transform is physical and is stored with the
+        # native geometry in outputDirectory/preview. Returns the warped landmarks (fixed grid indices), and with
+        # groundTruthPointPath the landmark errors and TRE in mm
+        settings = (pointFilePath, groundTruthPointPath, factor, resolutions, iterationFactor, maximumSamples, parameterMaps)
+        if self.volumeCache is None:
+            return self.previewImages(self.util.loadImageFrom(fixedImagePath), self.util.loadImageFrom(movingImagePath), *settings)
+        with self.volumeCache.volume(fixedImagePath) as fixedVolume, self.volumeCache.volume(movingImagePath) as movingVolume:
+            return self.previewImages(fixedVolume.toItkImage(), movingVolume.toItkImage(), *settings)
+
+    def previewImages(self, fixedImage, movingImage, pointFilePath, groundTruthPointPath=None, factor=4, resolutions=2, iterationFactor=0.2, maximumSamples=5000, parameterMaps=None):
+        startTime = time.perf_counter()
+        nativeGeometry = self.geometryOf(fixedImage)
+        fixedImage, movingImage = self.downsample(fixedImage, factor), self.downsample(movingImage, factor)
+
+        parameterMaps = parameterMaps if parameterMaps is not None else self.parameterMaps
+        if parameterMaps is None:
+            parameterObject, registrationTypeList = self.initParamaterObject(self.parameterFolder)
+        else:
+            parameterObject, registrationTypeList = self.initParameterObjectFrom(parameterMaps)
+        for index in range(parameterObject.GetNumberOfParameterMaps()):
+            parameterMap = self.keepFinestResolutions(dict(parameterObject.GetParameterMap(index)), resolutions, iterationFactor)
+            if "NumberOfSpatialSamples" in parameterMap:
+                parameterMap["NumberOfSpatialSamples"] = [str(min(int(float(value)), maximumSamples)) for value in parameterMap["NumberOfSpatialSamples"]]
+            parameterMap["WriteResultImage"] = ["false"]
+            parameterObject.SetParameterMap(index, parameterMap)
+
+        logging.info(f"preview registration at 1/{factor} resolution.")
+        _, resultTransformParameters = self.runElastix(fixedImage, movingImage, parameterObject)
+
+        folderPath = os.path.join(self.outputDirectory, "preview")
+        self.util.ensureFolderExists(folderPath)
+        parameterFiles = []
+        for index in range(resultTransformParameters.GetNumberOfParameterMaps()):
+            parameterMap = dict(resultTransformParameters.GetParameterMap(index))
+            parameterMap.update(nativeGeometry)
+            parameterFiles.append(os.path.join(folderPath, f"{index}_{registrationTypeList[index]}.txt"))
+            resultTransformParameters.WriteParameterFile(parameterMap, parameterFiles[-1])
+
+        # landmarks warped in memory, same convention as the OutputIndexFixed of transformix (without rounding)
+        chain = TransformChain(parameterFiles)
+        fixedLandmarks = np.asarray(Evaluation.readPointsFromFile(pointFilePath), dtype=np.float64)
+        result = {"points": chain.indicesOf(chain.transformPoints(chain.pointsOf(fixedLandmarks)))}
+        if groundTruthPointPath:
+            groundTruth = np.asarray(Evaluation.readPointsFromFile(groundTruthPointPath), dtype=np.float64)
+            nPoints = min(len(groundTruth), len(result["points"]))
+            result["landmarkErrors"] = np.linalg.norm((result["points"][:nPoints] - groundTruth[:nPoints]) * chain.spacing, axis=1)
+            result["tre"] = float(np.mean(result["landmarkErrors"]))
+        result["seconds"] = time.perf_counter() - startTime
+        logging.info(f"preview finished in {result['seconds']:.1f}s.")
+        return result
+
+    @staticmethod
+    def downsample(image, factor):
+        # block averaging (anti-aliased). The origin moves to the centre of the first block and trailing voxels that
+        # do not fill a whole block are dropped, so origin and extent differ slightly from the input image. The
+        # preview transforms are physical, they do not depend on either
+        spacing = np.array(image.GetSpacing(), dtype=np.float64)
+        shrinkFactors = [int(s) for s in np.maximum(1, np.round(factor * spacing.min() / spacing))]
+        return itk.bin_shrink_image_filter(image, shrink_factors=shrinkFactors)
+
+    @staticmethod
+    def geometryOf(image):
+        # the fixed image entries of a transform parameter map
+        return {
+            "Size": [str(s) for s in image.GetLargestPossibleRegion().GetSize()],
+            "Index": ["0", "0", "0"],
+            "Spacing": [str(s) for s in image.GetSpacing()],
+            "Origin": [str(o) for o in image.GetOrigin()],
+            "Direction": [str(d) for d in itk.array_from_matrix(image.GetDirection()).T.flatten()],
+        }
+
     #################################
     ### PREPROCESSING ###############
     #################################
@@ -114,6 +353,35 @@ class Registration:
             logging.info(f"Saved Parametermap as {fileName} in {folderPath}.")
 
 
+    def submitOutputs(self, resultImage, resultTransformParameters, movingImagePath):
+        # hands the transform maps and the warped image to the output writer. The maps, the registration types and
+        # the output folder are copied here, the next registration may change them before the writer runs
+        transformMaps = []
+        if self.storeTransformParameterMaps and self.outputWriter.keeps("transforms"):
+            nParameterMaps = resultTransformParameters.GetNumberOfParameterMaps()
+            for index in range(nParameterMaps):
+                parameterMap = {key: [str(value) for value in values] for key, values in dict(resultTransformParameters.GetParameterMap(index)).items()}
+                if index == nParameterMaps - 1:
+                    parameterMap['FinalBSplineInterpolationOrder'] = ["0"]
+                transformMaps.append((self.registrationTypeList[index], parameterMap))
+        image = resultImage if self.storeImage and self.outputWriter.keeps("images") else None
+        self.outputWriter.submit(self.writeOutputs, image, transformMaps, movingImagePath, self.outputDirectory)
+
+    def writeOutputs(self, image, transformMaps, movingImagePath, outputDirectory):
+        # runs on a thread of the output writer
+        imageName, _ = self.util.splitNameFromExtension(movingImagePath)
+        folderPath = os.path.join(outputDirectory, "transformParameterMaps")
+        for registrationType, parameterMap in transformMaps:
+            self.util.ensureFolderExists(folderPath)
+            writeParameterMap(parameterMap, os.path.join(folderPath, imageName + "_" + registrationType + ".txt"))
+        if transformMaps:
+            logging.info(f"Saved {len(transformMaps)} Parametermaps in {folderPath}.")
+
+        if image is not None:
+            imagePath = os.path.join(outputDirectory, imageName + "_registered" + self.outputWriter.imageExtension)
+            self.outputWriter.writeImage(itk.GetArrayViewFromImage(image), image.GetSpacing(), image.GetOrigin(), itk.array_from_matrix(image.GetDirection()), imagePath)
+            logging.info(f"Saved registed image as {os.path.basename(imagePath)} in {outputDirectory}.")
+
     def safeImage(self, image, movingImagePath):
         # safes image in output directory
         name, extension = self.util.splitNameFromExtension(movingImagePath)
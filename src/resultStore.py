@@ -0,0 +1,183 @@
+# # -----------------------------------------------------------------------------
+# # Persistent SQLite store of registration runs, per-landmark errors and timings
+# # Date Created: 19-10-2026
+# # -----------------------------------------------------------------------------
+
+import sqlite3
+import hashlib
+import datetime
+import os
+import numpy as np
+
+from utils import Utils
+
+class ResultStore:
+    util = Utils()
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS runs (
+            runId INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            created TEXT NOT NULL,
+            parameterHash TEXT,
+            datasetVersion TEXT,
+            parameterFolder TEXT
+        );
+        CREATE TABLE IF NOT EXISTS cases (
+            runId INTEGER NOT NULL REFERENCES runs(runId) ON DELETE CASCADE,
+            caseName TEXT NOT NULL,
+            meanTre REAL,
+            stdTre REAL,
+            maxTre REAL,
+            runtimeSeconds REAL,
+            peakMemoryMB REAL,
+            PRIMARY KEY (runId, caseName)
+        );
+        CREATE TABLE IF NOT EXISTS landmarks (
+            runId INTEGER NOT NULL REFERENCES runs(runId) ON DELETE CASCADE,
+            caseName TEXT NOT NULL,
+            landmark INTEGER NOT NULL,
+            errorMM REAL NOT NULL,
+            PRIMARY KEY (runId, caseName, landmark)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS runsByName ON runs(name);
+        CREATE INDEX IF NOT EXISTS runsByParameterHash ON runs(parameterHash);
+        CREATE INDEX IF NOT EXISTS casesByCaseName ON cases(caseName, meanTre);
+    """
+
+    def __init__(self, databasePath="evaluation/results.sqlite"):
+        self.databasePath = databasePath
+        folderPath = os.path.dirname(databasePath)
+        if folderPath:
+            self.util.ensureFolderExists(folderPath)
+        # the connection may be used by a worker thread (pipeline.py), writes are never concurrent
+        self.connection = sqlite3.connect(databasePath, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.executescript(self.SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    #################################
+    ### WRITING #####################
+    #################################
+
+    def addRun(self, name, parameterHash=None, datasetVersion=None, parameterFolder=None):
+        # registers a new run and returns its id. Runs with the same name are kept side by side
+        created = datetime.datetime.now().isoformat(timespec="seconds")
+        with self.connection:
+            cursor = self.connection.execute(
+                "INSERT INTO runs (name, created, parameterHash, datasetVersion, parameterFolder) VALUES (?, ?, ?, ?, ?)",
+                (name, created, parameterHash, datasetVersion, parameterFolder))
+        return cursor.lastrowid
+
+    def addCase(self, runId, caseName, landmarkErrors, runtimeSeconds=None, peakMemoryMB=None):
+        # stores the per-landmark errors (in mm) of a case and its summary
+        errors = np.asarray(landmarkErrors, dtype=float)
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO cases VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (runId, caseName, float(np.mean(errors)), float(np.std(errors)), float(np.max(errors)), runtimeSeconds, peakMemoryMB))
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO landmarks VALUES (?, ?, ?, ?)",
+                ((runId, caseName, index, float(error)) for index, error in enumerate(errors)))
+
+    def deleteRun(self, runId):
+        with self.connection:
+            self.connection.execute("DELETE FROM runs WHERE runId = ?", (runId,))
+
+    #################################
+    ### QUERIES #####################
+    #################################
+
+    def runs(self, name=None, parameterHash=None):
+        # returns the runs as dicts, newest first, optionally filtered
+        query = "SELECT * FROM runs WHERE (? IS NULL OR name = ?) AND (? IS NULL OR parameterHash = ?) ORDER BY runId DESC"
+        rows = self.connection.execute(query, (name, name, parameterHash, parameterHash))
+        return [dict(row) for row in rows]
+
+    def latestRunId(self, name):
+        runs = self.runs(name=name)
+        if not runs:
+            raise ValueError(f"No run named {name} in {self.databasePath}")
+        return runs[0]["runId"]
+
+    def cases(self, runId):
+        rows = self.connection.execute("SELECT * FROM cases WHERE runId = ? ORDER BY caseName", (runId,))
+        return [dict(row) for row in rows]
+
+    def landmarkErrors(self, runId, caseName):
+        rows = self.connection.execute("SELECT errorMM FROM landmarks WHERE runId = ? AND caseName = ? ORDER BY landmark", (runId, caseName))
+        return np.array([row[0] for row in rows])
+
+    def summary(self, runId):
+        # mean and std over the case means, like the csv written by COPDgene.evaluateTrain
+        cases = self.cases(runId)
+        caseMeans = [case["meanTre"] for case in cases]
+        runtimes = [case["runtimeSeconds"] for case in cases if case["runtimeSeconds"] is not None]
+        return {
+            "runId": runId,
+            "meanTre": float(np.mean(caseMeans)) if caseMeans else None,
+            "stdTre": float(np.std(caseMeans)) if caseMeans else None,
+            "totalRuntimeSeconds": float(np.sum(runtimes)) if runtimes else None,
+        }
+
+    def compare(self, runIdA, runIdB):
+        # per case difference of run B against run A, negative deltas mean B is better
+        query = """
+            SELECT a.caseName, a.meanTre AS treA, b.meanTre AS treB, b.meanTre - a.meanTre AS deltaTre,
+                   a.runtimeSeconds AS runtimeA, b.runtimeSeconds AS runtimeB
+            FROM cases a JOIN cases b ON a.caseName = b.caseName
+            WHERE a.runId = ? AND b.runId = ? ORDER BY a.caseName
+        """
+        return [dict(row) for row in self.connection.execute(query, (runIdA, runIdB))]
+
+    def bestRuns(self, limit=10):
+        # runs ranked by their mean TRE over all stored cases
+        query = """
+            SELECT r.runId, r.name, r.parameterHash, AVG(c.meanTre) AS meanTre, SUM(c.runtimeSeconds) AS runtimeSeconds, COUNT(*) AS nCases
+            FROM runs r JOIN cases c ON r.runId = c.runId
+            GROUP BY r.runId ORDER BY meanTre ASC LIMIT ?
+        """
+        return [dict(row) for row in self.connection.execute(query, (limit,))]
+
+    def report(self, runIds):
+        # compact text table with one line per run and one column per case
+        lines = []
+        for runId in runIds:
+            run = dict(self.connection.execute("SELECT * FROM runs WHERE runId = ?", (runId,)).fetchone())
+            cases = " ".join(f"{case['caseName']}={case['meanTre']:.2f}" for case in self.cases(runId))
+            summary = self.summary(runId)
+            meanTre = f"{summary['meanTre']:.2f} ± {summary['stdTre']:.2f}" if summary["meanTre"] is not None else "-"
+            lines.append(f"[{runId}] {run['name']} ({run['created']}, params {run['parameterHash'] or '-'}): {cases} | mean {meanTre}")
+        return "\n".join(lines)
+
+    ################################
+    ### HELPER FUNCTIONS ###########
+    ################################
+
+    @staticmethod
+    def hashFiles(filePaths, length=12):
+        # content hash of a set of files, independent of their order
+        digest = hashlib.sha1()
+        for filePath in sorted(filePaths):
+            digest.update(os.path.basename(filePath).encode())
+            with open(filePath, 'rb') as file:
+                digest.update(file.read())
+        return digest.hexdigest()[:length]
+
+    def hashParameterFolder(self, parameterFolder):
+        return self.hashFiles(self.util.getAllFiles(parameterFolder))
+
+
+
+if __name__ == "__main__":
+    # SETTINGS
+    databasePath = "evaluation/results.sqlite"
+
+    # LIST THE BEST RUNS
+    store = ResultStore(databasePath)
+    best = store.bestRuns()
+    print(store.report([run["runId"] for run in best]))
@@ -0,0 +1,175 @@
+# # -----------------------------------------------------------------------------
+# # Throughput and accuracy benchmark of the lung segmentation on synthetic scans
+# # Date Created: 19-10-2026
+# # -----------------------------------------------------------------------------
+
+import argparse
+import csv
+import os
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import SimpleITK as sitk
+from lungSegmentation import LungSegmentation
+
+
+class SyntheticThorax:
+    # raw intensities of the DIR-Lab scans (HU + 1024)
+    AIR = 20
+    LUNG = 150
+    AIRWAY = 30
+    TISSUE = 1060
+    TABLE = 1200
+
+    def __init__(self, size=256, nSlices=64, spacing=(0.625, 0.625, 2.5), noise=15.0, seed=0):
+        self.size = size
+        self.nSlices = nSlices
+        self.spacing = spacing
+        self.noise = noise
+        self.seed = seed
+
+    def generate(self):
+        # returns a scan (z,y,x) in int16 and the true lung mask in uint8
+        z, y, x = self.normalizedGrid()
+        body = ((x / 0.42)**2 + ((y + 0.05) / 0.30)**2) <= 1
+        table = (np.abs(x) < 0.45) & (y > 0.30) & (y < 0.36)
+        lungs = self.lungMaskOf(z, y, x)
+        airways = self.airwayMaskOf(z, y, x)
+
+        scan = np.full(lungs.shape, self.AIR, dtype="float32")
+        scan[np.broadcast_to(body, scan.shape)] = self.TISSUE
+        scan[np.broadcast_to(table, scan.shape)] = self.TABLE
+        scan[lungs] = self.LUNG
+        scan[airways & ~lungs] = self.AIRWAY
+
+        rng = np.random.default_rng(self.seed)
+        scan += rng.normal(0, self.noise, size=scan.shape).astype("float32")
+        return np.clip(scan, 0, None).astype("int16"), lungs.astype("uint8")
+
+    def normalizedGrid(self):
+        # z in [0,1] from inferior to superior, y and x in [-0.5,0.5]
+        z = np.linspace(0, 1, self.nSlices, dtype="float32")[:, None, None]
+        y = np.linspace(-0.5, 0.5, self.size, dtype="float32")[None, :, None]
+        x = np.linspace(-0.5, 0.5, self.size, dtype="float32")[None, None, :]
+        return z, y, x
+
+    @staticmethod
+    def lungMaskOf(z, y, x):
+        # two half ellipsoids narrowing towards the apex
+        height = np.clip((z - 0.1) / 0.75, 0, 1)
+        radius = np.sqrt(np.clip(1 - height**2, 0, 1)) * (z >= 0.1)
+        lungs = np.zeros(np.broadcast_shapes(z.shape, y.shape, x.shape), dtype=bool)
+        for centerX in (-0.17, 0.17):
+            lungs |= (((x - centerX) / 0.13)**2 + ((y + 0.05) / 0.2)**2) < radius**2
+        return lungs
+
+    @staticmethod
+    def airwayMaskOf(z, y, x):
+        # trachea in the midline splitting into two main bronchi
+        trachea = (x**2 + (y + 0.1)**2 < 0.02**2) & (z > 0.6) & (z < 0.95)
+        bronchi = np.zeros_like(trachea)
+        for side in (-1, 1):
+            centerX = side * (0.6 - z) * 0.9
+            bronchi |= ((x - centerX)**2 + (y + 0.1)**2 < 0.015**2) & (z > 0.45) & (z <= 0.6)
+        return trachea | bronchi
+
+    def writeTo(self, scan, filePath):
+        image = sitk.GetImageFromArray(scan)
+        image.SetSpacing([float(s) for s in self.spacing])
+        sitk.WriteImage(image, filePath)
+
+
+class SegmentationBenchmark:
+    def __init__(self, repeats=1, numberOfWorkers=None):
+        self.repeats = repeats
+        self.numberOfWorkers = numberOfWorkers
+
+    def run(self, phantom):
+        # runs the full segmentation and each stage separately, returns one row per stage
+        scan, trueMask = phantom.generate()
+        with tempfile.TemporaryDirectory() as folder:
+            scanPath = os.path.join(folder, "synthetic.nii")
+            phantom.writeTo(scan, scanPath)
+            lungSeg = LungSegmentation(scanPath, numberOfWorkers=self.numberOfWorkers)
+
+        rows = []
+        for _ in range(self.repeats):
+            rows += self.runStages(lungSeg)
+            rows.append(self.measure("segmentLung", lungSeg.segmentLung))
+            rows[-1]["dice"] = self.dice(rows[-1].pop("result"), trueMask)
+
+        for row in rows:
+            row.pop("result", None)
+            row["shape"] = "x".join(str(s) for s in scan.shape)
+        return rows
+
+    def runStages(self, lungSeg):
+        # mirrors LungSegmentation.segmentLung with one measurement per stage
+        preprocessing = lungSeg.preprocessing
+        scan = lungSeg.scan
+        clipRange = (100, 700)
+        coarse = self.measure("coarseMask", lambda: preprocessing.createMaskOf(preprocessing.clipScanToHounsfieldUnitRange(scan, clipRange)))
+        repair = self.measure("brokenSliceRepair", preprocessing.repairBrokenSlicesOf, coarse["result"])
+        filled = self.measure("axialHoleFilling", preprocessing.fillHolesOfEachAxialSliceOf, repair["result"])
+        contours = self.measure("contourExtraction", lambda: lungSeg.findContoursForEachAxialSliceOf(lungSeg.clipCoarseScan(filled["result"] * scan)))
+        tracking = self.measure("contourTracking", lungSeg.createFineMaskFrom, contours["result"])
+        post = self.measure("postprocessing", lungSeg.postprocessing.postprocessing, tracking["result"])
+        return [coarse, repair, filled, contours, tracking, post]
+
+    @staticmethod
+    def measure(stage, function, *args):
+        # wall time and peak numpy/python memory of a single call
+        tracemalloc.start()
+        start = time.perf_counter()
+        result = function(*args)
+        seconds = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return {"stage": stage, "seconds": seconds, "peakMB": peak / 2**20, "result": result}
+
+    @staticmethod
+    def dice(predictedMask, trueMask):
+        predicted = predictedMask.astype(bool)
+        true = trueMask.astype(bool)
+        total = predicted.sum() + true.sum()
+        if total == 0:
+            return 1.0
+        return 2.0 * np.logical_and(predicted, true).sum() / total
+
+    @staticmethod
+    def writeCsv(rows, filePath):
+        fieldNames = ["shape", "stage", "seconds", "peakMB", "dice"]
+        with open(filePath, mode='w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=fieldNames)
+            writer.writeheader()
+            writer.writerows(rows)
+
+    @staticmethod
+    def printRows(rows):
+        for row in rows:
+            dice = f"{row['dice']:.4f}" if "dice" in row else "-"
+            print(f"{row['shape']:>14} {row['stage']:>18} {row['seconds']:9.3f}s {row['peakMB']:9.1f}MB  dice {dice}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the lung segmentation on synthetic thoracic volumes.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[256, 512], help="in-plane sizes")
+    parser.add_argument("--slices", type=int, default=120, help="number of axial slices")
+    parser.add_argument("--noise", type=float, default=15.0, help="standard deviation of the gaussian noise")
+    parser.add_argument("--repeats", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=None, help="threads of the contour extraction, all cores by default")
+    parser.add_argument("--output", default=None, help="optional csv file for the results")
+    args = parser.parse_args()
+
+    benchmark = SegmentationBenchmark(repeats=args.repeats, numberOfWorkers=args.workers)
+    allRows = []
+    for size in args.sizes:
+        phantom = SyntheticThorax(size=size, nSlices=args.slices, noise=args.noise)
+        rows = benchmark.run(phantom)
+        benchmark.printRows(rows)
+        allRows += rows
+
+    if args.output:
+        benchmark.writeCsv(allRows, args.output)
@@ -6,20 +6,22 @@
 
 from preprocessing import Preprocessing
 from postprocessing import Postprocessing
-from ploting import Ploting
 
+import os
 import numpy as np
 import cv2
 import SimpleITK as sitk
+from concurrent.futures import ThreadPoolExecutor
 
 class LungSegmentation:
     JACCARD_THRESHOLD = 0.05
     MAX_NUMBER_OF_CONTOURS_TO_BE_TRACKED = 6
     preprocessing = Preprocessing()
     postprocessing = Postprocessing()
-    plot = Ploting()
 
-    def __init__(self, scanPath):
+    def __init__(self, scanPath, numberOfWorkers=None):
+        # numberOfWorkers bounds the threads of the per-slice contour extraction (all cores by default)
+        self.numberOfWorkers = numberOfWorkers or os.cpu_count()
         self.scanMeta = self.readScanMetaFrom(scanPath)
         self.scan = self.metaToScan()
         self.scanDimensions = self.scan.shape
@@ -40,23 +42,24 @@ class LungSegmentation:
         return postprocessedMask
     
     def refine(self, coarseScan):
-        coarseScan[coarseScan==0] = coarseScan.max()
-        HounsfieldUnitRange = (100, 700)
-        clippedScan = self.preprocessing.clipScanToHounsfieldUnitRange(coarseScan, HounsfieldUnitRange)
+        clippedScan = self.clipCoarseScan(coarseScan)
         contoursForEachAxialSlice = self.findContoursForEachAxialSliceOf(clippedScan)
         
         fineMask = self.createFineMaskFrom(contoursForEachAxialSlice)
         return fineMask
 
-    def findContoursForEachAxialSliceOf(self, clippedScan):
-        numberOfAxialSlices = clippedScan.shape[0]
-        contoursForEachAxialSlice = [None] * numberOfAxialSlices
-        for i in range(0, numberOfAxialSlices):
-            axialSlice = clippedScan[i]
-            sliceContours = self.findContoursOf(axialSlice)
-            contoursForEachAxialSlice[i] = sliceContours
-            centerIndex = int(len(contoursForEachAxialSlice)/2)
+    @staticmethod
+    def clipCoarseScan(coarseScan):
+        # fills the masked out region with the maximum so it is treated like body tissue.
+        # Clips in place, the coarse scan is a temporary of segmentLung and no second copy is needed
+        coarseScan[coarseScan==0] = coarseScan.max()
+        HU_min, HU_max = (100, 700)
+        return np.clip(coarseScan, a_min=HU_min, a_max=HU_max, out=coarseScan)
 
+    def findContoursForEachAxialSliceOf(self, clippedScan):
+        # the slices are independent and opencv releases the GIL, so they are processed by a thread pool
+        with ThreadPoolExecutor(max_workers=self.numberOfWorkers) as executor:
+            contoursForEachAxialSlice = list(executor.map(self.findContoursOf, clippedScan))
         return contoursForEachAxialSlice
     
     def findContoursOf(self, axialSlice):
@@ -90,10 +93,16 @@ class LungSegmentation:
         return refinedMask
     
     def refineMaskBytrackingLungContours(self, contoursForEachAxialSlice, direction):
+        refinedMask = np.zeros(self.scanDimensions)
+        for i, lungMask in self.trackLungContours(contoursForEachAxialSlice, direction):
+            refinedMask[i] = lungMask
+        return refinedMask
+
+    def trackLungContours(self, contoursForEachAxialSlice, direction):
+        # yields the index and lung mask of each axial slice, tracking the lung from the center slice on
         startIndex = self.getStartIndex(contoursForEachAxialSlice, direction)
         finalIndex = self.getFinalIndex(contoursForEachAxialSlice, direction)
         stepDirection = self.stepDirectionToInteger(direction)
-        refinedMask = np.zeros(self.scanDimensions)
 
         centerContours = contoursForEachAxialSlice[startIndex]
         previousMasks = self.getCandidateMasksFrom(centerContours)
@@ -101,11 +110,9 @@ class LungSegmentation:
             CurrentContours = contoursForEachAxialSlice[i]
             lungMasks = self.comparePreviousMasksToCurrentContours(previousMasks,CurrentContours)
             lungMask = self.createSingleMaskFrom(lungMasks)
-            refinedMask[i] = lungMask
+            yield i, lungMask
             previousMasks = lungMasks
 
-        return refinedMask
-
     @staticmethod
     def getStartIndex(contoursForEachAxialSlice, direction):
         centerIndex = int(len(contoursForEachAxialSlice)/2)
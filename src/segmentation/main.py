@@ -5,16 +5,20 @@
 # # -----------------------------------------------------------------------------
 
 import SimpleITK as sitk
+import argparse
 import os
 from lungSegmentation import LungSegmentation
+from streamingSegmentation import StreamingLungSegmentation
 
-def segmentAndSaveImage(originalImagePath, segmentedImagePath, segmentedMaskPath):
-    # Read the original image
-    originalImage = sitk.ReadImage(originalImagePath)
-    originalData = sitk.GetArrayFromImage(originalImage)
+def segmentAndSaveImage(originalImagePath, segmentedImagePath, segmentedMaskPath, streaming=False, slabSize=16):
+    if streaming:
+        return segmentAndSaveImageStreaming(originalImagePath, segmentedImagePath, segmentedMaskPath, slabSize)
+    # Read the original image once, the segmentation keeps it
+    lungSeg = LungSegmentation(originalImagePath)
+    originalImage = lungSeg.scanMeta
+    originalData = lungSeg.scan
 
     # Segment the image 
-    lungSeg = LungSegmentation(originalImagePath)
     predictedMask = lungSeg.segmentLung()
     segmentedData = predictedMask * originalData
 
@@ -39,17 +43,39 @@ def segmentAndSaveImage(originalImagePath, segmentedImagePath, segmentedMaskPath
     sitk.WriteImage(segmentedImage, segmentedImagePath)
     sitk.WriteImage(segmentedMask, segmentedMaskPath)
 
+def segmentAndSaveImageStreaming(originalImagePath, segmentedImagePath, segmentedMaskPath, slabSize=16):
+    # Bounded memory: the scan is read in slabs and the masks live on disk until they are written
+    os.makedirs(os.path.dirname(segmentedImagePath), exist_ok=True)
+    os.makedirs(os.path.dirname(segmentedMaskPath), exist_ok=True)
+    lungSeg = StreamingLungSegmentation(originalImagePath, slabSize=slabSize)
+    try:
+        predictedMask = lungSeg.segmentLung()
+        lungSeg.saveAsNifti(predictedMask, segmentedMaskPath)
+        lungSeg.saveSegmentedScan(predictedMask, segmentedImagePath)
+    finally:
+        lungSeg.close()
+
 
 if __name__ == "__main__":
-    # Example usage on the COPDgene dataset
-    datasetDirectory = "data"
-
-    for i in range(1,5):
-        for status in ["i", "e"]:
-            originalImagePath = os.path.join(datasetDirectory, f"copd{i}/copd{i}_{status}BHCT.nii")
-            segmentedImagePath = os.path.join(datasetDirectory, f"copd{i}/segmentations/copd{i}_{status}BHCT_segmented.nii")
-            segmentedMaskPath = os.path.join(datasetDirectory, f"copd{i}/segmentations/copd{i}_{status}BHCT_mask.nii")
-
-            print(originalImagePath)
-            segmentAndSaveImage(originalImagePath, segmentedImagePath, segmentedMaskPath)
-    
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Segment the lungs of the COPDgene dataset.")
+    parser.add_argument("--streaming", action="store_true", help="process the scans in slabs with bounded memory")
+    parser.add_argument("--slab-size", type=int, default=16, help="slices per slab in streaming mode")
+    parser.add_argument("--input", default=None, help="segment a single scan instead of the dataset")
+    parser.add_argument("--segmented", default=None, help="output of the segmented scan, with --input")
+    parser.add_argument("--mask", default=None, help="output of the lung mask, with --input")
+    args = parser.parse_args()
+
+    if args.input:
+        segmentAndSaveImage(args.input, args.segmented, args.mask, streaming=args.streaming, slabSize=args.slab_size)
+    else:
+        # Example usage on the COPDgene dataset
+        datasetDirectory = "data"
+
+        for i in range(1,5):
+            for status in ["i", "e"]:
+                originalImagePath = os.path.join(datasetDirectory, f"copd{i}/copd{i}_{status}BHCT.nii")
+                segmentedImagePath = os.path.join(datasetDirectory, f"copd{i}/segmentations/copd{i}_{status}BHCT_segmented.nii")
+                segmentedMaskPath = os.path.join(datasetDirectory, f"copd{i}/segmentations/copd{i}_{status}BHCT_mask.nii")
+
+                print(originalImagePath)
+                segmentAndSaveImage(originalImagePath, segmentedImagePath, segmentedMaskPath, streaming=args.streaming, slabSize=args.slab_size)
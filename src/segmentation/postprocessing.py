@@ -72,3 +72,22 @@ class Postprocessing:
             combinedMask = np.logical_or(combinedMask, mask).astype(int)
         return combinedMask
 
+    @staticmethod
+    def findLungLabels(labeledArray, numFeatures):
+        # same selection as postprocessing, on the label image only: the three largest components,
+        # without those touching the volume edges, then the lung (one or two components)
+        componentSizes = np.bincount(labeledArray.ravel(), minlength=numFeatures + 1)
+        componentSizes[0] = 0
+        largestComponents = [component for component in np.argsort(componentSizes)[-3:] if componentSizes[component] > 0]
+
+        edgeLabels = set()
+        for axis in range(labeledArray.ndim):
+            for index in (0, -1):
+                edgeLabels.update(np.unique(np.take(labeledArray, index, axis=axis)).tolist())
+        remainingComponents = [component for component in largestComponents if component not in edgeLabels][::-1]
+
+        if len(remainingComponents) == 0:
+            return []
+        if len(remainingComponents) >= 2 and np.isclose(componentSizes[remainingComponents[0]], componentSizes[remainingComponents[1]], rtol=0.5):
+            return remainingComponents[:2]
+        return remainingComponents[:1]
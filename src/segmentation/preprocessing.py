@@ -6,10 +6,8 @@
 
 import numpy as np
 import cv2
-from ploting import Ploting
 
 class Preprocessing:
-    plot = Ploting()
     minDerivative = 1e10
     maskSizes = None
 
@@ -21,13 +19,23 @@ class Preprocessing:
         HounsfieldUnitRange = (100, 700)
         clippedScan = self.clipScanToHounsfieldUnitRange(scan, HounsfieldUnitRange)
         mask = self.createMaskOf(clippedScan)
+        mask = self.repairBrokenSlicesOf(mask)
+        mask = self.fillHolesOfEachAxialSliceOf(mask)
+        return mask
+
+    def repairBrokenSlicesOf(self, mask):
+        # the mask sizes are cached per scan, reset them so a reused instance does not see the previous scan
+        self.maskSizes = None
+        self.minDerivative = 1e10
         mask, nBrokenSlices = self.replaceBrokenSlice(mask)
 
         i = 1
         while nBrokenSlices > 0 and i < mask.shape[1]:
             mask, nBrokenSlices = self.replaceBrokenSlice(mask)
             i+=1
+        return mask
 
+    def fillHolesOfEachAxialSliceOf(self, mask):
         numberOfAxialSlices = mask.shape[0]
         for i in range(0,numberOfAxialSlices):
             axialMask = mask[i]
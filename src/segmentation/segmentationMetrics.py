@@ -0,0 +1,151 @@
+# # -----------------------------------------------------------------------------
+# # Overlap and surface distance metrics of lung masks against reference masks
+# # Date Created: 19-10-2026
+# # -----------------------------------------------------------------------------
+
+import argparse
+import csv
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import nibabel as nib
+from scipy.ndimage import binary_erosion, distance_transform_edt
+
+
+class SegmentationMetrics:
+    # Dice, Jaccard, volume difference, Hausdorff 95 and mean surface distance of two binary masks.
+    # Distances are in mm: one euclidean distance transform per mask, with the voxel spacing as sampling,
+    # computed on the bounding box of both masks only.
+    FIELD_NAMES = ["dice", "jaccard", "predictedML", "referenceML", "volumeDifferenceML", "relativeVolumeDifference", "hd95", "msd"]
+
+    @classmethod
+    def compute(cls, predictedMask, referenceMask, spacing):
+        predicted, reference = cls.cropToBoundingBox(predictedMask > 0, referenceMask > 0)
+        voxelVolumeML = float(np.prod(spacing)) / 1000
+        predictedVoxels = int(predicted.sum())
+        referenceVoxels = int(reference.sum())
+        intersection = int(np.logical_and(predicted, reference).sum())
+        union = predictedVoxels + referenceVoxels - intersection
+
+        metrics = {
+            "dice": 2.0 * intersection / (predictedVoxels + referenceVoxels) if union else 1.0,
+            "jaccard": intersection / union if union else 1.0,
+            "predictedML": predictedVoxels * voxelVolumeML,
+            "referenceML": referenceVoxels * voxelVolumeML,
+            "volumeDifferenceML": (predictedVoxels - referenceVoxels) * voxelVolumeML,
+            "relativeVolumeDifference": (predictedVoxels - referenceVoxels) / referenceVoxels if referenceVoxels else float("nan"),
+        }
+        metrics.update(cls.surfaceDistances(predicted, reference, spacing))
+        return metrics
+
+    @staticmethod
+    def cropToBoundingBox(predicted, reference):
+        # one voxel of margin so that the surfaces are not cut by the border
+        union = predicted | reference
+        if not union.any():
+            return predicted, reference
+        box = tuple(slice(max(int(indices.min()) - 1, 0), int(indices.max()) + 2) for indices in np.nonzero(union))
+        return predicted[box], reference[box]
+
+    @classmethod
+    def surfaceDistances(cls, predicted, reference, spacing):
+        predictedSurface = cls.surfaceOf(predicted)
+        referenceSurface = cls.surfaceOf(reference)
+        if not predictedSurface.any() and not referenceSurface.any():
+            return {"hd95": 0.0, "msd": 0.0}
+        if not predictedSurface.any() or not referenceSurface.any():
+            return {"hd95": float("inf"), "msd": float("inf")}
+
+        # distance of every voxel to the nearest surface voxel of the other mask
+        predictedToReference = distance_transform_edt(~referenceSurface, sampling=spacing)[predictedSurface]
+        referenceToPredicted = distance_transform_edt(~predictedSurface, sampling=spacing)[referenceSurface]
+        return {
+            "hd95": float(max(np.percentile(predictedToReference, 95), np.percentile(referenceToPredicted, 95))),
+            "msd": float(np.concatenate([predictedToReference, referenceToPredicted]).mean()),
+        }
+
+    @staticmethod
+    def surfaceOf(mask):
+        # voxels of the mask with at least one face neighbour outside of it
+        return mask & ~binary_erosion(mask, border_value=0)
+
+
+class SegmentationEvaluation:
+    # Compares the masks written by segmentation/main.py to reference masks with the same file names,
+    # e.g. manual masks or the masks of a previous run when testing new thresholds. One process per mask.
+    def __init__(self, numberOfWorkers=None):
+        self.numberOfWorkers = numberOfWorkers
+
+    @staticmethod
+    def findPairs(predictedFolder, referenceFolder, fileNames=None):
+        # (name, predicted path, reference path) of the masks present in both folders
+        if fileNames is None:
+            fileNames = sorted(name for name in os.listdir(referenceFolder) if name.endswith((".nii", ".nii.gz")))
+        pairs = []
+        for fileName in fileNames:
+            predictedPath = os.path.join(predictedFolder, fileName)
+            referencePath = os.path.join(referenceFolder, fileName)
+            if os.path.exists(predictedPath) and os.path.exists(referencePath):
+                pairs.append((fileName.split(".nii")[0], predictedPath, referencePath))
+            else:
+                print(f"Skipping {fileName}: missing prediction or reference")
+        return pairs
+
+    def run(self, pairs):
+        # one row per pair, in the order of the pairs
+        with ProcessPoolExecutor(max_workers=self.numberOfWorkers) as executor:
+            return list(executor.map(evaluatePair, pairs))
+
+    @staticmethod
+    def writeCsv(rows, filePath):
+        folderPath = os.path.dirname(filePath)
+        if folderPath:
+            os.makedirs(folderPath, exist_ok=True)
+        with open(filePath, mode='w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=["name"] + SegmentationMetrics.FIELD_NAMES)
+            writer.writeheader()
+            writer.writerows(rows)
+
+    @staticmethod
+    def printRows(rows):
+        print(f"{'name':>24} {'dice':>7} {'jaccard':>7} {'volDiff[ml]':>11} {'hd95[mm]':>9} {'msd[mm]':>8}")
+        for row in rows:
+            print(f"{row['name']:>24} {row['dice']:7.4f} {row['jaccard']:7.4f} {row['volumeDifferenceML']:11.1f} {row['hd95']:9.2f} {row['msd']:8.2f}")
+        if rows:
+            print(f"{'mean':>24} {np.mean([row['dice'] for row in rows]):7.4f} {np.mean([row['jaccard'] for row in rows]):7.4f} "
+                  f"{np.mean([row['volumeDifferenceML'] for row in rows]):11.1f} {np.mean([row['hd95'] for row in rows]):9.2f} {np.mean([row['msd'] for row in rows]):8.2f}")
+
+
+def evaluatePair(pair):
+    # module level so that it can be sent to the worker processes
+    name, predictedPath, referencePath = pair
+    predictedImage = nib.load(predictedPath)
+    referenceImage = nib.load(referencePath)
+    if predictedImage.shape != referenceImage.shape:
+        raise ValueError(f"{name}: shape {predictedImage.shape} does not match the reference {referenceImage.shape}")
+    spacing = tuple(float(s) for s in referenceImage.header.get_zooms()[:3])
+    metrics = SegmentationMetrics.compute(np.asanyarray(predictedImage.dataobj), np.asanyarray(referenceImage.dataobj), spacing)
+    return dict(metrics, name=name)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Dice, Jaccard, volume difference, HD95 and mean surface distance of lung masks.")
+    parser.add_argument("--reference", required=True, help="folder with the reference masks, same file names as the predictions")
+    parser.add_argument("--predicted", default=None, help="folder with the predicted masks, the COPDgene segmentations by default")
+    parser.add_argument("--data", default="data", help="dataset folder, used without --predicted")
+    parser.add_argument("--cases", type=int, nargs="+", default=[1, 2, 3, 4])
+    parser.add_argument("--output", default="evaluation/segmentation_metrics.csv")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.predicted:
+        pairs = SegmentationEvaluation.findPairs(args.predicted, args.reference)
+    else:
+        # both phases of every case, the masks are in data/copd<N>/segmentations
+        pairs = []
+        for i in args.cases:
+            pairs += SegmentationEvaluation.findPairs(os.path.join(args.data, f"copd{i}", "segmentations"), args.reference, [f"copd{i}_{status}BHCT_mask.nii" for status in ["i", "e"]])
+    rows = SegmentationEvaluation(args.workers).run(pairs)
+    SegmentationEvaluation.printRows(rows)
+    SegmentationEvaluation.writeCsv(rows, args.output)
@@ -0,0 +1,144 @@
+# # -----------------------------------------------------------------------------
+# # Slab-streaming lung segmentation with bounded memory
+# # Date Created: 19-10-2026
+# # -----------------------------------------------------------------------------
+
+import os
+import shutil
+import tempfile
+import numpy as np
+import nibabel as nib
+from scipy.ndimage import label
+from lungSegmentation import LungSegmentation
+
+class StreamingLungSegmentation(LungSegmentation):
+    # Same algorithm as LungSegmentation, but the scan is read lazily from a memory-mapped NIfTI in slabs
+    # and every intermediate mask is an on-disk uint8 memmap. The 5x5 median blur and the 30x30 box filter
+    # work inside sagittal (coarse mask) or axial (hole filling, contours) planes, so slabs are cut
+    # perpendicular to those planes and need no halo. Only the connected components step maps the full mask.
+    HU_RANGE = (100, 700)
+
+    def __init__(self, scanPath, slabSize=16, workDirectory=None, numberOfWorkers=None):
+        self.numberOfWorkers = numberOfWorkers or os.cpu_count()
+        self.slabSize = slabSize
+        self.scanImage = nib.load(scanPath, mmap=True)
+        x, y, z = self.scanImage.shape[:3]
+        self.scanDimensions = (z, y, x)
+        self.scan = self.mapScan(scanPath)
+        self.ownsWorkDirectory = workDirectory is None
+        self.workDirectory = workDirectory or tempfile.mkdtemp(prefix="lungseg_")
+        os.makedirs(self.workDirectory, exist_ok=True)
+
+    def close(self):
+        if self.ownsWorkDirectory:
+            shutil.rmtree(self.workDirectory, ignore_errors=True)
+
+    #################################
+    ### SLABS #######################
+    #################################
+
+    def mapScan(self, scanPath):
+        # (z,y,x) view of an uncompressed, unscaled NIfTI as a read-only memmap, None when it cannot be mapped.
+        # The offset comes from the array proxy, some writers leave vox_offset at 0 in single file NIfTIs
+        header = self.scanImage.header
+        slope, intercept = header.get_slope_inter()
+        if not scanPath.endswith(".nii") or slope not in (None, 1.0) or intercept not in (None, 0.0):
+            return None
+        data = np.memmap(scanPath, dtype=header.get_data_dtype(), mode="r", offset=int(self.scanImage.dataobj.offset), shape=self.scanImage.shape[:3], order="F")
+        return data.T
+
+    def readSlab(self, axis, start, stop):
+        # reads scan[start:stop] along axis 0 (axial) or 2 (sagittal) in (z,y,x) order, the NIfTI stores (x,y,z).
+        # Mapped scans are read page by page, other files (e.g. .nii.gz) through nibabel's array proxy
+        if self.scan is not None:
+            slab = self.scan[start:stop] if axis == 0 else self.scan[:, :, start:stop]
+            return slab.astype("int16")
+        if axis == 0:
+            slab = self.scanImage.dataobj[:, :, start:stop]
+        elif axis == 2:
+            slab = self.scanImage.dataobj[start:stop, :, :]
+        else:
+            raise ValueError(f"Slabs are read along axis 0 or 2, not {axis}")
+        return np.ascontiguousarray(np.asarray(slab).T).astype("int16", copy=False)
+
+    def slabsAlong(self, axis):
+        size = self.scanDimensions[axis]
+        for start in range(0, size, self.slabSize):
+            yield start, min(start + self.slabSize, size)
+
+    def createWorkArray(self, name, dtype="uint8"):
+        return np.lib.format.open_memmap(os.path.join(self.workDirectory, name + ".npy"), mode="w+", dtype=dtype, shape=self.scanDimensions)
+
+    #################################
+    ### SEGMENTATION ################
+    #################################
+
+    def segmentLung(self):
+        # returns the lung mask as a (z,y,x) uint8 memmap in the work directory
+        coarseMask = self.createCoarseMask()
+        contoursForEachAxialSlice = self.findContoursStreaming(coarseMask)
+        del coarseMask
+        fineMask = self.createFineMaskStreaming(contoursForEachAxialSlice)
+        return self.postprocessStreaming(fineMask)
+
+    def createCoarseMask(self):
+        coarseMask = self.createWorkArray("coarseMask")
+        # sagittal slabs: every sagittal slice is processed on its own
+        for start, stop in self.slabsAlong(2):
+            clippedSlab = self.preprocessing.clipScanToHounsfieldUnitRange(self.readSlab(2, start, stop), self.HU_RANGE)
+            for i in range(stop - start):
+                coarseMask[:, :, start + i] = self.preprocessing.createMaskFrom(clippedSlab[:, :, i])
+        coarseMask = self.preprocessing.repairBrokenSlicesOf(coarseMask)
+        # axial slabs: the holes are filled in place in each axial slice
+        for start, stop in self.slabsAlong(0):
+            self.preprocessing.fillHolesOfEachAxialSliceOf(coarseMask[start:stop])
+        coarseMask.flush()
+        return coarseMask
+
+    def findContoursStreaming(self, coarseMask):
+        contoursForEachAxialSlice = []
+        for start, stop in self.slabsAlong(0):
+            coarseScan = coarseMask[start:stop] * self.readSlab(0, start, stop)
+            # the whole scan always contains tissue above the clipping range, so the masked out voxels
+            # take the upper limit, as clipCoarseScan does with the maximum of the full volume
+            coarseScan[coarseScan==0] = self.HU_RANGE[1]
+            clippedSlab = np.clip(coarseScan, a_min=self.HU_RANGE[0], a_max=self.HU_RANGE[1], out=coarseScan)
+            contoursForEachAxialSlice += self.findContoursForEachAxialSliceOf(clippedSlab)
+        return contoursForEachAxialSlice
+
+    def createFineMaskStreaming(self, contoursForEachAxialSlice):
+        # both tracking directions write into the same on-disk mask (they do not share slices)
+        fineMask = self.createWorkArray("fineMask")
+        for direction in ["centerToTop", "centerToBottom"]:
+            for i, lungMask in self.trackLungContours(contoursForEachAxialSlice, direction):
+                fineMask[i] += lungMask.astype("uint8")
+        fineMask.flush()
+        return fineMask
+
+    def postprocessStreaming(self, fineMask):
+        # the only full volume step: connected components on the uint8 mask with an int32 label image
+        labeledArray, numFeatures = label(fineMask, output=np.int32)
+        lungLabels = self.postprocessing.findLungLabels(labeledArray, numFeatures)
+        lungMask = self.createWorkArray("lungMask")
+        for start, stop in self.slabsAlong(0):
+            lungMask[start:stop] = np.isin(labeledArray[start:stop], lungLabels)
+        lungMask.flush()
+        return lungMask
+
+    #################################
+    ### STORAGE #####################
+    #################################
+
+    def saveAsNifti(self, volume, filePath):
+        # (z,y,x) C-ordered memmap is the (x,y,z) Fortran-ordered array of the NIfTI, no copy is made
+        image = nib.Nifti1Image(volume.T, self.scanImage.affine, self.scanImage.header)
+        image.set_data_dtype(volume.dtype)
+        nib.save(image, filePath)
+
+    def saveSegmentedScan(self, lungMask, filePath):
+        # masked scan written slab by slab, geometry of the original scan
+        segmented = self.createWorkArray("segmented", dtype="int16")
+        for start, stop in self.slabsAlong(0):
+            segmented[start:stop] = lungMask[start:stop] * self.readSlab(0, start, stop)
+        segmented.flush()
+        self.saveAsNifti(segmented, filePath)
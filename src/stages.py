@@ -0,0 +1,80 @@
+# # -----------------------------------------------------------------------------
+# # Overlapped execution of a chain of stages over many cases (producer/consumer)
+# # Date Created: 19-10-2026
+# # -----------------------------------------------------------------------------
+
+import queue
+import threading
+import time
+
+
+class OverlappedStages:
+    # Every stage has its own worker threads and reads the cases from a bounded queue filled by the stage before,
+    # so case N+1 can be segmented while case N is registered and case N-1 evaluated. Only case identifiers go
+    # through the queues (the data stays on disk); queueSize bounds how far a stage runs ahead of the next one
+    # and with it the number of cases in flight. A case that fails in a stage is not passed on.
+    STOP = object()
+
+    def __init__(self, stages, queueSize=1):
+        # stages: list of (name, function, numberOfWorkers), function(case) is called once per case
+        self.stages = stages
+        self.queueSize = queueSize
+        self.results = {}
+        self.failures = {}
+        self.timeline = []
+        self.lock = threading.Lock()
+
+    def run(self, cases):
+        # returns {case: return value of the last stage}, failed cases are in self.failures
+        self.startTime = time.perf_counter()
+        queues = [queue.Queue(maxsize=self.queueSize) for _ in self.stages]
+        workers = []
+        for index, (name, function, numberOfWorkers) in enumerate(self.stages):
+            outputQueue = queues[index + 1] if index + 1 < len(queues) else None
+            threads = [threading.Thread(target=self.work, args=(name, function, queues[index], outputQueue), name=f"{name}-{i}", daemon=True) for i in range(numberOfWorkers)]
+            for thread in threads:
+                thread.start()
+            workers.append(threads)
+
+        for case in cases:
+            queues[0].put(case)
+        # a stage is stopped once all workers of the stage before it are finished
+        for index, threads in enumerate(workers):
+            for _ in threads:
+                queues[index].put(self.STOP)
+            for thread in threads:
+                thread.join()
+        self.wallSeconds = time.perf_counter() - self.startTime
+        return self.results
+
+    def work(self, name, function, inputQueue, outputQueue):
+        while True:
+            case = inputQueue.get()
+            if case is self.STOP:
+                return
+            startTime = time.perf_counter()
+            try:
+                result = function(case)
+            except Exception as e:
+                print(f"[{name}] {case} failed: {e}")
+                with self.lock:
+                    self.failures[case] = (name, e)
+                continue
+            finally:
+                with self.lock:
+                    self.timeline.append((name, case, startTime - self.startTime, time.perf_counter() - self.startTime))
+            print(f"[{name}] {case} finished")
+            if outputQueue is not None:
+                outputQueue.put(case)
+            else:
+                with self.lock:
+                    self.results[case] = result
+
+    def summary(self):
+        # busy time of each stage compared to the wall time, a stage close to 100% is the bottleneck
+        lines = [f"wall time {self.wallSeconds:.1f}s"]
+        for name, _, numberOfWorkers in self.stages:
+            busySeconds = sum(end - start for stage, _, start, end in self.timeline if stage == name)
+            utilization = busySeconds / (self.wallSeconds * numberOfWorkers) if self.wallSeconds > 0 else 0.0
+            lines.append(f"{name:>12}: busy {busySeconds:8.1f}s, {numberOfWorkers} worker(s), utilization {100 * utilization:5.1f}%")
+        return "\n".join(lines)
@@ -4,10 +4,9 @@
 # # Date Created: 12-12-2023
 # # -----------------------------------------------------------------------------
 
-import itk
 import os
 import pathlib
-import nibabel as nib
+import threading
 
 class Utils:
     def __init__self(self):
@@ -15,12 +14,14 @@ class Utils:
 
     @staticmethod
     def loadImageFrom(imagePath):
-        # Load images with itk floats (itk.F). Necessary for elastix
+        # Load images with itk floats (itk.F). Necessary for elastix. itk is imported on first use, it takes seconds
+        import itk
         return itk.imread(imagePath, itk.SS)
 
     @staticmethod
     def loadTransformParameterObject(filePaths):
         # initializes 
+        import itk
         parameterObject = itk.ParameterObject.New()
         for parameterPath in filePaths:
             parameterObject.AddParameterFile(parameterPath)
@@ -52,9 +53,10 @@ class Utils:
 
     def readNiftiImage(self, filePath):
         # Read Nifti image
+        import nibabel as nib
         try:
-            niftiImage = nib.load(filePath).get_fdata()
-            return niftiImage, nib.load(filePath).affine
+            niftiImage = nib.load(filePath)
+            return niftiImage.get_fdata(), niftiImage.affine
         except Exception as e:
             print(f"Error reading NIFTI image from {filePath}: {str(e)}")
 
@@ -105,5 +107,38 @@ class Utils:
         return name, extension
 
 
+class MemorySampler:
+    # Peak of the current resident memory of this process while the with block runs, sampled every interval
+    # seconds from /proc/self/statm (linux). Unlike ru_maxrss it is not the peak since the process started, so
+    # it belongs to what ran inside the block. peakMB is None where /proc is not available.
+    PAGE_MB = os.sysconf("SC_PAGE_SIZE") / 1024 ** 2 if hasattr(os, "sysconf") else None
 
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.peakMB = None
+        self.stopSampling = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
 
+    @classmethod
+    def currentMB(cls):
+        try:
+            with open("/proc/self/statm", 'r') as file:
+                return int(file.read().split()[1]) * cls.PAGE_MB
+        except (OSError, TypeError):
+            return None
+
+    def sample(self):
+        while True:
+            current = self.currentMB()
+            if current is not None:
+                self.peakMB = current if self.peakMB is None else max(self.peakMB, current)
+            if self.stopSampling.wait(self.interval):
+                return
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopSampling.set()
+        self.thread.join()
@@ -0,0 +1,304 @@
+# # -----------------------------------------------------------------------------
+# # Shared-memory cache of decoded volumes for the worker processes of a node
+# # Date Created: 19-10-2026
+# # -----------------------------------------------------------------------------
+
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import closing, contextmanager
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+import SimpleITK as sitk
+
+
+class CachedVolume:
+    # a decoded volume attached from shared memory: (z,y,x) array plus the ITK geometry, no copy is made
+    def __init__(self, key, sharedMemory, shape, dtype, spacing, origin, direction):
+        self.key = key
+        self.sharedMemory = sharedMemory
+        self.spacing = spacing
+        self.origin = origin
+        self.direction = direction
+        self.array = np.ndarray(shape, dtype=dtype, buffer=sharedMemory.buf)
+        # the memory is shared with every other worker
+        self.array.flags.writeable = False
+
+    def toItkImage(self):
+        # itk image viewing the shared memory. itk needs a writable buffer, elastix only reads its input images
+        import itk
+        writableArray = np.ndarray(self.array.shape, dtype=self.array.dtype, buffer=self.sharedMemory.buf)
+        image = itk.GetImageViewFromArray(writableArray)
+        image.SetSpacing(self.spacing)
+        image.SetOrigin(self.origin)
+        image.SetDirection(itk.matrix_from_array(np.array(self.direction, dtype=np.float64).reshape(3, 3)))
+        return image
+
+    def close(self):
+        self.array = None
+        try:
+            self.sharedMemory.close()
+        except BufferError:
+            # an image still views the memory, the mapping goes away together with it
+            pass
+
+
+class SharedVolumeCache:
+    # Every image is decoded once per node into a POSIX shared memory segment (int16, like itk.imread(path, itk.SS)).
+    # A SQLite index in a node-local directory keeps shape, dtype, geometry and the processes holding each
+    # volume. Volumes are keyed by path, size and modification time, so a rewritten file is decoded again.
+    # Unreferenced volumes are evicted least recently used first when the cache exceeds capacityMB; holders of
+    # processes that died are dropped. Segments outlive the process that created them until they are evicted.
+    SHM_PREFIX = "dirlab_"
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS volumes (
+            key TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            shmName TEXT NOT NULL,
+            shape TEXT,
+            dtype TEXT,
+            spacing TEXT,
+            origin TEXT,
+            direction TEXT,
+            nbytes INTEGER NOT NULL DEFAULT 0,
+            state TEXT NOT NULL,
+            loaderPid INTEGER,
+            lastUsed REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS holders (
+            key TEXT NOT NULL REFERENCES volumes(key) ON DELETE CASCADE,
+            pid INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (key, pid)
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, indexDirectory=None, capacityMB=4096, pollInterval=0.1):
+        self.indexDirectory = indexDirectory or os.path.join(tempfile.gettempdir(), "dirlab_volume_cache")
+        os.makedirs(self.indexDirectory, exist_ok=True)
+        self.databasePath = os.path.join(self.indexDirectory, "index.sqlite")
+        self.capacityBytes = int(capacityMB * 2**20)
+        self.pollInterval = pollInterval
+        # key -> (CachedVolume, count) of this process, shared by the threads of a worker
+        self.attached = {}
+        self.attachedLock = threading.Lock()
+        with closing(self.connect()) as connection:
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.executescript(self.SCHEMA)
+
+    def connect(self):
+        connection = sqlite3.connect(self.databasePath, timeout=60, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA foreign_keys = ON")
+        return connection
+
+    @staticmethod
+    def getKey(imagePath):
+        stat = os.stat(imagePath)
+        return hashlib.sha1(f"{os.path.abspath(imagePath)}|{stat.st_size}|{stat.st_mtime_ns}".encode()).hexdigest()[:20]
+
+    #################################
+    ### ACQUIRE / RELEASE ###########
+    #################################
+
+    @contextmanager
+    def volume(self, imagePath):
+        # with cache.volume(path) as volume: ... released at the end of the block
+        volume = self.acquire(imagePath)
+        try:
+            yield volume
+        finally:
+            self.release(volume)
+
+    def acquire(self, imagePath):
+        # returns the CachedVolume of imagePath, decoding it if no process did so before. Call release when done
+        key = self.getKey(imagePath)
+        while True:
+            with closing(self.connect()) as connection:
+                connection.execute("BEGIN IMMEDIATE")
+                self.removeDeadHolders(connection)
+                row = connection.execute("SELECT * FROM volumes WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    connection.execute(
+                        "INSERT INTO volumes (key, path, shmName, state, loaderPid, lastUsed) VALUES (?, ?, ?, 'loading', ?, ?)",
+                        (key, os.path.abspath(imagePath), self.SHM_PREFIX + key, os.getpid(), time.time()))
+                    connection.execute("COMMIT")
+                    row = self.decode(imagePath, key)
+                    break
+                if row["state"] == "ready":
+                    self.addHolder(connection, key)
+                    connection.execute("COMMIT")
+                    break
+                if not self.isAlive(row["loaderPid"]):
+                    # the decoding process died, the next acquire decodes again
+                    connection.execute("DELETE FROM volumes WHERE key = ?", (key,))
+                    self.unlink(row["shmName"])
+                connection.execute("COMMIT")
+            time.sleep(self.pollInterval)
+        return self.attach(row)
+
+    def decode(self, imagePath, key):
+        # decodes into a new segment and publishes it in the index, returns the index row
+        try:
+            image = sitk.ReadImage(imagePath, sitk.sitkInt16)
+            array = sitk.GetArrayViewFromImage(image)
+            self.makeRoomFor(array.nbytes)
+            sharedMemory = SharedMemory(name=self.SHM_PREFIX + key, create=True, size=max(array.nbytes, 1))
+            self.untrack(sharedMemory)
+            np.ndarray(array.shape, dtype=array.dtype, buffer=sharedMemory.buf)[...] = array
+            sharedMemory.close()
+        except BaseException:
+            with closing(self.connect()) as connection:
+                connection.execute("DELETE FROM volumes WHERE key = ?", (key,))
+            self.unlink(self.SHM_PREFIX + key)
+            raise
+        with closing(self.connect()) as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute(
+                "UPDATE volumes SET shape = ?, dtype = ?, spacing = ?, origin = ?, direction = ?, nbytes = ?, state = 'ready', lastUsed = ? WHERE key = ?",
+                (json.dumps(array.shape), array.dtype.str, json.dumps(image.GetSpacing()), json.dumps(image.GetOrigin()),
+                 json.dumps(image.GetDirection()), int(array.nbytes), time.time(), key))
+            self.addHolder(connection, key)
+            row = connection.execute("SELECT * FROM volumes WHERE key = ?", (key,)).fetchone()
+            connection.execute("COMMIT")
+        return row
+
+    def attach(self, row):
+        # one mapping per process and volume, shared by nested acquires and by threads
+        with self.attachedLock:
+            if row["key"] in self.attached:
+                volume, count = self.attached[row["key"]]
+                self.attached[row["key"]] = (volume, count + 1)
+                return volume
+            sharedMemory = SharedMemory(name=row["shmName"])
+            self.untrack(sharedMemory)
+            volume = CachedVolume(
+                row["key"], sharedMemory, tuple(json.loads(row["shape"])), np.dtype(row["dtype"]),
+                tuple(json.loads(row["spacing"])), tuple(json.loads(row["origin"])), tuple(json.loads(row["direction"])))
+            self.attached[row["key"]] = (volume, 1)
+            return volume
+
+    def release(self, volume):
+        with self.attachedLock:
+            volume, count = self.attached[volume.key]
+            if count > 1:
+                self.attached[volume.key] = (volume, count - 1)
+            else:
+                del self.attached[volume.key]
+                volume.close()
+        with closing(self.connect()) as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute("UPDATE holders SET count = count - 1 WHERE key = ? AND pid = ?", (volume.key, os.getpid()))
+            connection.execute("DELETE FROM holders WHERE count <= 0")
+            connection.execute("UPDATE volumes SET lastUsed = ? WHERE key = ?", (time.time(), volume.key))
+            connection.execute("COMMIT")
+
+    def close(self):
+        # releases everything this process still holds
+        with self.attachedLock:
+            attached = list(self.attached.values())
+        for volume, count in attached:
+            for _ in range(count):
+                self.release(volume)
+
+    #################################
+    ### EVICTION ####################
+    #################################
+
+    def makeRoomFor(self, nbytes):
+        # evicts unreferenced volumes, least recently used first, until nbytes more fit into the capacity
+        with closing(self.connect()) as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            self.removeDeadHolders(connection)
+            used = connection.execute("SELECT COALESCE(SUM(nbytes), 0) FROM volumes").fetchone()[0]
+            candidates = connection.execute(
+                "SELECT key, shmName, nbytes FROM volumes WHERE state = 'ready' AND key NOT IN (SELECT key FROM holders) ORDER BY lastUsed").fetchall()
+            for candidate in candidates:
+                if used + nbytes <= self.capacityBytes:
+                    break
+                self.evictRow(connection, candidate)
+                used -= candidate["nbytes"]
+            connection.execute("COMMIT")
+
+    def evictUnused(self):
+        # frees every volume no process holds, returns the number of evicted volumes
+        with closing(self.connect()) as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            self.removeDeadHolders(connection)
+            candidates = connection.execute("SELECT key, shmName FROM volumes WHERE state = 'ready' AND key NOT IN (SELECT key FROM holders)").fetchall()
+            for candidate in candidates:
+                self.evictRow(connection, candidate)
+            connection.execute("COMMIT")
+        return len(candidates)
+
+    def evictRow(self, connection, row):
+        # processes that still have the segment mapped keep it until they unmap it
+        connection.execute("DELETE FROM volumes WHERE key = ?", (row["key"],))
+        self.unlink(row["shmName"])
+
+    def removeDeadHolders(self, connection):
+        for row in connection.execute("SELECT DISTINCT pid FROM holders").fetchall():
+            if not self.isAlive(row["pid"]):
+                connection.execute("DELETE FROM holders WHERE pid = ?", (row["pid"],))
+
+    def entries(self):
+        with closing(self.connect()) as connection:
+            return [dict(row) for row in connection.execute(
+                "SELECT v.key, v.path, v.state, v.nbytes, v.lastUsed, COALESCE(SUM(h.count), 0) AS holders "
+                "FROM volumes v LEFT JOIN holders h ON h.key = v.key GROUP BY v.key ORDER BY v.lastUsed")]
+
+    #################################
+    ### HELPERS #####################
+    #################################
+
+    def addHolder(self, connection, key):
+        connection.execute(
+            "INSERT INTO holders (key, pid, count) VALUES (?, ?, 1) ON CONFLICT(key, pid) DO UPDATE SET count = count + 1",
+            (key, os.getpid()))
+        connection.execute("UPDATE volumes SET lastUsed = ? WHERE key = ?", (time.time(), key))
+
+    @staticmethod
+    def untrack(sharedMemory):
+        # the multiprocessing resource tracker would unlink the segment when this process exits
+        resource_tracker.unregister(sharedMemory._name, "shared_memory")
+
+    @staticmethod
+    def unlink(shmName):
+        try:
+            sharedMemory = SharedMemory(name=shmName)
+        except FileNotFoundError:
+            return
+        # attaching registers the segment with the resource tracker, unlink unregisters it again
+        sharedMemory.close()
+        sharedMemory.unlink()
+
+    @staticmethod
+    def isAlive(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or free the shared-memory volume cache of this node.")
+    parser.add_argument("command", choices=["status", "evict"])
+    parser.add_argument("--index", default=None, help="index directory, the same for all workers of the node")
+    args = parser.parse_args()
+
+    cache = SharedVolumeCache(args.index)
+    if args.command == "evict":
+        print(f"Evicted {cache.evictUnused()} volumes")
+    for entry in cache.entries():
+        print(f"{entry['path']}: {entry['state']}, {entry['nbytes'] / 2**20:.1f}MB, {entry['holders']} holder(s)")
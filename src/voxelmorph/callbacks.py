@@ -0,0 +1,110 @@
+# # -----------------------------------------------------------------------------
+# # Checkpointing And Telemetry Callbacks For Voxelmorph Training
+# # Date Created: 19-10-2026
+# # -----------------------------------------------------------------------------
+
+import collections
+import json
+import os
+import resource
+import time
+import numpy as np
+import tensorflow as tf
+
+
+class TrainingCheckpoint:
+    # weights, optimizer state and the number of finished epochs, so a preempted run continues where it stopped
+    def __init__(self, vxm_model, checkpointDirectory, max_to_keep=3):
+        self.epoch = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self.checkpoint = tf.train.Checkpoint(model=vxm_model, optimizer=vxm_model.optimizer, epoch=self.epoch)
+        self.manager = tf.train.CheckpointManager(self.checkpoint, checkpointDirectory, max_to_keep=max_to_keep)
+
+    def restoreLatest(self):
+        # returns the epoch to continue from, 0 without checkpoint
+        if self.manager.latest_checkpoint:
+            self.checkpoint.restore(self.manager.latest_checkpoint)
+            print(f"Resuming from {self.manager.latest_checkpoint} (epoch {int(self.epoch.numpy())})")
+        return int(self.epoch.numpy())
+
+    def save(self, epoch):
+        self.epoch.assign(epoch)
+        return self.manager.save(checkpoint_number=epoch)
+
+
+class CheckpointCallback(tf.keras.callbacks.Callback):
+    def __init__(self, trainingCheckpoint, every=1):
+        super().__init__()
+        self.trainingCheckpoint = trainingCheckpoint
+        self.every = every
+        self.lastEpoch = None
+        self.lastSavedEpoch = None
+
+    def on_epoch_end(self, epoch, logs=None):
+        # keras epochs are zero based, the checkpoint stores the number of finished epochs
+        self.lastEpoch = epoch + 1
+        if self.lastEpoch % self.every == 0:
+            self.trainingCheckpoint.save(self.lastEpoch)
+            self.lastSavedEpoch = self.lastEpoch
+
+    def on_train_end(self, logs=None):
+        # always keep the last state, also when the number of epochs is not a multiple of every
+        if self.lastEpoch is not None and self.lastEpoch != self.lastSavedEpoch:
+            self.trainingCheckpoint.save(self.lastEpoch)
+
+
+class EpochTelemetry(tf.keras.callbacks.Callback):
+    # writes one json line per epoch: wall time, step time, time the training loop waited for data and peak memory.
+    # Keras fetches the next batch inside the train step, so the wait cannot be read from the callbacks alone.
+    # instrument(dataset) appends a timed stage to the training dataset: it records when each batch leaves the
+    # input pipeline, and a step waited for data when its batch became ready after the step began. Only the
+    # batches that are trained on are timed, no extra batches are read and no random state is consumed.
+    # dataWaitFraction near 1 means the run is input-bound.
+    def __init__(self, logPath):
+        super().__init__()
+        self.logPath = logPath
+        self.readyTimes = collections.deque()
+        os.makedirs(os.path.dirname(logPath) or ".", exist_ok=True)
+
+    def instrument(self, dataset):
+        # the dataset to train on, elements are unchanged
+        def stamp(*element):
+            ready = tf.py_function(self.recordReady, [], tf.float64)
+            with tf.control_dependencies([ready]):
+                element = tf.nest.map_structure(tf.identity, element)
+            return element if len(element) > 1 else element[0]
+        return dataset.map(stamp).prefetch(1)
+
+    def recordReady(self):
+        # runs on a tf.data thread, deque appends are thread-safe
+        self.readyTimes.append(time.perf_counter())
+        return 0.0
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epochStart = time.perf_counter()
+        self.stepTimes = []
+        self.waitTimes = []
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.batchStart = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.stepTimes.append(time.perf_counter() - self.batchStart)
+        if self.readyTimes:
+            # batches are stamped in order, the oldest stamp belongs to this step
+            self.waitTimes.append(max(0.0, self.readyTimes.popleft() - self.batchStart))
+
+    def on_epoch_end(self, epoch, logs=None):
+        wallSeconds = time.perf_counter() - self.epochStart
+        record = {
+            "epoch": epoch + 1,
+            "wallSeconds": wallSeconds,
+            "steps": len(self.stepTimes),
+            "stepSeconds": float(np.mean(self.stepTimes)) if self.stepTimes else None,
+            "dataWaitSeconds": float(np.sum(self.waitTimes)) if self.waitTimes else None,
+            "dataWaitFraction": float(np.sum(self.waitTimes) / np.sum(self.stepTimes)) if self.waitTimes and self.stepTimes else None,
+            "peakMemoryMB": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+        record.update({key: float(value) for key, value in (logs or {}).items()})
+        with open(self.logPath, "a") as file:
+            file.write(json.dumps(record) + "\n")
@@ -32,7 +32,7 @@ class CTDataGenerator(Sequence):
         exhalation_batch = self.exhalation_images[idx * self.batch_size:(idx + 1) * self.batch_size]
         inhalation_batch = self.preprocessing.preprocess(np.array(inhalation_batch))[...,np.newaxis]
         exhalation_batch = self.preprocessing.preprocess(np.array(exhalation_batch))[...,np.newaxis]
-        zero_phi = np.zeros(inhalation_batch.shape)
+        zero_phi = np.zeros(inhalation_batch.shape, dtype=np.float32)
         # Add any additional processing here if necessary
         return [exhalation_batch,inhalation_batch],[inhalation_batch,zero_phi]
     
@@ -0,0 +1,81 @@
+# # -----------------------------------------------------------------------------
+# # tf.data Input Pipeline For Voxelmorph
+# # Date Created: 19-10-2026
+# # -----------------------------------------------------------------------------
+
+import numpy as np
+import tensorflow as tf
+# Add the utils folder to sys.path
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from preprocessing import Preprocessing
+
+class CTDataPipeline:
+    # Replacement of CTDataGenerator: the deterministic preprocessing (min-max + CLAHE) runs once
+    # and is cached, random augmentation runs in parallel map calls and batches are prefetched.
+    def __init__(self, inhalation_images, exhalation_images, batch_size=1, shuffle=True, augment=False, cacheFile=""):
+        self.inhalation_images = inhalation_images
+        self.exhalation_images = exhalation_images
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.augment = augment
+        # empty string caches in memory, a file path caches on disk and is reused by later runs
+        self.cacheFile = cacheFile
+        self.vol_shape = tuple(np.shape(inhalation_images[0]))
+        self.preprocessing = Preprocessing()
+
+    def __len__(self):
+        # number of batches per epoch
+        return int(np.ceil(len(self.inhalation_images) / self.batch_size))
+
+    def preprocessVolume(self, volume):
+        # same preprocessing as CTDataGenerator with a batch of one, kept in float32
+        volume = np.array(volume, dtype=np.float32)[np.newaxis]
+        volume = self.preprocessing.preprocess(volume)
+        return volume[0, ..., np.newaxis].astype(np.float32)
+
+    def loadPair(self, index):
+        # moving (exhalation) and fixed (inhalation) volume of one case
+        index = int(index)
+        moving = self.preprocessVolume(self.exhalation_images[index])
+        fixed = self.preprocessVolume(self.inhalation_images[index])
+        return moving, fixed
+
+    def build(self):
+        # returns a tf.data.Dataset of ((moving, fixed), (fixed, zero_phi)) batches
+        AUTOTUNE = tf.data.AUTOTUNE
+        nPairs = len(self.inhalation_images)
+        dataset = tf.data.Dataset.range(nPairs)
+        dataset = dataset.map(self.loadPairOp, num_parallel_calls=AUTOTUNE, deterministic=True)
+        dataset = dataset.cache(self.cacheFile)
+        if self.shuffle:
+            dataset = dataset.shuffle(nPairs, reshuffle_each_iteration=True)
+        if self.augment:
+            dataset = dataset.map(self.randomFlip, num_parallel_calls=AUTOTUNE)
+        dataset = dataset.batch(self.batch_size)
+        dataset = dataset.map(self.toModelInputs, num_parallel_calls=AUTOTUNE)
+        return dataset.prefetch(AUTOTUNE)
+
+    def loadPairOp(self, index):
+        # wraps loadPair for tf.data, numpy_function loses the static shape so it is set again
+        moving, fixed = tf.numpy_function(self.loadPair, [index], (tf.float32, tf.float32))
+        moving.set_shape(self.vol_shape + (1,))
+        fixed.set_shape(self.vol_shape + (1,))
+        return moving, fixed
+
+    @staticmethod
+    def randomFlip(moving, fixed):
+        # flips both volumes along the same random spatial axes to keep them aligned
+        for axis in range(3):
+            flip = tf.random.uniform(()) < 0.5
+            moving = tf.cond(flip, lambda: tf.reverse(moving, axis=[axis]), lambda: moving)
+            fixed = tf.cond(flip, lambda: tf.reverse(fixed, axis=[axis]), lambda: fixed)
+        return moving, fixed
+
+    @staticmethod
+    def toModelInputs(moving, fixed):
+        # inputs [moving, fixed], targets [fixed, zero_phi] as in CTDataGenerator
+        zero_phi = tf.zeros_like(fixed)
+        return (moving, fixed), (fixed, zero_phi)
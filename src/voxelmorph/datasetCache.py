@@ -0,0 +1,111 @@
+# # -----------------------------------------------------------------------------
+# # Memory-mapped cache of the resized Voxelmorph training volumes
+# # Date Created: 19-10-2026
+# # -----------------------------------------------------------------------------
+
+import hashlib
+import os
+import re
+import numpy as np
+import nibabel as nib
+import cv2
+
+
+class DatasetCache:
+    VERSION = 2
+    MAX_CHANNELS_PER_RESIZE = 128 # channel limit of cv2.resize (CV_CN_MAX is 128 from opencv 5 on)
+
+    def __init__(self, imgPath, cacheDirectory="cache/voxelmorph", vol_shape=(256, 256, 128)):
+        self.imgPath = imgPath
+        self.cacheDirectory = cacheDirectory
+        self.vol_shape = tuple(vol_shape)
+        os.makedirs(self.cacheDirectory, exist_ok=True)
+
+    def getCaseNames(self):
+        # case folders in natural order (copd1, copd2, ..., copd10)
+        names = [name for name in os.listdir(self.imgPath) if os.path.isdir(os.path.join(self.imgPath, name))]
+        return sorted(names, key=lambda name: [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", name)])
+
+    def getImagePath(self, caseName, type_scan):
+        return os.path.join(self.imgPath, caseName, f"segmentations/{caseName}_{type_scan}_segmented.nii")
+
+    def load(self, caseName, type_scan):
+        # returns a read-only float32 memmap of shape vol_shape, building the cache entry if needed
+        imagePath = self.getImagePath(caseName, type_scan)
+        cachePath = self.getCachePath(imagePath)
+        if not os.path.exists(cachePath):
+            self.build(imagePath, cachePath)
+        return np.load(cachePath, mmap_mode="r")
+
+    def loadAll(self):
+        # returns the inhalation and exhalation volumes of every case
+        caseNames = self.getCaseNames()
+        inhalationImages = [self.load(caseName, "iBHCT") for caseName in caseNames]
+        exhalationImages = [self.load(caseName, "eBHCT") for caseName in caseNames]
+        return inhalationImages, exhalationImages
+
+    def loadNative(self, caseName, type_scan, kind="segmented"):
+        # full resolution memmap without padding or resizing. kind is "segmented" (float32) or "mask" (uint8)
+        imagePath = os.path.join(self.imgPath, caseName, f"segmentations/{caseName}_{type_scan}_{kind}.nii")
+        dtype = np.uint8 if kind == "mask" else np.float32
+        cachePath = self.getCachePath(imagePath, settings=f"native-{np.dtype(dtype).name}")
+        if not os.path.exists(cachePath):
+            self.build(imagePath, cachePath, resize=False, dtype=dtype)
+        return np.load(cachePath, mmap_mode="r")
+
+    def getCachePath(self, imagePath, settings=None):
+        # the key changes with the source file and with the settings used to build the volume
+        stat = os.stat(imagePath)
+        settings = settings or str(self.vol_shape)
+        key = f"{os.path.abspath(imagePath)}|{stat.st_size}|{stat.st_mtime_ns}|{settings}|{self.VERSION}"
+        name, _ = os.path.splitext(os.path.basename(imagePath))
+        return os.path.join(self.cacheDirectory, f"{name}_{hashlib.sha1(key.encode()).hexdigest()[:16]}.npy")
+
+    def build(self, imagePath, cachePath, resize=True, dtype=np.float32):
+        # decodes, pads and resizes the volume and writes it atomically as a .npy file
+        nifti_image = nib.load(imagePath)
+        image_data = np.asarray(nifti_image.dataobj, dtype=dtype)
+        if resize:
+            image_data = self.padAndResize(image_data)
+
+        temporaryPath = cachePath + f".{os.getpid()}.tmp.npy"
+        np.save(temporaryPath, image_data)
+        os.replace(temporaryPath, cachePath)
+
+    def padAndResize(self, image_data):
+        # resizes all slices in a single call (cv2 treats the slices as channels). Scans with fewer slices than
+        # vol_shape are padded with zero slices, scans with more slices are resampled along z to vol_shape
+        # (VoxelmorphInference.upsampleFlow undoes both), no slice is dropped
+        height, width, nSlices = self.vol_shape
+        nNative = image_data.shape[-1]
+        resized = np.zeros((height, width, nNative), dtype=np.float32)
+        for start in range(0, nNative, self.MAX_CHANNELS_PER_RESIZE):
+            stop = min(start + self.MAX_CHANNELS_PER_RESIZE, nNative)
+            block = np.ascontiguousarray(image_data[:, :, start:stop])
+            resizedBlock = cv2.resize(block, (width, height))
+            resized[:, :, start:stop] = resizedBlock.reshape(height, width, stop - start)
+        if nNative > nSlices:
+            return self.resizeSlices(resized, nSlices)
+        padded = np.zeros(self.vol_shape, dtype=np.float32)
+        padded[:, :, :nNative] = resized
+        return padded
+
+    @staticmethod
+    def resizeSlices(volume, nSlices):
+        # linear resampling of (height, width, slices) along the slice axis, same sample positions as cv2.resize in-plane
+        height, width, nNative = volume.shape
+        rows = np.ascontiguousarray(volume.reshape(height * width, nNative), dtype=np.float32)
+        return cv2.resize(rows, (nSlices, height * width), interpolation=cv2.INTER_LINEAR).reshape(height, width, nSlices)
+
+    def clear(self):
+        for fileName in os.listdir(self.cacheDirectory):
+            if fileName.endswith(".npy"):
+                os.remove(os.path.join(self.cacheDirectory, fileName))
+
+
+if __name__ == "__main__":
+    # builds the cache once, training and evaluation then only map the files
+    imgPath = 'data'
+    cache = DatasetCache(imgPath)
+    inhalation_images, exhalation_images = cache.loadAll()
+    print(f"Cached {len(inhalation_images)} inhalation and {len(exhalation_images)} exhalation volumes in {cache.cacheDirectory}")
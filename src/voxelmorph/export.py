@@ -0,0 +1,154 @@
+# # -----------------------------------------------------------------------------
+# # Export Of Voxelmorph To A CPU-Optimized TFLite Model
+# # Date Created: 19-10-2026
+# # -----------------------------------------------------------------------------
+
+import argparse
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+import numpy as np
+import tensorflow as tf
+
+from datasetCache import DatasetCache
+from inference import VoxelmorphInference
+
+
+class TFLiteExporter:
+    QUANTIZATIONS = ("none", "float16", "int8")
+
+    def __init__(self, vxm_model, vol_shape=(256, 256, 128)):
+        self.vxm_model = vxm_model
+        self.vol_shape = tuple(vol_shape)
+
+    def convert(self, quantization="none"):
+        # freezes the model into a TFLite flatbuffer. int8 is dynamic-range quantization of the weights
+        if quantization not in self.QUANTIZATIONS:
+            raise ValueError(f"Unknown quantization {quantization}, use one of {self.QUANTIZATIONS}")
+
+        with tempfile.TemporaryDirectory() as savedModelDirectory:
+            self.saveServingModel(savedModelDirectory)
+            converter = tf.lite.TFLiteConverter.from_saved_model(savedModelDirectory)
+            # the spatial transformer uses gather ops that are not all tflite builtins
+            converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+            if quantization != "none":
+                converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            if quantization == "float16":
+                converter.target_spec.supported_types = [tf.float16]
+            return converter.convert()
+
+    def saveServingModel(self, savedModelDirectory):
+        # fixed batch size of one and named inputs/outputs, used by TFLiteRunner
+        spec = tf.TensorSpec((1,) + self.vol_shape + (1,), tf.float32)
+
+        @tf.function(input_signature=[tf.TensorSpec(spec.shape, spec.dtype, name="moving"), tf.TensorSpec(spec.shape, spec.dtype, name="fixed")])
+        def serve(moving, fixed):
+            moved, flow = self.vxm_model([moving, fixed], training=False)
+            return {"moved": moved, "flow": flow}
+
+        tf.saved_model.save(self.vxm_model, savedModelDirectory, signatures={"serving_default": serve})
+
+    def export(self, outputPath, quantization="none"):
+        flatbuffer = self.convert(quantization)
+        os.makedirs(os.path.dirname(outputPath) or ".", exist_ok=True)
+        with open(outputPath, "wb") as file:
+            file.write(flatbuffer)
+        print(f"Saved {quantization} TFLite model ({len(flatbuffer) / 2**20:.1f} MB) as {outputPath}")
+        return outputPath
+
+
+class TFLiteRunner:
+    # lightweight replacement of vxm_model.predict for a single pair
+    def __init__(self, modelPath, numThreads=None):
+        self.interpreter = tf.lite.Interpreter(model_path=modelPath, num_threads=numThreads or os.cpu_count())
+        self.runner = self.interpreter.get_signature_runner("serving_default")
+
+    def predict(self, inputs):
+        # same call convention as the keras model: [moving, fixed] -> [moved, flow]
+        moving, fixed = inputs
+        outputs = self.runner(moving=np.asarray(moving, dtype=np.float32), fixed=np.asarray(fixed, dtype=np.float32))
+        return [outputs["moved"], outputs["flow"]]
+
+    def predict_on_batch(self, inputs):
+        # the exported model has a batch size of one, so batches are run pair by pair
+        moving, fixed = (np.asarray(x) for x in inputs)
+        outputs = [self.predict([moving[i:i+1], fixed[i:i+1]]) for i in range(len(moving))]
+        return [np.concatenate([output[0] for output in outputs]), np.concatenate([output[1] for output in outputs])]
+
+
+class ExportBenchmark:
+    # Every backend is loaded and run in a fresh (spawned) process, its memory is the peak resident memory of that
+    # process. Both processes pay for the tensorflow runtime, so the numbers are comparable; measured in one process
+    # ru_maxrss would only ever grow and the second backend would look free.
+    def __init__(self, modelPath, tflitePath, vol_shape, numThreads=None):
+        self.modelPath = modelPath
+        self.tflitePath = tflitePath
+        self.vol_shape = tuple(vol_shape)
+        self.numThreads = numThreads
+
+    def measure(self, backend, inputs, repeats=3):
+        # (flow, median latency, peak memory MB) of backend "keras" or "tflite"
+        modelPath = self.modelPath if backend == "keras" else self.tflitePath
+        with multiprocessing.get_context("spawn").Pool(1) as pool:
+            return pool.apply(measureBackend, (backend, modelPath, self.vol_shape, self.numThreads, inputs, repeats))
+
+    def compare(self, inputs, repeats=3):
+        # numerical agreement of the flows and latency/memory of both models
+        kerasFlow, kerasLatency, kerasMemory = self.measure("keras", inputs, repeats)
+        liteFlow, liteLatency, liteMemory = self.measure("tflite", inputs, repeats)
+        flowDifference = np.abs(kerasFlow - liteFlow)
+        return {
+            "maxFlowDifference": float(flowDifference.max()),
+            "meanFlowDifference": float(flowDifference.mean()),
+            "kerasLatency": kerasLatency,
+            "tfliteLatency": liteLatency,
+            "kerasMemoryMB": kerasMemory,
+            "tfliteMemoryMB": liteMemory,
+        }
+
+
+def measureBackend(backend, modelPath, vol_shape, numThreads, inputs, repeats):
+    # runs in the process of ExportBenchmark.measure: loads the model, warms up and times the predictions
+    if backend == "keras":
+        import voxelmorph as vxm
+        vxm_model = vxm.networks.VxmDense(vol_shape, VoxelmorphInference.NB_FEATURES, int_steps=0)
+        vxm_model.load_weights(modelPath)
+        predict = lambda x: vxm_model.predict(x, verbose=0)
+    else:
+        predict = TFLiteRunner(modelPath, numThreads).predict
+    outputs = predict(inputs)  # warm up
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        outputs = predict(inputs)
+        latencies.append(time.perf_counter() - start)
+    # ru_maxrss is reported in kilobytes on linux
+    peakMemoryMB = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return np.asarray(outputs[1]), float(np.median(latencies)), peakMemoryMB
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export a trained Voxelmorph model to TFLite and check it against keras.")
+    parser.add_argument("--model", default="/notebooks/voxelmorph/Best_Model.h5")
+    parser.add_argument("--output", default="/notebooks/voxelmorph/Best_Model.tflite")
+    parser.add_argument("--quantization", choices=TFLiteExporter.QUANTIZATIONS, default="none")
+    parser.add_argument("--data", default="data", help="cases used for the numerical check")
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--no-check", action="store_true")
+    args = parser.parse_args()
+
+    datasetCache = DatasetCache(args.data)
+    vxm_model = VoxelmorphInference.fromWeights(args.model, datasetCache).vxm_model
+    TFLiteExporter(vxm_model, datasetCache.vol_shape).export(args.output, args.quantization)
+
+    if not args.no_check:
+        from dataPipeline import CTDataPipeline
+        caseName = datasetCache.getCaseNames()[0]
+        pipeline = CTDataPipeline([datasetCache.load(caseName, "iBHCT")], [datasetCache.load(caseName, "eBHCT")], shuffle=False)
+        moving, fixed = pipeline.loadPair(0)
+        inputs = [moving[np.newaxis], fixed[np.newaxis]]
+        results = ExportBenchmark(args.model, args.output, datasetCache.vol_shape, args.threads).compare(inputs)
+        for key, value in results.items():
+            print(f"{key}: {value:.4f}")
@@ -0,0 +1,177 @@
+# # -----------------------------------------------------------------------------
+# # Batched CPU Inference Of Voxelmorph With Native-Resolution Flow Export
+# # Date Created: 19-10-2026
+# # -----------------------------------------------------------------------------
+
+import argparse
+import os
+import time
+import numpy as np
+import nibabel as nib
+import cv2
+from scipy.ndimage import map_coordinates
+# Add the utils folder to sys.path
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from evaluation import Evaluation
+from datasetCache import DatasetCache
+
+
+class VoxelmorphInference:
+    NB_FEATURES = [[16, 32, 32, 32],[32, 32, 32, 32, 32, 16, 16]]
+    evaluation = Evaluation()
+
+    def __init__(self, vxm_model, datasetCache, batch_size=2):
+        self.vxm_model = vxm_model
+        self.datasetCache = datasetCache
+        self.vol_shape = datasetCache.vol_shape
+        self.batch_size = batch_size
+
+    @classmethod
+    def fromWeights(cls, modelPath, datasetCache, batch_size=2):
+        # builds the network once and loads the trained weights
+        import voxelmorph as vxm
+        vxm_model = vxm.networks.VxmDense(datasetCache.vol_shape, cls.NB_FEATURES, int_steps=0)
+        vxm_model.load_weights(modelPath)
+        return cls(vxm_model, datasetCache, batch_size)
+
+    #################################
+    ### PREDICTION ##################
+    #################################
+
+    def predictFlows(self, caseNames):
+        # yields (caseName, moved, flow) on the network grid, predicting batch_size pairs per call
+        from dataPipeline import CTDataPipeline
+        inhalation_images = [self.datasetCache.load(caseName, "iBHCT") for caseName in caseNames]
+        exhalation_images = [self.datasetCache.load(caseName, "eBHCT") for caseName in caseNames]
+        dataset = CTDataPipeline(inhalation_images, exhalation_images, batch_size=self.batch_size, shuffle=False).build()
+
+        caseIndex = 0
+        for inputs, _ in dataset:
+            moved, flow = self.vxm_model.predict_on_batch(inputs)
+            for i in range(len(flow)):
+                yield caseNames[caseIndex], np.asarray(moved[i, ..., 0]), np.asarray(flow[i], dtype=np.float32)
+                caseIndex += 1
+
+    def predictNativeFlows(self, caseNames, slidingWindow):
+        # yields (caseName, None, flow) predicted patch-wise directly on the full resolution grid
+        for caseName in caseNames:
+            moving = self.datasetCache.loadNative(caseName, "eBHCT")
+            fixed = self.datasetCache.loadNative(caseName, "iBHCT")
+            yield caseName, None, slidingWindow.predict(moving, fixed)
+
+    def getNativeShape(self, caseName):
+        # shape and voxel size of the original volume, read from the header only
+        header = nib.load(self.datasetCache.getImagePath(caseName, "iBHCT")).header
+        return tuple(header.get_data_shape()[:3]), tuple(float(z) for z in header.get_zooms()[:3])
+
+    def upsampleFlow(self, flow, nativeShape):
+        # resamples the flow from the network grid to the native grid and converts it to native voxels.
+        # Scans with at most vol_shape[2] slices are only padded by the cache, slice k of the network grid is native
+        # slice k. Longer scans were resampled along z (DatasetCache.padAndResize), their flow is resampled back
+        height, width, nSlices = self.vol_shape
+        nativeSlices = nativeShape[2]
+        if nativeSlices > nSlices:
+            flow = np.stack([DatasetCache.resizeSlices(flow[..., axis], nativeSlices) for axis in range(3)], axis=-1)
+            flow[..., 2] *= nativeSlices / nSlices
+        flowSlices = np.ascontiguousarray(flow[:, :, :nativeSlices, :], dtype=np.float32).reshape(height, width, nativeSlices * 3)
+        nativeFlow = np.zeros(nativeShape + (3,), dtype=np.float32)
+        for start in range(0, flowSlices.shape[-1], DatasetCache.MAX_CHANNELS_PER_RESIZE):
+            stop = min(start + DatasetCache.MAX_CHANNELS_PER_RESIZE, flowSlices.shape[-1])
+            resized = cv2.resize(np.ascontiguousarray(flowSlices[..., start:stop]), (nativeShape[1], nativeShape[0]), interpolation=cv2.INTER_LINEAR)
+            nativeFlow.reshape(nativeShape[0], nativeShape[1], -1)[..., start:stop] = resized.reshape(nativeShape[0], nativeShape[1], stop - start)
+        nativeFlow[..., 0] *= nativeShape[0] / height
+        nativeFlow[..., 1] *= nativeShape[1] / width
+        return nativeFlow
+
+    @staticmethod
+    def warpLandmarks(landmarks, nativeFlow):
+        # moves fixed (inhalation) landmarks into the moving (exhalation) image with trilinear flow interpolation
+        landmarks = np.asarray(landmarks, dtype=np.float64)
+        coordinates = landmarks.T
+        displacement = np.stack([map_coordinates(nativeFlow[..., axis], coordinates, order=1, mode="nearest") for axis in range(3)], axis=1)
+        return landmarks + displacement
+
+    #################################
+    ### STORAGE AND EVALUATION ######
+    #################################
+
+    @staticmethod
+    def writePoints(points, outputFilePath):
+        # same format as Evaluation.extractOutputPoints: one "x y z" line per point
+        with open(outputFilePath, 'w') as outputFile:
+            for point in points:
+                outputFile.write(' '.join(f"{value:.4f}" for value in point) + '\n')
+
+    @staticmethod
+    def saveFlow(nativeFlow, spacing, flowPath):
+        # displacement in native voxels, stored as a vector image (x, y, z, 3)
+        nib.save(nib.Nifti1Image(nativeFlow, affine=np.diag(list(spacing) + [1.0])), flowPath)
+
+    def run(self, caseNames, outputDirectory, saveFlows=True, saveImages=False, slidingWindow=None):
+        # predicts all cases and writes prediction_<case>.txt files, returns the TRE per case.
+        # With a SlidingWindowInference the flows are predicted at full resolution from patches.
+        os.makedirs(outputDirectory, exist_ok=True)
+        treValues = {}
+        predictions = self.predictNativeFlows(caseNames, slidingWindow) if slidingWindow else self.predictFlows(caseNames)
+        for caseName, moved, flow in predictions:
+            startTime = time.perf_counter()
+            nativeShape, spacing = self.getNativeShape(caseName)
+            nativeFlow = flow if slidingWindow else self.upsampleFlow(flow, nativeShape)
+
+            if saveFlows:
+                self.saveFlow(nativeFlow, spacing, os.path.join(outputDirectory, f"flow_{caseName}.nii.gz"))
+            if saveImages and moved is not None:
+                nib.save(nib.Nifti1Image(moved, affine=np.eye(4)), os.path.join(outputDirectory, f"registered_{caseName}.nii"))
+
+            landmarkPath = os.path.join(self.datasetCache.imgPath, caseName, f"{caseName}_300_iBH_xyz_r1.txt")
+            if not os.path.exists(landmarkPath):
+                print(f"{caseName}: no landmarks, only the flow was exported")
+                continue
+            warpedLandmarks = self.warpLandmarks(self.evaluation.readPointsFromFile(landmarkPath), nativeFlow)
+            self.writePoints(warpedLandmarks, os.path.join(outputDirectory, f"prediction_{caseName}.txt"))
+
+            groundTruthPath = os.path.join(self.datasetCache.imgPath, caseName, f"{caseName}_300_eBH_xyz_r1.txt")
+            if not os.path.exists(groundTruthPath):
+                continue
+            groundTruth = self.evaluation.readPointsFromFile(groundTruthPath)
+            tre = self.evaluation.targetRegistrationError(
+                self.evaluation.normalizePoints(warpedLandmarks, spacing),
+                self.evaluation.normalizePoints(groundTruth, spacing))
+            treValues[caseName] = tre
+            print(f"{caseName}: TRE {tre:.2f} mm (export {time.perf_counter() - startTime:.1f}s)")
+        return treValues
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Predict all cases with a trained Voxelmorph model on the CPU.")
+    parser.add_argument("--model", default="/notebooks/voxelmorph/Best_Model.h5")
+    parser.add_argument("--data", default="data")
+    parser.add_argument("--output", default="results/voxelmorph")
+    parser.add_argument("--cases", nargs="+", default=None, help="case folders, all cases by default")
+    parser.add_argument("--batch-size", type=int, default=2)
+    parser.add_argument("--tflite", default=None, help="exported TFLite model (see export.py) used instead of --model")
+    parser.add_argument("--patch-shape", type=int, nargs=3, default=None, help="sliding-window inference at full resolution with a patch-trained model")
+    parser.add_argument("--no-flows", action="store_true", help="do not export the native-resolution flows")
+    args = parser.parse_args()
+
+    os.environ.setdefault("CUDA_VISIBLE_DEVICES", "")
+    datasetCache = DatasetCache(args.data)
+    caseNames = args.cases or datasetCache.getCaseNames()
+    if args.tflite:
+        from export import TFLiteRunner
+        inference = VoxelmorphInference(TFLiteRunner(args.tflite), datasetCache, batch_size=args.batch_size)
+    elif args.patch_shape:
+        inference = VoxelmorphInference.fromWeights(args.model, DatasetCache(args.data, vol_shape=args.patch_shape), batch_size=args.batch_size)
+    else:
+        inference = VoxelmorphInference.fromWeights(args.model, datasetCache, batch_size=args.batch_size)
+
+    slidingWindow = None
+    if args.patch_shape:
+        from patches import SlidingWindowInference
+        slidingWindow = SlidingWindowInference(inference.vxm_model, patch_shape=args.patch_shape, batch_size=args.batch_size)
+    treValues = inference.run(caseNames, args.output, saveFlows=not args.no_flows, slidingWindow=slidingWindow)
+    print(f"-------------------")
+    print(f"Mean TRE: {np.mean(list(treValues.values()))}")
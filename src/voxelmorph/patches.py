@@ -0,0 +1,137 @@
+# # -----------------------------------------------------------------------------
+# # Patch-Based Training And Sliding-Window Inference Of Voxelmorph At Full Resolution
+# # Date Created: 19-10-2026
+# # -----------------------------------------------------------------------------
+
+import numpy as np
+
+
+def extractPatch(volume, start, patch_shape):
+    # copies a patch out of a (memory-mapped) volume, parts outside the volume are zero
+    patch = np.zeros(patch_shape, dtype=np.float32)
+    source = tuple(slice(max(s, 0), min(s + p, n)) for s, p, n in zip(start, patch_shape, volume.shape))
+    target = tuple(slice(src.start - s, src.stop - s) for src, s in zip(source, start))
+    patch[target] = volume[source]
+    return patch
+
+
+class PatchSampler:
+    # random patches of corresponding inhalation/exhalation volumes, read lazily from memmaps
+    MASK_STRIDE = (4, 4, 2)
+
+    def __init__(self, inhalation_images, exhalation_images, masks=None, patch_shape=(128, 128, 64), lungBias=0.8, seed=None):
+        self.inhalation_images = inhalation_images
+        self.exhalation_images = exhalation_images
+        self.patch_shape = tuple(patch_shape)
+        self.lungBias = lungBias if masks is not None else 0.0
+        self.rng = np.random.default_rng(seed)
+        self.intensityRanges = [self.getIntensityRange(inhalation, exhalation) for inhalation, exhalation in zip(inhalation_images, exhalation_images)]
+        self.lungVoxels = [self.getLungVoxels(mask) for mask in masks] if masks is not None else None
+
+    @staticmethod
+    def getIntensityRange(inhalation, exhalation):
+        # min-max of each volume, computed once so patches are normalized like whole volumes
+        return (float(np.min(inhalation)), float(np.max(inhalation))), (float(np.min(exhalation)), float(np.max(exhalation)))
+
+    def getLungVoxels(self, mask):
+        # subsampled coordinates inside the lung mask, enough to bias the patch centers
+        stride = self.MASK_STRIDE
+        return np.argwhere(mask[::stride[0], ::stride[1], ::stride[2]]) * np.array(stride)
+
+    def sampleStart(self, caseIndex):
+        volume_shape = np.array(self.inhalation_images[caseIndex].shape)
+        half = np.array(self.patch_shape) // 2
+        lungVoxels = self.lungVoxels[caseIndex] if self.lungVoxels is not None else None
+        if lungVoxels is not None and len(lungVoxels) > 0 and self.rng.random() < self.lungBias:
+            center = lungVoxels[self.rng.integers(len(lungVoxels))]
+        else:
+            center = self.rng.integers(0, volume_shape)
+        # keep the patch inside the volume where possible
+        maxStart = np.maximum(volume_shape - np.array(self.patch_shape), 0)
+        return np.clip(center - half, 0, maxStart)
+
+    def sample(self):
+        # returns one (moving, fixed) pair of normalized float32 patches with a channel axis
+        caseIndex = self.rng.integers(len(self.inhalation_images))
+        start = self.sampleStart(caseIndex)
+        (fixedMin, fixedMax), (movingMin, movingMax) = self.intensityRanges[caseIndex]
+        fixed = (extractPatch(self.inhalation_images[caseIndex], start, self.patch_shape) - fixedMin) / (fixedMax - fixedMin)
+        moving = (extractPatch(self.exhalation_images[caseIndex], start, self.patch_shape) - movingMin) / (movingMax - movingMin)
+        return moving[..., np.newaxis], fixed[..., np.newaxis]
+
+    def generator(self):
+        while True:
+            yield self.sample()
+
+    def build(self, batch_size=1):
+        # infinite tf.data dataset of ((moving, fixed), (fixed, zero_phi)) patch batches
+        import tensorflow as tf
+        from dataPipeline import CTDataPipeline
+        spec = tf.TensorSpec(self.patch_shape + (1,), tf.float32)
+        dataset = tf.data.Dataset.from_generator(self.generator, output_signature=(spec, spec))
+        dataset = dataset.batch(batch_size)
+        dataset = dataset.map(CTDataPipeline.toModelInputs, num_parallel_calls=tf.data.AUTOTUNE)
+        return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+class SlidingWindowInference:
+    # predicts overlapping patches and blends their flows into one full-resolution field
+    def __init__(self, vxm_model, patch_shape=(128, 128, 64), overlap=0.25, batch_size=2):
+        self.vxm_model = vxm_model
+        self.patch_shape = tuple(patch_shape)
+        self.overlap = overlap
+        self.batch_size = batch_size
+        self.weights = self.getBlendingWeights(self.patch_shape)
+
+    @staticmethod
+    def getBlendingWeights(patch_shape):
+        # separable pyramid weights, highest in the patch center and never zero
+        weights = np.ones(patch_shape, dtype=np.float32)
+        for axis, size in enumerate(patch_shape):
+            ramp = np.minimum(np.arange(1, size + 1), np.arange(size, 0, -1)).astype(np.float32)
+            shape = [1, 1, 1]
+            shape[axis] = size
+            weights *= (ramp / ramp.max()).reshape(shape)
+        return weights
+
+    def getWindowStarts(self, volume_shape):
+        # window origins along each axis, the last window is aligned with the end of the volume
+        startsPerAxis = []
+        for size, patch in zip(volume_shape, self.patch_shape):
+            step = max(int(patch * (1 - self.overlap)), 1)
+            starts = list(range(0, max(size - patch, 0) + 1, step))
+            if starts[-1] + patch < size:
+                starts.append(size - patch)
+            startsPerAxis.append(starts)
+        return [(x, y, z) for x in startsPerAxis[0] for y in startsPerAxis[1] for z in startsPerAxis[2]]
+
+    def predict(self, moving, fixed, outputPath=None):
+        # flow in voxels of the full resolution grid. With outputPath the accumulator is a memmap on disk
+        volume_shape = fixed.shape
+        movingMin, movingMax = float(np.min(moving)), float(np.max(moving))
+        fixedMin, fixedMax = float(np.min(fixed)), float(np.max(fixed))
+        if outputPath:
+            flow = np.lib.format.open_memmap(outputPath, mode="w+", dtype=np.float32, shape=volume_shape + (3,))
+        else:
+            flow = np.zeros(volume_shape + (3,), dtype=np.float32)
+        weightSum = np.zeros(volume_shape, dtype=np.float32)
+
+        starts = self.getWindowStarts(volume_shape)
+        for batchStart in range(0, len(starts), self.batch_size):
+            batchStarts = starts[batchStart:batchStart + self.batch_size]
+            movingBatch = np.stack([(extractPatch(moving, start, self.patch_shape) - movingMin) / (movingMax - movingMin) for start in batchStarts])
+            fixedBatch = np.stack([(extractPatch(fixed, start, self.patch_shape) - fixedMin) / (fixedMax - fixedMin) for start in batchStarts])
+            _, patchFlows = self.vxm_model.predict_on_batch([movingBatch[..., np.newaxis], fixedBatch[..., np.newaxis]])
+            for start, patchFlow in zip(batchStarts, np.asarray(patchFlows)):
+                self.accumulate(flow, weightSum, start, patchFlow)
+
+        flow /= weightSum[..., np.newaxis]
+        return flow
+
+    def accumulate(self, flow, weightSum, start, patchFlow):
+        # adds the weighted patch flow to the part of the field it covers
+        target = tuple(slice(s, min(s + p, n)) for s, p, n in zip(start, self.patch_shape, weightSum.shape))
+        source = tuple(slice(0, t.stop - t.start) for t in target)
+        weights = self.weights[source]
+        flow[target] += patchFlow[source] * weights[..., np.newaxis]
+        weightSum[target] += weights
@@ -5,38 +5,97 @@
 # # -----------------------------------------------------------------------------
 
 
+import argparse
 import os
 import voxelmorph as vxm
 import tensorflow as tf
-from dataGenerator import CTDataGenerator
+from dataPipeline import CTDataPipeline
 from utils_vxm import Utils
+from patches import PatchSampler
+from callbacks import TrainingCheckpoint, CheckpointCallback, EpochTelemetry
 
 
-def run_program(imgPath):
-    utils=Utils(imgPath)
-    # We read the dataset
-    print("Reading images...")
-    inhalation_images,exhalation_images = utils.load_data()
-    train_generator = CTDataGenerator(inhalation_images, exhalation_images, batch_size=1)
-    
-    # Set parameters and train model
-    print("Starting the training...")
-    vol_shape = (256, 256, 128)
+def build_model(vol_shape):
+    # Set parameters and compile model
     nb_features = [[16, 32, 32, 32],[32, 32, 32, 32, 32, 16, 16]]
     lossCombination = [vxm.losses.MSE().loss, vxm.losses.Grad('l2').loss]
     loss_weights = [1, 0.01]
     vxm_model = vxm.networks.VxmDense(vol_shape, nb_features, int_steps=0)
-    vxm_model.compile(tf.keras.optimizers.Adam(lr=1e-3), loss=lossCombination,loss_weights=loss_weights)
-    vxm_model.load_weights("/notebooks/voxelmorph/Best_Model.h5")
-    history=vxm_model.fit(train_generator, epochs=100)
+    vxm_model.compile(tf.keras.optimizers.Adam(learning_rate=1e-3), loss=lossCombination,loss_weights=loss_weights)
+    return vxm_model
+
+def fit_resumable(vxm_model, train_dataset, outputDirectory, epochs, steps_per_epoch=None, initialWeights=None, checkpointEvery=1):
+    # Resumes from the latest checkpoint in outputDirectory/checkpoints, otherwise starts from initialWeights.
+    # Weights and optimizer state are checkpointed every checkpointEvery epochs and each epoch is logged to telemetry.jsonl
+    checkpoint = TrainingCheckpoint(vxm_model, os.path.join(outputDirectory, "checkpoints"))
+    initial_epoch = checkpoint.restoreLatest()
+    if initial_epoch == 0 and initialWeights:
+        vxm_model.load_weights(initialWeights)
+    if initial_epoch >= epochs:
+        print(f"Training already finished ({initial_epoch} epochs)")
+        return None
+
+    telemetry = EpochTelemetry(os.path.join(outputDirectory, "telemetry.jsonl"))
+    callbacks = [CheckpointCallback(checkpoint, every=checkpointEvery), telemetry]
+    return vxm_model.fit(telemetry.instrument(train_dataset), epochs=epochs, initial_epoch=initial_epoch, steps_per_epoch=steps_per_epoch, callbacks=callbacks)
+
+def run_program(imgPath, outputDirectory="/notebooks/voxelmorph", initialWeights=None, epochs=100, checkpointEvery=1):
+    os.makedirs(outputDirectory, exist_ok=True)
+    vol_shape = (256, 256, 128)
+    utils=Utils(imgPath, vol_shape=vol_shape)
+    # We read the dataset
+    print("Reading images...")
+    inhalation_images,exhalation_images = utils.load_data()
+    train_dataset = CTDataPipeline(inhalation_images, exhalation_images, batch_size=1, shuffle=True).build()
+
+    # Train model
+    print("Starting the training...")
+    vxm_model = build_model(vol_shape)
+    history=fit_resumable(vxm_model, train_dataset, outputDirectory, epochs, initialWeights=initialWeights, checkpointEvery=checkpointEvery)
     # Save Model
-    vxm_model.save("/notebooks/voxelmorph/Best_Model.h5")
+    vxm_model.save(os.path.join(outputDirectory, "Best_Model.h5"))
     # Plot results
-    utils.save_training(history, filename='/notebooks/voxelmorph/training_plot.png')
+    if history is not None:
+        utils.save_training(history, filename=os.path.join(outputDirectory, 'training_plot.png'))
 
     # Predict all the images and compute final metrics
-    utils.compute_Metrics(vxm_model)
-    
+    utils.compute_Metrics(vxm_model, outputDirectory=os.path.join(outputDirectory, "results"))
+
+def run_patch_program(imgPath, outputDirectory="/notebooks/voxelmorph/patches", patch_shape=(128, 128, 64), steps_per_epoch=100, epochs=100, lungBias=0.8, initialWeights=None, checkpointEvery=1):
+    # Full resolution training on random patches, peak memory is bounded by the patch size
+    os.makedirs(outputDirectory, exist_ok=True)
+    utils=Utils(imgPath)
+    cache=utils.datasetCache
+    print("Mapping full resolution images...")
+    caseNames = cache.getCaseNames()
+    inhalation_images = [cache.loadNative(name, "iBHCT") for name in caseNames]
+    exhalation_images = [cache.loadNative(name, "eBHCT") for name in caseNames]
+    masks = [cache.loadNative(name, "iBHCT", kind="mask") for name in caseNames]
+    sampler = PatchSampler(inhalation_images, exhalation_images, masks, patch_shape=patch_shape, lungBias=lungBias)
+    train_dataset = sampler.build(batch_size=1)
+
+    print("Starting the patch training...")
+    vxm_model = build_model(patch_shape)
+    history=fit_resumable(vxm_model, train_dataset, outputDirectory, epochs, steps_per_epoch=steps_per_epoch, initialWeights=initialWeights, checkpointEvery=checkpointEvery)
+    vxm_model.save(os.path.join(outputDirectory, "Best_Patch_Model.h5"))
+    if history is not None:
+        utils.save_training(history, filename=os.path.join(outputDirectory, 'training_patch_plot.png'))
+    return vxm_model
+
+
 if __name__ == "__main__":
-    imgPath = 'data'
-    run_program(imgPath)
+    parser = argparse.ArgumentParser(description="Train Voxelmorph, resuming from the latest checkpoint in the output directory.")
+    parser.add_argument("--data", default="data")
+    parser.add_argument("--output", default="/notebooks/voxelmorph", help="checkpoints, telemetry, model and results")
+    parser.add_argument("--initial-weights", default=None, help="weights to start from when there is no checkpoint")
+    parser.add_argument("--epochs", type=int, default=100)
+    parser.add_argument("--checkpoint-every", type=int, default=1, help="epochs between checkpoints")
+    parser.add_argument("--patches", action="store_true", help="full resolution patch training")
+    parser.add_argument("--patch-shape", type=int, nargs=3, default=[128, 128, 64])
+    parser.add_argument("--steps-per-epoch", type=int, default=100, help="patches per epoch in patch training")
+    args = parser.parse_args()
+
+    if args.patches:
+        run_patch_program(args.data, args.output, tuple(args.patch_shape), args.steps_per_epoch, args.epochs, initialWeights=args.initial_weights, checkpointEvery=args.checkpoint_every)
+    else:
+        run_program(args.data, args.output, initialWeights=args.initial_weights, epochs=args.epochs, checkpointEvery=args.checkpoint_every)